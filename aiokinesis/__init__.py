@@ -1,4 +1,20 @@
 __version__ = '0.0.4'
 
+from .checkpoint import (    # noqa F403
+    Checkpoint, Checkpointer, MemoryCheckpointer, SQLiteCheckpointer
+)
 from .consumer import AIOKinesisConsumer    # noqa F403
-from .producer import AIOKinesisProducer    # noqa F403
+from .processor import RecordProcessor    # noqa F403
+from .producer import AIOKinesisProducer, RecordMetadata    # noqa F403
+from .lease import (    # noqa F403
+    Lease, LeaseStore, MemoryLeaseStore, SQLiteLeaseStore
+)
+from .metrics import (    # noqa F403
+    MetricsSink, PrometheusMetricsSink, StatsdMetricsSink
+)
+from .errors import (    # noqa F403
+    BufferFullError, DeliveryTimeoutError, RecordError
+)
+from .record import Record    # noqa F403
+from .retry import RetryPolicy    # noqa F403
+from .transport import AiobotocoreTransport, ExecutorTransport    # noqa F403
@@ -0,0 +1,234 @@
+"""
+KPL compatible record aggregation.
+
+An aggregated record packs many user records into one kinesis record:
+
+    MAGIC + protobuf(AggregatedRecord) + md5(protobuf(AggregatedRecord))
+
+    message AggregatedRecord {
+        repeated string partition_key_table = 1;
+        repeated string explicit_hash_key_table = 2;
+        repeated Record records = 3;
+    }
+    message Record {
+        required uint64 partition_key_index = 1;
+        optional uint64 explicit_hash_key_index = 2;
+        required bytes data = 3;
+        repeated Tag tags = 4;
+    }
+
+Only the handful of protobuf features this format needs are implemented.
+"""
+from hashlib import md5
+
+from .message_accumulator import MAX_RECORD_SIZE
+
+
+MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _varint_size(value):
+    size = 1
+    while value > 0x7f:
+        value >>= 7
+        size += 1
+    return size
+
+
+def _decode_varint(buffer, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _encode_field(number, value):
+    return _encode_varint(number << 3 | _LENGTH_DELIMITED) + \
+        _encode_varint(len(value)) + value
+
+
+def _field_size(value_size):
+    # All fields we write have numbers below 16, so their key is one byte
+    return 1 + _varint_size(value_size) + value_size
+
+
+def _iter_fields(buffer):
+    position = 0
+    end = len(buffer)
+    while position < end:
+        key, position = _decode_varint(buffer, position)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == _VARINT:
+            value, position = _decode_varint(buffer, position)
+        elif wire_type == _LENGTH_DELIMITED:
+            size, position = _decode_varint(buffer, position)
+            value = buffer[position:position + size]
+            position += size
+        elif wire_type == _FIXED64:
+            value = buffer[position:position + 8]
+            position += 8
+        elif wire_type == _FIXED32:
+            value = buffer[position:position + 4]
+            position += 4
+        else:
+            raise ValueError('Unsupported wire type {}'.format(wire_type))
+
+        if position > end:
+            raise ValueError('Truncated protobuf message')
+        yield number, value
+
+
+def _to_bytes(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return bytes(data)
+
+
+class RecordAggregator:
+    """
+    Packs user records into one aggregated kinesis record of at most
+    `max_size` bytes, counting the partition key of the kinesis record
+    """
+
+    def __init__(self, max_size=MAX_RECORD_SIZE):
+        self._max_size = max_size
+
+        self.partition_key = None
+        self._partition_key_indexes = {}
+        self._partition_key_table = []
+        self._records = []
+        self.size = len(MAGIC) + DIGEST_SIZE
+
+    def __len__(self):
+        return len(self._records)
+
+    def _record_size(self, partition_key, data):
+        partition_key_index = self._partition_key_indexes.get(
+            partition_key,
+            len(self._partition_key_table)
+        )
+        record_size = 1 + _varint_size(partition_key_index) + \
+            _field_size(len(data))
+        size = _field_size(record_size)
+
+        # New partition keys are added to the table
+        if partition_key not in self._partition_key_indexes:
+            size += _field_size(len(partition_key.encode('utf-8')))
+        # The first partition key is also the kinesis record's key
+        if self.partition_key is None:
+            size += len(partition_key.encode('utf-8'))
+        return size
+
+    def fits(self, partition_key, data):
+        partition_key = str(partition_key)
+        size = self._record_size(partition_key, _to_bytes(data))
+        return self.size + size <= self._max_size
+
+    def add(self, partition_key, data):
+        partition_key = str(partition_key)
+        data = _to_bytes(data)
+        self.size += self._record_size(partition_key, data)
+
+        if self.partition_key is None:
+            self.partition_key = partition_key
+        partition_key_index = self._partition_key_indexes.get(partition_key)
+        if partition_key_index is None:
+            partition_key_index = len(self._partition_key_table)
+            self._partition_key_indexes[partition_key] = partition_key_index
+            self._partition_key_table.append(partition_key)
+
+        self._records.append(
+            _encode_varint(1 << 3 | _VARINT) +
+            _encode_varint(partition_key_index) +
+            _encode_field(3, data)
+        )
+
+    def serialize(self):
+        message = b''.join(
+            [
+                _encode_field(1, partition_key.encode('utf-8'))
+                for partition_key in self._partition_key_table
+            ] + [
+                _encode_field(3, record)
+                for record in self._records
+            ]
+        )
+        return MAGIC + message + md5(message).digest()
+
+
+def _parse_user_record(buffer):
+    partition_key_index = explicit_hash_key_index = None
+    data = b''
+    for number, value in _iter_fields(buffer):
+        if number == 1:
+            partition_key_index = value
+        elif number == 2:
+            explicit_hash_key_index = value
+        elif number == 3:
+            data = value
+    return partition_key_index, explicit_hash_key_index, data
+
+
+def parse_user_records(data):
+    """
+    Split the data of a kinesis record into the partition key, explicit
+    hash key and data of its user records. Data are memoryviews of `data`,
+    so nothing is copied. Returns None if the record isn't aggregated, or
+    its checksum doesn't match.
+    """
+    if not data.startswith(MAGIC) or \
+            len(data) < len(MAGIC) + DIGEST_SIZE:
+        return None
+
+    message = memoryview(data)[len(MAGIC):-DIGEST_SIZE]
+    if md5(message).digest() != data[-DIGEST_SIZE:]:
+        return None
+
+    try:
+        partition_key_table = []
+        explicit_hash_key_table = []
+        user_records = []
+        for number, value in _iter_fields(message):
+            if number == 1:
+                partition_key_table.append(bytes(value).decode('utf-8'))
+            elif number == 2:
+                explicit_hash_key_table.append(bytes(value).decode('utf-8'))
+            elif number == 3:
+                user_records.append(_parse_user_record(value))
+
+        parsed = []
+        for partition_key_index, explicit_hash_key_index, user_data in \
+                user_records:
+            explicit_hash_key = None
+            if explicit_hash_key_index is not None:
+                explicit_hash_key = \
+                    explicit_hash_key_table[explicit_hash_key_index]
+            parsed.append((
+                partition_key_table[partition_key_index],
+                explicit_hash_key,
+                user_data
+            ))
+    except (ValueError, IndexError, TypeError, UnicodeDecodeError):
+        return None
+
+    return parsed
@@ -0,0 +1,165 @@
+import asyncio
+from collections import namedtuple
+
+from .sqlite import SQLiteDatabase
+
+
+# The last processed record of a shard. User records of a KPL aggregated
+# record also have their position within it.
+Checkpoint = namedtuple(
+    'Checkpoint',
+    ['sequence_number', 'sub_sequence_number']
+)
+Checkpoint.__new__.__defaults__ = (None,)
+
+
+class Checkpointer:
+    """
+    Stores a checkpoint per stream and shard. Stores write every checkpoint
+    of a flush with a single `set_checkpoints` call, so backends with batch
+    writes (such as DynamoDB's BatchWriteItem) can write them at once.
+    """
+
+    async def start(self):
+        pass
+
+    async def get_checkpoint(self, stream_name, shard_id):
+        """
+        Return the Checkpoint of a shard, or None if it has none
+        """
+        raise NotImplementedError
+
+    async def set_checkpoints(self, stream_name, checkpoints):
+        """
+        Store a dict of Checkpoints by shard id
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryCheckpointer(Checkpointer):
+    """
+    Keeps checkpoints in memory, for tests and short lived consumers
+    """
+
+    def __init__(self):
+        self.checkpoints = {}
+
+    async def get_checkpoint(self, stream_name, shard_id):
+        return self.checkpoints.get((stream_name, shard_id))
+
+    async def set_checkpoints(self, stream_name, checkpoints):
+        for shard_id, checkpoint in checkpoints.items():
+            self.checkpoints[(stream_name, shard_id)] = checkpoint
+
+
+class SQLiteCheckpointer(SQLiteDatabase, Checkpointer):
+    """
+    Keeps checkpoints in a local SQLite database file
+    """
+
+    def __init__(self, loop, path, table='checkpoints'):
+        super().__init__(loop, path)
+        self._table = table
+
+    def _create_tables(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            'stream_name TEXT NOT NULL, '
+            'shard_id TEXT NOT NULL, '
+            'sequence_number TEXT NOT NULL, '
+            'sub_sequence_number INTEGER, '
+            'PRIMARY KEY (stream_name, shard_id))'.format(self._table)
+        )
+
+    def _get_checkpoint(self, stream_name, shard_id):
+        row = self._connection.execute(
+            'SELECT sequence_number, sub_sequence_number FROM {} '
+            'WHERE stream_name = ? AND shard_id = ?'.format(self._table),
+            (stream_name, shard_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return Checkpoint(*row)
+
+    async def get_checkpoint(self, stream_name, shard_id):
+        return await self._run(self._get_checkpoint, stream_name, shard_id)
+
+    def _set_checkpoints(self, stream_name, checkpoints):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'
+                .format(self._table),
+                [
+                    (
+                        stream_name,
+                        shard_id,
+                        checkpoint.sequence_number,
+                        checkpoint.sub_sequence_number
+                    )
+                    for shard_id, checkpoint in checkpoints.items()
+                ]
+            )
+
+    async def set_checkpoints(self, stream_name, checkpoints):
+        await self._run(self._set_checkpoints, stream_name, checkpoints)
+
+
+class CheckpointBuffer:
+    """
+    Collects checkpoints in memory and writes them to a Checkpointer once
+    `max_records` records were checkpointed or `interval` seconds passed
+    since the last write, whichever comes first
+    """
+
+    def __init__(self, loop, checkpointer, stream_name, interval=5.0,
+                 max_records=1000):
+        self._loop = loop
+        self._checkpointer = checkpointer
+        self._stream_name = stream_name
+        self.interval = interval
+        self._max_records = max_records
+
+        self._pending = {}
+        self._pending_records = 0
+        self._last_flush = loop.time()
+        self._flush_lock = asyncio.Lock()
+
+    def mark(self, shard_id, checkpoint, count=1):
+        self._pending[shard_id] = checkpoint
+        self._pending_records += count
+
+    def discard(self, shard_id):
+        """
+        Forget a shard's checkpoint that wasn't written yet, e.g. once
+        another consumer took the shard over
+        """
+        self._pending.pop(shard_id, None)
+
+    def due(self):
+        if not self._pending:
+            return False
+        return self._pending_records >= self._max_records or \
+            self._loop.time() - self._last_flush >= self.interval
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._last_flush = self._loop.time()
+            if not self._pending:
+                return
+
+            pending = self._pending
+            self._pending = {}
+            self._pending_records = 0
+            try:
+                await self._checkpointer.set_checkpoints(
+                    self._stream_name,
+                    pending
+                )
+            except Exception:
+                # Keep the checkpoints unless newer ones were marked
+                for shard_id, checkpoint in pending.items():
+                    self._pending.setdefault(shard_id, checkpoint)
+                raise
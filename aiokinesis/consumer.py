@@ -1,71 +1,811 @@
-import boto3
-from botocore.exceptions import ClientError
+import asyncio
+from asyncio import ensure_future
+from collections import deque
+from datetime import datetime, timezone
+import logging
+import time
 
-from .utils import rate_limit_per_rolling_second
+from botocore.exceptions import BotoCoreError, ClientError
+
+from .checkpoint import Checkpoint, CheckpointBuffer
+from .fanout import SubscriptionShardReader, register_stream_consumer
+from .lease import LeaseCoordinator
+from .prefetch_buffer import PrefetchBuffer
+from .rate_limiter import shard_rate_limiter
+from .record import records_from_response
+from .retry import RetryPolicy, error_code
+from .serialization import get_compression
+from .shards import is_open, parent_shard_ids, shard_cache
+from .transport import acquire_shared_transport, release_shared_transport
+
+
+# Maximum number of records a single get_records call can return
+MAX_GET_RECORDS_LIMIT = 10000
+
+# Shortest pause between idle polls, one slot of the 5 requests per second
+MIN_IDLE_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class ShardReader:
+    """
+    Reads records from a single shard. Every reader keeps its own shard
+    iterator. Requests and bytes read are limited by the shard's read
+    budget, which is shared with every other reader of the shard in the
+    process unless a `rate_limiter` is passed. Throttled and transiently
+    failing requests are retried according to `retry_policy`.
+
+    Once the reader is caught up with the shard, empty responses double
+    `idle_interval` up to `max_idle_interval` so idle shards don't burn
+    through the request budget. Any records or lag reset it to zero.
+
+    Shard iterators that expired are renewed after the last record read.
+    Readers that started at LATEST and read nothing yet renew theirs at the
+    time of their last request, so records written since aren't skipped.
+
+    Request latency and time spent waiting for the read budget are reported
+    to `metrics`, a MetricsSink.
+    """
+
+    def __init__(self, transport, stream_name, shard_id,
+                 shard_iterator_type='LATEST', starting_sequence_number=None,
+                 timestamp=None, limit=MAX_GET_RECORDS_LIMIT,
+                 max_idle_interval=1.0, rate_limiter=None,
+                 retry_policy=None, metrics=None):
+        self._transport = transport
+        self._stream_name = stream_name
+        self.shard_id = shard_id
+        self._limit = limit
+        self._max_idle_interval = max_idle_interval
+        self._metrics = metrics
+        self._tags = {'stream': stream_name, 'shard': shard_id}
+
+        if rate_limiter is None:
+            rate_limiter = shard_rate_limiter(stream_name, shard_id, 'read')
+        self._rate_limiter = rate_limiter
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+
+        self.millis_behind_latest = None
+        self.idle_interval = 0
+
+        self._shard_iterator_type = shard_iterator_type
+        self._starting_sequence_number = starting_sequence_number
+        self._timestamp = timestamp
+
+        self._next_shard_iterator = None
+        self._last_sequence_number = None
+
+        # When the shard iterator last pointed at the end of what was read
+        self._read_time = None
+
+        # Set once a closed shard has been read to its end
+        self.closed = False
+
+    async def _create_shard_iterator(self, shard_iterator_type,
+                                     starting_sequence_number=None,
+                                     timestamp=None):
+        shard_iterator_kwargs = {
+            'StreamName': self._stream_name,
+            'ShardId': self.shard_id,
+            'ShardIteratorType': shard_iterator_type
+        }
+        if starting_sequence_number is not None:
+            shard_iterator_kwargs['StartingSequenceNumber'] =\
+                starting_sequence_number
+        if timestamp is not None:
+            shard_iterator_kwargs['Timestamp'] = timestamp
+        requested = datetime.now(timezone.utc)
+        shard_iterator = await self._transport.request(
+            'get_shard_iterator',
+            **shard_iterator_kwargs
+        )
+        self._next_shard_iterator = shard_iterator['ShardIterator']
+        self._read_time = requested
+
+    async def start(self):
+        await self._create_shard_iterator(
+            self._shard_iterator_type,
+            self._starting_sequence_number,
+            self._timestamp
+        )
+
+    async def _renew_shard_iterator(self):
+        # Every record read so far was put in the buffer, so carry on after
+        # the last one
+        if self._last_sequence_number is not None:
+            await self._create_shard_iterator(
+                'AFTER_SEQUENCE_NUMBER',
+                self._last_sequence_number
+            )
+        elif self._shard_iterator_type == 'LATEST':
+            # A new LATEST iterator would skip records written since the
+            # last request found nothing
+            await self._create_shard_iterator(
+                'AT_TIMESTAMP',
+                timestamp=self._read_time
+            )
+        else:
+            # Nothing was read past the starting position yet
+            await self.start()
+
+    async def _get_records_once(self):
+        waited = await self._rate_limiter.acquire()
+        if self._metrics is None:
+            return await self._transport.request(
+                'get_records',
+                ShardIterator=self._next_shard_iterator,
+                Limit=self._limit
+            )
+
+        if waited > 0:
+            self._metrics.timing('consumer.throttle_wait', waited, self._tags)
+        started = time.monotonic()
+        response = await self._transport.request(
+            'get_records',
+            ShardIterator=self._next_shard_iterator,
+            Limit=self._limit
+        )
+        self._metrics.timing(
+            'consumer.get_records_latency',
+            time.monotonic() - started,
+            self._tags
+        )
+        return response
+
+    async def get_records(self):
+        requested = datetime.now(timezone.utc)
+        try:
+            response = await self._retry_policy.call(self._get_records_once)
+        except ClientError as e:
+            # Iterators expire 5 minutes after they were handed out, e.g.
+            # while the consumer is slow to take the records read before
+            # or an idle shard is polled rarely
+            if error_code(e) != 'ExpiredIteratorException':
+                raise
+            await self._renew_shard_iterator()
+            requested = datetime.now(timezone.utc)
+            response = await self._retry_policy.call(self._get_records_once)
+        self._read_time = requested
+
+        if response['Records']:
+            self._last_sequence_number = \
+                response['Records'][-1]['SequenceNumber']
+
+        # Closed shards have no next iterator once they are fully read
+        self._next_shard_iterator = response.get('NextShardIterator')
+        if self._next_shard_iterator is None:
+            self.closed = True
+
+        # Only now do we know how much of the byte budget we used
+        self._rate_limiter.charge(size=sum(
+            len(record['Data'])
+            for record in response['Records']
+        ))
+
+        # Poll as fast as allowed while there is anything to read
+        self.millis_behind_latest = response.get('MillisBehindLatest')
+        if response['Records'] or self.millis_behind_latest != 0:
+            self.idle_interval = 0
+        else:
+            self.idle_interval = min(
+                max(2 * self.idle_interval, MIN_IDLE_INTERVAL),
+                self._max_idle_interval
+            )
+
+        return response
+
+    async def close(self):
+        pass
 
 
 class AIOKinesisConsumer:
     """
     Async client to consume from a kinesis topic
+
+    Records are handed out as Records, which keep only their own fields
+    and not the responses they were read from. KPL aggregated records are
+    split into their user records, which carry the `sequence_number` of the
+    aggregated record and their position in it as `sub_sequence_number`.
+
+    With a `value_deserializer` or `compression`, the `value` of a record is
+    its data decompressed and passed to `value_deserializer`. Values are
+    only decoded when they are first read.
+
+    With a `checkpointer`, each shard resumes after its last checkpoint
+    instead of at `shard_iterator_type`. Records are checkpointed with
+    `checkpoint(record)`, or with `auto_checkpoint` once the next record or
+    list of records is requested. Checkpoints are written every
+    `checkpoint_interval` seconds or `checkpoint_max_records` records and
+    when the consumer stops.
+
+    Shards created by resharding are found by listing the stream's shards
+    every `shard_discovery_interval` seconds. A shard is only read once its
+    parents have been read to their end, so records of a partition key are
+    yielded in order across splits and merges. Shards found after `start`
+    are read from their beginning.
+
+    With a `consumer_name`, the consumer registers itself as an enhanced
+    fan-out consumer of the stream and records are pushed to it over
+    SubscribeToShard, with its own read throughput for every shard.
+
+    With a `lease_store`, consumers sharing the store split the stream's
+    shards between them. Each consumer only reads the shards it holds a
+    lease for, renews its leases every third of `lease_duration` and takes
+    over the leases of consumers that stopped renewing them. Use a
+    `checkpointer` too, so a shard that changes hands resumes where its
+    previous reader left off. The checkpointer and lease store are started
+    by `start` and closed by `stop`.
+
+    Shards are polled by background tasks into a buffer holding one list of
+    records per shard. With `max_prefetch_records` or `max_prefetch_bytes`,
+    the buffer holds up to that many records or bytes instead, so requests
+    are made while the application processes earlier records. Shards aren't
+    polled while the buffer is full.
+
+    Records received, request latency, throttling, errors and how far
+    behind each shard the consumer is are reported to `metrics`, a
+    MetricsSink.
     """
 
     def __init__(self, stream_name, loop, region_name='us-east-1',
                  shard_iterator_type='LATEST', starting_sequence_number=None,
-                 timestamp=None):
+                 timestamp=None, transport=None,
+                 limit=MAX_GET_RECORDS_LIMIT, max_idle_interval=1.0,
+                 retry_policy=None, value_deserializer=None,
+                 compression=None, checkpointer=None, auto_checkpoint=True,
+                 checkpoint_interval=5.0, checkpoint_max_records=1000,
+                 shard_discovery_interval=30.0, consumer_name=None,
+                 lease_store=None, worker_id=None, lease_duration=10.0,
+                 max_prefetch_records=None, max_prefetch_bytes=None,
+                 metrics=None):
+        if not 1 <= limit <= MAX_GET_RECORDS_LIMIT:
+            raise ValueError(
+                'limit must be between 1 and {}'.format(MAX_GET_RECORDS_LIMIT)
+            )
 
         self._stream_name = stream_name
         self._region_name = region_name
         self._loop = loop
 
+        # Clients that aren't given a transport share one per region
+        self._shares_transport = transport is None
+        if transport is None:
+            transport = acquire_shared_transport(loop, region_name)
+        self._transport = transport
+
         self._shard_iterator_type = shard_iterator_type
         self._starting_sequence_number = starting_sequence_number
         self._timestamp = timestamp
+        self._limit = limit
+        self._max_idle_interval = max_idle_interval
+        self._retry_policy = retry_policy
+        self._metrics = metrics
+        self._value_deserializer = value_deserializer
+        self._compression = None
+        if compression is not None:
+            self._compression = get_compression(compression)
+
+        # Values of records are only decoded when they are read
+        self._decode = None
+        if value_deserializer is not None or compression is not None:
+            self._decode = self._decode_value
+
+        self._checkpointer = checkpointer
+        self._auto_checkpoint = auto_checkpoint
+        self._checkpoint_buffer = None
+        if checkpointer is not None:
+            self._checkpoint_buffer = CheckpointBuffer(
+                loop,
+                checkpointer,
+                stream_name,
+                interval=checkpoint_interval,
+                max_records=checkpoint_max_records
+            )
+        self._checkpoint_task = None
+
+        # Records up to a checkpoint within an aggregated record are skipped
+        self._skip_through = {}
+        self._last_handed_out = None
+        self._handed_out_count = 0
+
+        self._consumer_name = consumer_name
+        self._consumer_arn = None
+
+        self._lease_coordinator = None
+        if lease_store is not None:
+            self._lease_coordinator = LeaseCoordinator(
+                loop,
+                lease_store,
+                stream_name,
+                worker_id=worker_id,
+                lease_duration=lease_duration
+            )
+        self._lease_duration = lease_duration
+        self._lease_task = None
+
+        # Shards waiting for their parents, by shard id, with whether they
+        # were listed on start
+        self._shard_discovery_interval = shard_discovery_interval
+        self._discovery_task = None
+        self._shards = {}
+        self._pending_shards = {}
+        self._unfinished_shard_ids = set()
+        self._started = False
+
+        self._shard_readers = {}
+        self._shard_reader_tasks = {}
+        self._shard_tasks = set()
+        self._max_prefetch_records = max_prefetch_records
+        self._max_prefetch_bytes = max_prefetch_bytes
+        self._batches = None
+        self._buffered_records = deque()
+        self._exhausted = False
 
     async def start(self):
-        # Instantiate kinesis client
-        self._kinesis_client = boto3.client(
-            'kinesis',
-            region_name=self._region_name
+        # Start transport
+        await self._transport.start()
+
+        if self._checkpointer is not None:
+            await self._checkpointer.start()
+        if self._lease_coordinator is not None:
+            await self._lease_coordinator.start()
+        if self._consumer_name is not None:
+            self._consumer_arn = await register_stream_consumer(
+                self._transport,
+                self._stream_name,
+                self._consumer_name
+            )
+
+        # Poll every shard concurrently into a single buffer, which holds a
+        # list of records per shard unless prefetching is bounded otherwise
+        shards = await shard_cache(self._transport).list_shards(
+            self._stream_name
+        )
+        max_batches = None
+        if self._max_prefetch_records is None and \
+                self._max_prefetch_bytes is None:
+            max_batches = max(len(shards), 1)
+        self._batches = PrefetchBuffer(
+            self._loop,
+            max_batches=max_batches,
+            max_records=self._max_prefetch_records,
+            max_bytes=self._max_prefetch_bytes,
+            metrics=self._metrics,
+            tags={'stream': self._stream_name}
         )
+        await self._add_shards(shards, initial=True)
+        if self._lease_coordinator is not None:
+            await self._update_leases()
+        await self._start_ready_shards()
+        self._started = True
+
+        if self._shard_discovery_interval is not None:
+            self._discovery_task = ensure_future(
+                self._discovery_routine(),
+                loop=self._loop
+            )
+        if self._checkpoint_buffer is not None:
+            self._checkpoint_task = ensure_future(
+                self._checkpoint_routine(),
+                loop=self._loop
+            )
+        if self._lease_coordinator is not None:
+            self._lease_task = ensure_future(
+                self._lease_routine(),
+                loop=self._loop
+            )
+
+    async def _add_shards(self, shards, initial):
+        for shard in shards:
+            shard_id = shard['ShardId']
+            if shard_id in self._shards:
+                continue
+            self._shards[shard_id] = (shard, initial)
+            self._pending_shards[shard_id] = (shard, initial)
+            self._unfinished_shard_ids.add(shard_id)
+
+        if self._lease_coordinator is not None:
+            await self._lease_coordinator.add_shards(shards)
+
+    def _holds_lease(self, shard_id):
+        return self._lease_coordinator is None or \
+            shard_id in self._lease_coordinator.held
+
+    async def _update_leases(self):
+        held = await self._lease_coordinator.heartbeat()
 
-        # Get shard
-        kinesis_stream = self._kinesis_client.describe_stream(
-            StreamName=self._stream_name
+        # Shards finished by other consumers unblock their children
+        for shard_id in self._lease_coordinator.finished_shard_ids:
+            self._unfinished_shard_ids.discard(shard_id)
+            self._pending_shards.pop(shard_id, None)
+
+        # Stop reading shards whose lease was taken by another consumer
+        for shard_id in list(self._shard_readers):
+            if shard_id not in held:
+                await self._stop_shard(shard_id)
+
+    async def _stop_shard(self, shard_id):
+        task = self._shard_reader_tasks.pop(shard_id)
+        task.cancel()
+        await asyncio.wait([task])
+        await self._shard_readers.pop(shard_id).close()
+
+        # Records fetched ahead belong to the shard's new owner now
+        self._batches.remove(shard_id)
+        self._buffered_records = deque(
+            record for record in self._buffered_records
+            if record.shard_id != shard_id
         )
-        shard_id = kinesis_stream['StreamDescription']['Shards'][0]['ShardId']
 
-        # Create a shard iterator
-        shard_iterator_kwargs = {
-            'StreamName': self._stream_name,
-            'ShardId': shard_id,
-            'ShardIteratorType': self._shard_iterator_type
-        }
-        if self._starting_sequence_number is not None:
-            shard_iterator_kwargs['StartingSequenceNumber'] =\
-                self._starting_sequence_number
-        if self._timestamp is not None:
-            shard_iterator_kwargs['Timestamp'] = self._timestamp
-        shard_iterator = self._kinesis_client.get_shard_iterator(
-            **shard_iterator_kwargs
+        # So do its checkpoints. Writing ours could overwrite the newer
+        # ones of the new owner, who reads what we didn't write again.
+        if self._checkpoint_buffer is not None:
+            self._checkpoint_buffer.discard(shard_id)
+        self._skip_through.pop(shard_id, None)
+
+        # Read it again should the lease come back
+        self._pending_shards[shard_id] = self._shards[shard_id]
+
+    async def _lease_routine(self):
+        while True:
+            await asyncio.sleep(self._lease_duration / 3)
+            try:
+                await self._update_leases()
+            except Exception:
+                # Leases are renewed again on the next round
+                logger.exception('Failed to update leases')
+                continue
+            await self._start_ready_shards()
+
+    async def _start_ready_shards(self):
+        # Parents which aren't listed any more have expired
+        ready = [
+            (shard, initial)
+            for shard, initial in self._pending_shards.values()
+            if self._holds_lease(shard['ShardId']) and
+            not self._unfinished_shard_ids.intersection(
+                parent_shard_ids(shard)
+            )
+        ]
+        for shard, _ in ready:
+            del self._pending_shards[shard['ShardId']]
+
+        await asyncio.gather(*[
+            self._start_shard(shard, initial)
+            for shard, initial in ready
+        ])
+
+    async def _start_shard(self, shard, initial):
+        shard_id = shard['ShardId']
+        try:
+            checkpoint = None
+            if self._checkpointer is not None:
+                checkpoint = await self._checkpointer.get_checkpoint(
+                    self._stream_name,
+                    shard_id
+                )
+
+            # There is nothing after the latest record of a closed shard
+            if initial and checkpoint is None and not is_open(shard) and \
+                    self._shard_iterator_type == 'LATEST':
+                await self._finish_shard(shard_id)
+                return
+
+            shard_reader = self._create_shard_reader(
+                shard_id,
+                checkpoint,
+                initial
+            )
+            await shard_reader.start()
+        except (ClientError, BotoCoreError) as e:
+            if not self._started:
+                raise
+            self._batches.put(e)
+            return
+
+        self._shard_readers[shard_id] = shard_reader
+        task = ensure_future(
+            self._shard_routine(shard_reader),
+            loop=self._loop
         )
-        self._next_shard_iterator = shard_iterator['ShardIterator']
+        task.add_done_callback(self._shard_tasks.discard)
+        self._shard_tasks.add(task)
+        self._shard_reader_tasks[shard_id] = task
 
-    async def __aiter__(self):
-        return self
+    async def _finish_shard(self, shard_id):
+        self._unfinished_shard_ids.discard(shard_id)
+        self._shard_readers.pop(shard_id, None)
+        self._shard_reader_tasks.pop(shard_id, None)
+        if self._lease_coordinator is not None:
+            await self._lease_coordinator.finish(shard_id)
 
-    @rate_limit_per_rolling_second(5)
-    async def __anext__(self):
-        # Get next record
+        # A shard that was open when it was listed ended because the stream
+        # was resharded, so look for its children now rather than on the
+        # next discovery
+        shard, _ = self._shards[shard_id]
+        if self._shard_discovery_interval is not None and is_open(shard):
+            shard_cache(self._transport).invalidate(self._stream_name)
+            await self._discover_shards()
+
+        # Children can be read now that their parent is done
+        await self._start_ready_shards()
+
+    async def _discover_shards(self):
         try:
-            response = self._kinesis_client.get_records(
-                ShardIterator=self._next_shard_iterator,
-                Limit=1
+            shards = await shard_cache(self._transport).list_shards(
+                self._stream_name
             )
-            self._next_shard_iterator = response['NextShardIterator']
-        except ClientError as e:
+        except (ClientError, BotoCoreError):
+            logger.exception('Failed to list shards')
+            return
+        await self._add_shards(shards, initial=False)
+
+    async def _discovery_routine(self):
+        while True:
+            await asyncio.sleep(self._shard_discovery_interval)
+            await self._discover_shards()
+            await self._start_ready_shards()
+
+    def _create_shard_reader(self, shard_id, checkpoint=None, initial=True):
+        shard_iterator_type = self._shard_iterator_type
+        starting_sequence_number = self._starting_sequence_number
+        timestamp = self._timestamp
+
+        # Shards created after start are read from their beginning
+        if not initial:
+            shard_iterator_type = 'TRIM_HORIZON'
+            starting_sequence_number = None
+            timestamp = None
+
+        # Resume after the checkpoint. Aggregated records are read again
+        # and their user records up to the checkpoint skipped.
+        if checkpoint is not None:
+            starting_sequence_number = checkpoint.sequence_number
+            timestamp = None
+            if checkpoint.sub_sequence_number is None:
+                shard_iterator_type = 'AFTER_SEQUENCE_NUMBER'
+            else:
+                shard_iterator_type = 'AT_SEQUENCE_NUMBER'
+                self._skip_through[shard_id] = checkpoint
+
+        if self._consumer_arn is not None:
+            return SubscriptionShardReader(
+                self._transport,
+                self._consumer_arn,
+                shard_id,
+                shard_iterator_type=shard_iterator_type,
+                starting_sequence_number=starting_sequence_number,
+                timestamp=timestamp,
+                retry_policy=self._retry_policy
+            )
+        return ShardReader(
+            self._transport,
+            self._stream_name,
+            shard_id,
+            shard_iterator_type=shard_iterator_type,
+            starting_sequence_number=starting_sequence_number,
+            timestamp=timestamp,
+            limit=self._limit,
+            max_idle_interval=self._max_idle_interval,
+            retry_policy=self._retry_policy,
+            metrics=self._metrics
+        )
+
+    def _skip_checkpointed(self, shard_id, records):
+        checkpoint = self._skip_through[shard_id]
+        skipped = 0
+        for record in records:
+            if record.sequence_number != checkpoint.sequence_number:
+                del self._skip_through[shard_id]
+                break
+            sub_sequence_number = record.sub_sequence_number
+            if sub_sequence_number is not None and \
+                    sub_sequence_number > checkpoint.sub_sequence_number:
+                del self._skip_through[shard_id]
+                break
+            skipped += 1
+        return records[skipped:]
+
+    async def _read_records(self, shard_reader):
+        # Only the records are kept, so the response can be freed before
+        # they are handed out
+        response = await shard_reader.get_records()
+        return records_from_response(
+            response['Records'],
+            shard_reader.shard_id,
+            self._decode
+        )
+
+    async def _shard_routine(self, shard_reader):
+        metrics = self._metrics
+        tags = {'stream': self._stream_name, 'shard': shard_reader.shard_id}
+        while True:
+            # Fetch ahead only while the application keeps up
+            await self._batches.wait_for_space()
+            try:
+                records = await self._read_records(shard_reader)
+            except (ClientError, BotoCoreError) as e:
+                if metrics is not None:
+                    metrics.increment('consumer.errors', 1, tags)
+                self._batches.put(e)
+                return
+
+            if metrics is not None:
+                metrics.increment(
+                    'consumer.records_received',
+                    len(records),
+                    tags
+                )
+                if shard_reader.millis_behind_latest is not None:
+                    metrics.gauge(
+                        'consumer.millis_behind_latest',
+                        shard_reader.millis_behind_latest,
+                        tags
+                    )
+            if shard_reader.shard_id in self._skip_through:
+                records = self._skip_checkpointed(
+                    shard_reader.shard_id,
+                    records
+                )
+
+            # Only hand over batches that have records in them
+            if records:
+                self._batches.put(records, shard_reader.shard_id)
+
+            # Hand over to the children of a fully read shard
+            if shard_reader.closed:
+                await self._finish_shard(shard_reader.shard_id)
+                return
+
+            # Back off while the shard is idle
+            if shard_reader.idle_interval:
+                await asyncio.sleep(shard_reader.idle_interval)
+
+    @property
+    def millis_behind_latest(self):
+        """
+        How far behind the tip of each shard the consumer is, by shard id.
+        None until the first response for a shard has been received.
+        """
+        return {
+            shard_reader.shard_id: shard_reader.millis_behind_latest
+            for shard_reader in self._shard_readers.values()
+        }
+
+    async def _checkpoint_routine(self):
+        while True:
+            await asyncio.sleep(self._checkpoint_buffer.interval)
+            if not self._checkpoint_buffer.due():
+                continue
+            try:
+                await self._checkpoint_buffer.flush()
+            except Exception:
+                # Checkpoints are kept and written with the next flush
+                logger.exception('Failed to write checkpoints')
+
+    def _mark_checkpoint(self, record, count=1):
+        # Shards whose lease was lost are checkpointed by their new owner
+        if not self._holds_lease(record.shard_id):
+            return
+        self._checkpoint_buffer.mark(
+            record.shard_id,
+            Checkpoint(record.sequence_number, record.sub_sequence_number),
+            count
+        )
+
+    async def checkpoint(self, record):
+        """
+        Mark a record and every record of its shard before it as processed
+        """
+        if self._checkpoint_buffer is None:
+            raise RuntimeError('Consumer has no checkpointer')
+
+        self._mark_checkpoint(record)
+        if self._checkpoint_buffer.due():
+            await self._checkpoint_buffer.flush()
+
+    async def _auto_checkpoint_handed_out(self):
+        # Requesting more records means the last ones were processed
+        if self._checkpoint_buffer is None or not self._auto_checkpoint or \
+                self._last_handed_out is None:
+            return
+        record = self._last_handed_out
+        self._last_handed_out = None
+        self._mark_checkpoint(record, self._handed_out_count)
+        if self._checkpoint_buffer.due():
+            await self._checkpoint_buffer.flush()
+
+    def _decode_value(self, data):
+        if self._compression is not None:
+            data = self._compression.decompress(data)
+        if self._value_deserializer is not None:
+            data = self._value_deserializer(data)
+        return data
+
+    async def _next_batch(self):
+        if self._exhausted:
             raise StopAsyncIteration
 
-        return response
+        records = await self._batches.get()
+        if isinstance(records, Exception):
+            self._exhausted = True
+            raise StopAsyncIteration
+
+        return records
+
+    async def getmany(self):
+        """
+        Return the next list of records fetched from any shard.
+        Raises StopAsyncIteration once the consumer can't read any further.
+        """
+        await self._auto_checkpoint_handed_out()
+        if self._buffered_records:
+            records = list(self._buffered_records)
+            self._buffered_records.clear()
+        else:
+            records = await self._next_batch()
+
+        self._last_handed_out = records[-1]
+        self._handed_out_count = len(records)
+        return records
+
+    async def batches(self):
+        """
+        Iterate over whole lists of records instead of single records
+        """
+        while True:
+            try:
+                records = await self.getmany()
+            except StopAsyncIteration:
+                return
+            yield records
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._auto_checkpoint_handed_out()
+
+        # Refill buffer from the next batch of any shard
+        if not self._buffered_records:
+            self._buffered_records.extend(await self._next_batch())
+
+        self._last_handed_out = self._buffered_records.popleft()
+        self._handed_out_count = 1
+        return self._last_handed_out
 
     async def stop(self):
-        pass
+        for task in (self._discovery_task, self._lease_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.wait([task])
+
+        for task in self._shard_tasks:
+            task.cancel()
+        if len(self._shard_tasks):
+            await asyncio.wait(self._shard_tasks)
+        for shard_reader in list(self._shard_readers.values()):
+            await shard_reader.close()
+
+        # Write outstanding checkpoints
+        if self._checkpoint_task is not None:
+            self._checkpoint_task.cancel()
+            await asyncio.wait([self._checkpoint_task])
+            await self._checkpoint_buffer.flush()
+
+        # Hand the shards over to other consumers
+        if self._lease_coordinator is not None:
+            await self._lease_coordinator.release()
+
+        # Close the stores start opened
+        if self._lease_coordinator is not None:
+            await self._lease_coordinator.close()
+        if self._checkpointer is not None:
+            await self._checkpointer.close()
+
+        if self._shares_transport:
+            await release_shared_transport(self._loop, self._region_name)
@@ -0,0 +1,26 @@
+class BufferFullError(Exception):
+    """
+    The producer's buffer is at its record or byte limit
+    """
+
+
+class DeliveryTimeoutError(Exception):
+    """
+    The producer stopped before a message could be delivered
+    """
+
+
+class RecordError(Exception):
+    """
+    A single record that kinesis rejected in a put_records response
+    """
+
+    def __init__(self, error_code, error_message=None):
+        super().__init__(error_code, error_message)
+        self.error_code = error_code
+        self.error_message = error_message
+
+    def __str__(self):
+        if self.error_message:
+            return '{}: {}'.format(self.error_code, self.error_message)
+        return self.error_code
@@ -0,0 +1,336 @@
+"""
+KCL style shard leases, so several consumer processes can split the shards
+of a stream between them.
+
+Every shard has a lease in a shared lease store. Workers renew the leases
+they hold by incrementing their counter. A lease whose counter hasn't
+changed for `lease_duration` seconds belongs to a dead worker and is taken
+over. Workers holding fewer than their share of leases steal from the
+worker holding the most.
+"""
+from collections import namedtuple
+import math
+import random
+import socket
+from uuid import uuid4
+
+from .shards import parent_shard_ids
+from .sqlite import SQLiteDatabase
+
+
+Lease = namedtuple(
+    'Lease',
+    ['shard_id', 'owner', 'counter', 'finished', 'parent_shard_ids']
+)
+Lease.__new__.__defaults__ = (None, 0, False, ())
+
+
+class LeaseStore:
+    """
+    Stores the leases of streams. Every update is conditional on the lease
+    being unchanged since it was read, like a DynamoDB conditional write,
+    so two workers can never both take the same lease.
+    """
+
+    async def start(self):
+        pass
+
+    async def list_leases(self, stream_name):
+        raise NotImplementedError
+
+    async def create_leases(self, stream_name, leases):
+        """
+        Add leases for shards which don't have one yet
+        """
+        raise NotImplementedError
+
+    async def update_lease(self, stream_name, lease, owner, finished):
+        """
+        Set the owner and finished flag of a lease and increment its
+        counter, if its owner and counter are still those of `lease`.
+        Returns the updated Lease, or None if it was changed by someone else.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryLeaseStore(LeaseStore):
+    """
+    Keeps leases in memory, for tests and workers within one process
+    """
+
+    def __init__(self):
+        self.leases = {}
+
+    async def list_leases(self, stream_name):
+        return [
+            lease for (lease_stream_name, _), lease in self.leases.items()
+            if lease_stream_name == stream_name
+        ]
+
+    async def create_leases(self, stream_name, leases):
+        for lease in leases:
+            self.leases.setdefault((stream_name, lease.shard_id), lease)
+
+    async def update_lease(self, stream_name, lease, owner, finished):
+        key = (stream_name, lease.shard_id)
+        current = self.leases.get(key)
+        if current is None or current.owner != lease.owner or \
+                current.counter != lease.counter:
+            return None
+
+        updated = current._replace(
+            owner=owner,
+            counter=current.counter + 1,
+            finished=finished
+        )
+        self.leases[key] = updated
+        return updated
+
+
+class SQLiteLeaseStore(SQLiteDatabase, LeaseStore):
+    """
+    Keeps leases in a local SQLite database file, which can be shared by
+    workers on the same host
+    """
+
+    def __init__(self, loop, path, table='leases'):
+        super().__init__(loop, path)
+        self._table = table
+
+    def _create_tables(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            'stream_name TEXT NOT NULL, '
+            'shard_id TEXT NOT NULL, '
+            'owner TEXT, '
+            'counter INTEGER NOT NULL, '
+            'finished INTEGER NOT NULL, '
+            'parent_shard_ids TEXT NOT NULL, '
+            'PRIMARY KEY (stream_name, shard_id))'.format(self._table)
+        )
+
+    def _list_leases(self, stream_name):
+        rows = self._connection.execute(
+            'SELECT shard_id, owner, counter, finished, parent_shard_ids '
+            'FROM {} WHERE stream_name = ?'.format(self._table),
+            (stream_name,)
+        ).fetchall()
+        return [
+            Lease(
+                shard_id,
+                owner,
+                counter,
+                bool(finished),
+                tuple(filter(None, parents.split(',')))
+            )
+            for shard_id, owner, counter, finished, parents in rows
+        ]
+
+    async def list_leases(self, stream_name):
+        return await self._run(self._list_leases, stream_name)
+
+    def _create_leases(self, stream_name, leases):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO {} VALUES (?, ?, ?, ?, ?, ?)'
+                .format(self._table),
+                [
+                    (
+                        stream_name,
+                        lease.shard_id,
+                        lease.owner,
+                        lease.counter,
+                        int(lease.finished),
+                        ','.join(lease.parent_shard_ids)
+                    )
+                    for lease in leases
+                ]
+            )
+
+    async def create_leases(self, stream_name, leases):
+        await self._run(self._create_leases, stream_name, leases)
+
+    def _update_lease(self, stream_name, lease, owner, finished):
+        with self._connection:
+            cursor = self._connection.execute(
+                'UPDATE {} SET owner = ?, counter = counter + 1, '
+                'finished = ? WHERE stream_name = ? AND shard_id = ? '
+                'AND owner IS ? AND counter = ?'.format(self._table),
+                (
+                    owner,
+                    int(finished),
+                    stream_name,
+                    lease.shard_id,
+                    lease.owner,
+                    lease.counter
+                )
+            )
+        if cursor.rowcount != 1:
+            return None
+        return lease._replace(
+            owner=owner,
+            counter=lease.counter + 1,
+            finished=finished
+        )
+
+    async def update_lease(self, stream_name, lease, owner, finished):
+        return await self._run(
+            self._update_lease,
+            stream_name,
+            lease,
+            owner,
+            finished
+        )
+
+
+class LeaseCoordinator:
+    """
+    Claims, renews and steals leases of a stream's shards for one worker.
+    `heartbeat` should be called every few seconds, well within
+    `lease_duration`.
+    """
+
+    def __init__(self, loop, lease_store, stream_name, worker_id=None,
+                 lease_duration=10.0, max_leases_to_steal=1):
+        if worker_id is None:
+            worker_id = '{}-{}'.format(socket.gethostname(), uuid4().hex)
+
+        self._loop = loop
+        self._lease_store = lease_store
+        self._stream_name = stream_name
+        self.worker_id = worker_id
+        self._lease_duration = lease_duration
+        self._max_leases_to_steal = max_leases_to_steal
+
+        # Leases held by this worker by shard id
+        self.held = {}
+        self.finished_shard_ids = set()
+
+        # The counter of every lease and when it last changed
+        self._observed = {}
+
+    async def start(self):
+        await self._lease_store.start()
+
+    async def add_shards(self, shards):
+        await self._lease_store.create_leases(self._stream_name, [
+            Lease(
+                shard['ShardId'],
+                parent_shard_ids=tuple(parent_shard_ids(shard))
+            )
+            for shard in shards
+        ])
+
+    def _expired(self, lease, now):
+        if lease.owner is None:
+            return True
+
+        # Workers' clocks can differ, so expiry is judged by how long the
+        # counter has stayed the same here
+        observed = self._observed.get(lease.shard_id)
+        if observed is None or observed[0] != lease.counter:
+            self._observed[lease.shard_id] = (lease.counter, now)
+            return False
+        return now - observed[1] > self._lease_duration
+
+    async def _update(self, lease, owner, finished=False):
+        return await self._lease_store.update_lease(
+            self._stream_name,
+            lease,
+            owner,
+            finished
+        )
+
+    async def _renew(self):
+        for shard_id, lease in list(self.held.items()):
+            renewed = await self._update(lease, self.worker_id)
+            if renewed is None:
+                # Someone else took the lease
+                del self.held[shard_id]
+            else:
+                self.held[shard_id] = renewed
+
+    async def _take(self, lease):
+        taken = await self._update(lease, self.worker_id)
+        if taken is not None:
+            self.held[lease.shard_id] = taken
+
+    async def _rebalance(self):
+        leases = await self._lease_store.list_leases(self._stream_name)
+        self.finished_shard_ids = {
+            lease.shard_id for lease in leases if lease.finished
+        }
+
+        # Children can only be taken once their parents are finished
+        known_shard_ids = {lease.shard_id for lease in leases}
+        leases = [
+            lease for lease in leases
+            if not lease.finished and all(
+                parent_shard_id in self.finished_shard_ids or
+                parent_shard_id not in known_shard_ids
+                for parent_shard_id in lease.parent_shard_ids
+            )
+        ]
+
+        now = self._loop.time()
+        available = []
+        leases_by_owner = {}
+        for lease in leases:
+            if lease.shard_id in self.held:
+                continue
+            # Leases left behind by an earlier run of this worker are free
+            if lease.owner == self.worker_id or self._expired(lease, now):
+                available.append(lease)
+            else:
+                leases_by_owner.setdefault(lease.owner, []).append(lease)
+
+        # Every live worker should hold about the same number of leases
+        target = math.ceil(len(leases) / (len(leases_by_owner) + 1))
+        random.shuffle(available)
+        for lease in available[:max(target - len(self.held), 0)]:
+            await self._take(lease)
+
+        if len(self.held) >= target or not leases_by_owner:
+            return
+        owner_leases = max(leases_by_owner.values(), key=len)
+        if len(owner_leases) <= target:
+            return
+        steal = min(
+            target - len(self.held),
+            len(owner_leases) - target,
+            self._max_leases_to_steal
+        )
+        for lease in random.sample(owner_leases, steal):
+            await self._take(lease)
+
+    async def heartbeat(self):
+        """
+        Renew held leases, take over expired ones and steal to balance.
+        Returns the shard ids of the leases held by this worker.
+        """
+        await self._renew()
+        await self._rebalance()
+        return set(self.held)
+
+    async def finish(self, shard_id):
+        """
+        Mark a shard as read to its end, so its children can be taken
+        """
+        lease = self.held.pop(shard_id, None)
+        if lease is not None:
+            await self._update(lease, None, finished=True)
+            self.finished_shard_ids.add(shard_id)
+
+    async def release(self):
+        """
+        Give up every held lease so other workers can take them at once
+        """
+        for lease in list(self.held.values()):
+            await self._update(lease, None)
+        self.held = {}
+
+    async def close(self):
+        await self._lease_store.close()
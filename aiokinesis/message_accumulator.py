@@ -1,51 +1,229 @@
 import asyncio
 from collections import deque
 
-from .utils import rate_limit_per_rolling_second
+from .errors import BufferFullError
+
+
+# Kinesis PutRecords limits
+MAX_RECORD_SIZE = 1024 * 1024
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_SIZE = 5 * 1024 * 1024
+
+
+def _data_size(data):
+    if type(data) is bytes:
+        return len(data)
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    return len(data)
+
+
+def message_size(partition_key, value):
+    # Kinesis counts the partition key towards the record size
+    return _data_size(str(partition_key)) + _data_size(value)
 
 
 class Message:
-    def __init__(self, partition_key, value):
+    __slots__ = ('partition_key', 'value', 'future', 'size')
+
+    def __init__(self, partition_key, value, future, size=None):
         self.partition_key = partition_key
         self.value = value
 
+        # Resolved once kinesis has accepted or rejected the message
+        self.future = future
+
+        if size is None:
+            size = message_size(partition_key, value)
+        self.size = size
+
 
 class MessageAccumulator:
-    def __init__(self, loop):
+    """
+    Buffers messages until the producer's sender drains them.
+
+    Adding a message costs no more than creating the message and its
+    future. The sender is only woken up through a single waiter future when
+    there is something for it to do: when the first message arrives, or
+    once a batch is full while it lingers. Senders blocked on a full buffer
+    share one waiter future too, which is only created while someone waits.
+
+    Batches hold at most `max_batch_records` messages and MAX_BATCH_SIZE
+    bytes. Without `max_batch_records` only their size is limited, e.g. for
+    messages that are aggregated into fewer kinesis records.
+    """
+
+    def __init__(self, loop, linger_time=0, max_buffered_records=None,
+                 max_buffered_bytes=None, max_batch_records=MAX_BATCH_RECORDS,
+                 metrics=None, tags=None):
         self._loop = loop
+        self._metrics = metrics
+        self._tags = tags
+        self._linger_time = linger_time
+        self._max_batch_records = max_batch_records
+        self._max_buffered_records = max_buffered_records
+        self._max_buffered_bytes = max_buffered_bytes
 
-        self._message_future = loop.create_future()
+        # Oldest messages on the left
         self._accumulated_messages = deque()
+        self._accumulated_size = 0
 
-    async def _await_message_future(self):
-        if not self._message_future.done():
-            futures = [self._message_future]
-            finished_tasks, _ = await asyncio.wait(
-                futures,
-                loop=self._loop,
-                return_when=asyncio.FIRST_COMPLETED
-            )
+        # Set while the sender waits for messages, or lingers waiting for
+        # a full batch
+        self._waiter = None
+        self._lingering = False
+
+        # Set while someone waits for space in the buffer
+        self._space_waiter = None
 
-            for task in finished_tasks:
-                task.result()
+    def _wake(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
 
-    async def __aiter__(self):
+    async def _wait(self, timeout=None):
+        self._waiter = self._loop.create_future()
+        handle = None
+        if timeout is not None:
+            handle = self._loop.call_later(timeout, self._wake)
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+            if handle is not None:
+                handle.cancel()
+
+    def _report_depth(self):
+        self._metrics.gauge(
+            'accumulator.buffered_records',
+            len(self._accumulated_messages),
+            self._tags
+        )
+        self._metrics.gauge(
+            'accumulator.buffered_bytes',
+            self._accumulated_size,
+            self._tags
+        )
+
+    def _batch_full(self):
+        max_batch_records = self._max_batch_records
+        return max_batch_records is not None and \
+            len(self._accumulated_messages) >= max_batch_records or \
+            self._accumulated_size >= MAX_BATCH_SIZE
+
+    def drain(self, max_records=None, max_bytes=None):
+        """
+        Take the oldest buffered messages, at most `max_records` of them
+        adding up to at most `max_bytes`, or every message without limits
+        """
+        messages = self._accumulated_messages
+        if (max_records is None or len(messages) <= max_records) and \
+                (max_bytes is None or self._accumulated_size <= max_bytes):
+            # Everything fits, so take it in one step
+            batch = list(messages)
+            messages.clear()
+            self._accumulated_size = 0
+        else:
+            batch = []
+            batch_size = 0
+            while messages and \
+                    (max_records is None or len(batch) < max_records):
+                message = messages[0]
+                if max_bytes is not None and \
+                        batch_size + message.size > max_bytes:
+                    break
+                messages.popleft()
+                batch.append(message)
+                batch_size += message.size
+            self._accumulated_size -= batch_size
+
+        if self._metrics is not None:
+            self._report_depth()
+
+        # Wake up anyone waiting for space
+        space_waiter = self._space_waiter
+        if batch and space_waiter is not None:
+            self._space_waiter = None
+            if not space_waiter.done():
+                space_waiter.set_result(None)
+
+        return batch
+
+    def _has_space(self, size):
+        # A message always fits into an empty buffer
+        if not self._accumulated_messages:
+            return True
+        if self._max_buffered_records is not None and \
+                len(self._accumulated_messages) >= self._max_buffered_records:
+            return False
+        if self._max_buffered_bytes is not None and \
+                self._accumulated_size + size > self._max_buffered_bytes:
+            return False
+        return True
+
+    async def wait_for_space(self):
+        """
+        Wait until messages are drained from the buffer
+        """
+        if self._space_waiter is None:
+            self._space_waiter = self._loop.create_future()
+        await asyncio.shield(self._space_waiter)
+
+    def __aiter__(self):
         return self
 
-    @rate_limit_per_rolling_second(5)
     async def __anext__(self):
-        # Await message future
-        if len(self._accumulated_messages) == 0:
-            await self._await_message_future()
+        while True:
+            # Await first message
+            while not self._accumulated_messages:
+                await self._wait()
 
-        # Yield next record
-        message = self._accumulated_messages.pop()
-        return message
+            # Linger so that more messages can join the batch
+            if self._linger_time > 0 and not self._batch_full():
+                self._lingering = True
+                try:
+                    await self._wait(self._linger_time)
+                finally:
+                    self._lingering = False
+
+            # Yield next batch of records, unless someone else drained them
+            # in the meantime
+            batch = self.drain(self._max_batch_records, MAX_BATCH_SIZE)
+            if batch:
+                return batch
 
     def add_message(self, partition_key, value):
-        new_message = Message(partition_key, value)
-        self._accumulated_messages.appendleft(new_message)
+        size = message_size(partition_key, value)
+        if size > MAX_RECORD_SIZE:
+            raise ValueError(
+                'Record of {} bytes exceeds the kinesis limit of {} bytes'
+                .format(size, MAX_RECORD_SIZE)
+            )
+        if not self._has_space(size):
+            raise BufferFullError(
+                'Buffer is full with {} records and {} bytes'
+                .format(
+                    len(self._accumulated_messages),
+                    self._accumulated_size
+                )
+            )
+
+        # Only messages that are kept get a future
+        new_message = Message(
+            partition_key,
+            value,
+            self._loop.create_future(),
+            size
+        )
+        self._accumulated_messages.append(new_message)
+        self._accumulated_size += size
+        if self._metrics is not None:
+            self._report_depth()
+
+        # The sender only needs to be woken up for the first message, or
+        # for a full batch once it lingers
+        if self._waiter is not None and \
+                (not self._lingering or self._batch_full()):
+            self._wake()
 
-        if not self._message_future.done():
-            self._message_future.set_result(None)
-        self._message_future = self._loop.create_future()
+        return new_message.future
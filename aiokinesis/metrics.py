@@ -0,0 +1,129 @@
+"""
+Metrics hooks. Clients report to a MetricsSink passed as `metrics`, and
+skip all instrumentation when there is none.
+
+Metric names are dotted, e.g. `producer.records_sent`, and tags carry the
+stream and shard the metric is about.
+"""
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+
+# Buckets for record counts and byte sizes
+SIZE_BUCKETS = tuple(4 ** i for i in range(12))
+
+
+class MetricsSink:
+    """
+    Receives metrics. Every method does nothing, so sinks only need to
+    override what they report.
+    """
+
+    def increment(self, name, value=1, tags=None):
+        """
+        Add to a counter
+        """
+
+    def gauge(self, name, value, tags=None):
+        """
+        Set the current value of a gauge
+        """
+
+    def observe(self, name, value, tags=None):
+        """
+        Record a size, such as the number of records in a batch
+        """
+
+    def timing(self, name, seconds, tags=None):
+        """
+        Record a duration, such as the latency of a request
+        """
+
+
+class StatsdMetricsSink(MetricsSink):
+    """
+    Reports to a statsd client with `incr`, `gauge` and `timing` methods,
+    such as `statsd.StatsClient`. Tag values are appended to the metric
+    name, since plain statsd has no tags.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def _name(self, name, tags):
+        if not tags:
+            return name
+        return '.'.join(
+            [name] + [str(tags[key]) for key in sorted(tags)]
+        )
+
+    def increment(self, name, value=1, tags=None):
+        self._client.incr(self._name(name, tags), value)
+
+    def gauge(self, name, value, tags=None):
+        self._client.gauge(self._name(name, tags), value)
+
+    def observe(self, name, value, tags=None):
+        self._client.timing(self._name(name, tags), value)
+
+    def timing(self, name, seconds, tags=None):
+        self._client.timing(self._name(name, tags), seconds * 1000)
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """
+    Reports to prometheus_client metrics, which are created on first use.
+    Dots in metric names become underscores and tags become labels.
+    """
+
+    def __init__(self, namespace='aiokinesis', registry=None):
+        if prometheus_client is None:
+            raise RuntimeError(
+                'prometheus_client must be installed to use '
+                'PrometheusMetricsSink'
+            )
+
+        self._namespace = namespace
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        self._registry = registry
+        self._metrics = {}
+
+    def _metric(self, metric_class, name, tags, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = metric_class(
+                name.replace('.', '_'),
+                name,
+                labelnames=sorted(tags or ()),
+                namespace=self._namespace,
+                registry=self._registry,
+                **kwargs
+            )
+            self._metrics[name] = metric
+        if tags:
+            return metric.labels(**tags)
+        return metric
+
+    def increment(self, name, value=1, tags=None):
+        self._metric(prometheus_client.Counter, name, tags).inc(value)
+
+    def gauge(self, name, value, tags=None):
+        self._metric(prometheus_client.Gauge, name, tags).set(value)
+
+    def observe(self, name, value, tags=None):
+        self._metric(
+            prometheus_client.Histogram,
+            name,
+            tags,
+            buckets=SIZE_BUCKETS
+        ).observe(value)
+
+    def timing(self, name, seconds, tags=None):
+        self._metric(
+            prometheus_client.Histogram,
+            name + '_seconds',
+            tags
+        ).observe(seconds)
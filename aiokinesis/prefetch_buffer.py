@@ -0,0 +1,149 @@
+import asyncio
+from collections import deque
+
+
+def records_size(records):
+    # Like the read throughput of a shard, only data is counted
+    return sum(len(record['Data']) for record in records)
+
+
+class PrefetchBuffer:
+    """
+    Holds the lists of records fetched by the consumer's shard routines
+    until they are handed out.
+
+    The buffer is bounded by `max_batches` lists, `max_records` records and
+    `max_bytes` bytes. Shard routines wait for space before fetching the
+    next list of records, so at most one response per shard goes over the
+    bounds, and shards aren't polled while nobody takes their records.
+    Errors ending a shard routine are always taken in.
+    """
+
+    def __init__(self, loop, max_batches=None, max_records=None,
+                 max_bytes=None, metrics=None, tags=None):
+        self._loop = loop
+        self._metrics = metrics
+        self._tags = tags
+        self._max_batches = max_batches
+        self._max_records = max_records
+        self._max_bytes = max_bytes
+
+        # Oldest lists of records on the left, with their shard and size
+        self._batches = deque()
+        self._buffered_batches = 0
+        self._buffered_records = 0
+        self._buffered_size = 0
+
+        # Set while someone waits for records or for space
+        self._waiter = None
+        self._space_waiter = None
+
+    def __len__(self):
+        return self._buffered_records
+
+    @property
+    def size(self):
+        return self._buffered_size
+
+    def _report_depth(self):
+        self._metrics.gauge(
+            'consumer.prefetched_records',
+            self._buffered_records,
+            self._tags
+        )
+        self._metrics.gauge(
+            'consumer.prefetched_bytes',
+            self._buffered_size,
+            self._tags
+        )
+
+    def _has_space(self):
+        if self._max_batches is not None and \
+                self._buffered_batches >= self._max_batches:
+            return False
+        if self._max_records is not None and \
+                self._buffered_records >= self._max_records:
+            return False
+        if self._max_bytes is not None and \
+                self._buffered_size >= self._max_bytes:
+            return False
+        return True
+
+    def _wake_space_waiter(self):
+        space_waiter = self._space_waiter
+        if space_waiter is not None and self._has_space():
+            self._space_waiter = None
+            if not space_waiter.done():
+                space_waiter.set_result(None)
+
+    def _take(self, batch):
+        _, records, size = batch
+        if not isinstance(records, Exception):
+            self._buffered_batches -= 1
+            self._buffered_records -= len(records)
+            self._buffered_size -= size
+
+    async def wait_for_space(self):
+        """
+        Wait until the buffer is below its bounds
+        """
+        while not self._has_space():
+            if self._space_waiter is None:
+                self._space_waiter = self._loop.create_future()
+            await asyncio.shield(self._space_waiter)
+
+    def put(self, records, shard_id=None, size=None):
+        """
+        Add a list of records of a shard, or an exception ending the consumer
+        """
+        if isinstance(records, Exception):
+            self._batches.append((None, records, 0))
+        else:
+            if size is None:
+                size = records_size(records)
+            self._batches.append((shard_id, records, size))
+            self._buffered_batches += 1
+            self._buffered_records += len(records)
+            self._buffered_size += size
+        if self._metrics is not None:
+            self._report_depth()
+
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def remove(self, shard_id):
+        """
+        Drop every list of records of a shard that wasn't taken yet
+        """
+        batches = self._batches
+        self._batches = deque()
+        for batch in batches:
+            if batch[0] == shard_id:
+                self._take(batch)
+            else:
+                self._batches.append(batch)
+        if self._metrics is not None:
+            self._report_depth()
+        self._wake_space_waiter()
+
+    async def get(self):
+        """
+        Take the oldest list of records, waiting for one if there is none
+        """
+        while not self._batches:
+            if self._waiter is None:
+                self._waiter = self._loop.create_future()
+            await asyncio.shield(self._waiter)
+
+        batch = self._batches.popleft()
+        self._take(batch)
+        if self._metrics is not None:
+            self._report_depth()
+
+        # Wake up the shard routines waiting for space
+        self._wake_space_waiter()
+
+        return batch[1]
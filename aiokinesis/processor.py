@@ -0,0 +1,185 @@
+import asyncio
+from asyncio import ensure_future
+from collections import deque
+
+
+class _PendingRecord:
+    __slots__ = ('record', 'done')
+
+    def __init__(self, record):
+        self.record = record
+        self.done = False
+
+
+class RecordProcessor:
+    """
+    Runs `handler` for every record of a started consumer with bounded
+    concurrency.
+
+    Records with the same partition key are handled one after another, in
+    the order they were consumed. Records of different keys are handled
+    concurrently, at most `concurrency` at a time. `handler` is a coroutine
+    function, or a plain function run on `executor` when one is given, so a
+    ProcessPoolExecutor can spread CPU heavy handlers over every core.
+
+    If the consumer has a checkpointer, a shard's checkpoint only moves past
+    a record once it and every record of the shard before it were handled.
+    The consumer must be created with `auto_checkpoint=False`.
+
+    At most `max_pending_records` records are taken from the consumer
+    before they were handled, so slow handlers hold back consumption.
+    """
+
+    def __init__(self, consumer, handler, loop, concurrency=16,
+                 executor=None, max_pending_records=1000):
+        if consumer._checkpoint_buffer is not None and \
+                consumer._auto_checkpoint:
+            raise ValueError(
+                'Consumer must be created with auto_checkpoint=False'
+            )
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+
+        self._consumer = consumer
+        self._handler = handler
+        self._loop = loop
+        self._concurrency = concurrency
+        self._executor = executor
+        self._checkpoints = consumer._checkpoint_buffer is not None
+
+        # Records waiting behind the one being handled, by partition key.
+        # A key is in the ready queue while it has a record and no worker.
+        self._keys = {}
+        self._ready = asyncio.Queue()
+
+        # Records taken from the consumer in order, by shard id
+        self._shard_records = {}
+        self._pending_records = asyncio.Semaphore(max_pending_records)
+        self._pending_count = 0
+
+        # Set while run waits for the pending records to be handled
+        self._drained = None
+        self._fetch_task = None
+        self._error = None
+
+    def _add(self, record):
+        pending = _PendingRecord(record)
+        self._pending_count += 1
+        if self._checkpoints:
+            self._shard_records.setdefault(
+                record.shard_id,
+                deque()
+            ).append(pending)
+
+        key = record.partition_key
+        queued = self._keys.get(key)
+        if queued is None:
+            self._keys[key] = deque([pending])
+            self._ready.put_nowait(key)
+        else:
+            queued.append(pending)
+
+    async def _fetch(self):
+        async for records in self._consumer.batches():
+            for record in records:
+                await self._pending_records.acquire()
+                self._add(record)
+
+    async def _handle(self, record):
+        if self._executor is not None:
+            await self._loop.run_in_executor(
+                self._executor,
+                self._handler,
+                record
+            )
+        else:
+            await self._handler(record)
+
+    async def _checkpoint(self, shard_id):
+        # Move past every record of the shard handled without a gap
+        shard_records = self._shard_records[shard_id]
+        last = None
+        while shard_records and shard_records[0].done:
+            last = shard_records.popleft().record
+        if last is not None:
+            await self._consumer.checkpoint(last)
+
+    def _wake_drained(self):
+        drained = self._drained
+        if drained is not None and not drained.done():
+            drained.set_result(None)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            if key is None or self._error is not None:
+                return
+
+            queued = self._keys[key]
+            pending = queued.popleft()
+            try:
+                await self._handle(pending.record)
+            except Exception as e:
+                # Nothing after the failed record is checkpointed
+                self._error = e
+                self.stop()
+                self._wake_drained()
+                return
+
+            # Hand the key's next record to any worker
+            if queued:
+                self._ready.put_nowait(key)
+            else:
+                del self._keys[key]
+
+            pending.done = True
+            if self._checkpoints:
+                await self._checkpoint(pending.record.shard_id)
+
+            self._pending_records.release()
+            self._pending_count -= 1
+            if not self._pending_count:
+                self._wake_drained()
+
+    async def run(self):
+        """
+        Handle records until the consumer can't read any further or `stop`
+        is called, then wait for the records taken so far. If the handler
+        raises, no more records are handled and the exception is raised
+        once the records in progress are done.
+        """
+        workers = [
+            ensure_future(self._worker(), loop=self._loop)
+            for _ in range(self._concurrency)
+        ]
+        self._fetch_task = ensure_future(self._fetch(), loop=self._loop)
+        try:
+            await asyncio.wait([self._fetch_task])
+            if self._pending_count and self._error is None:
+                self._drained = self._loop.create_future()
+                await self._drained
+        except asyncio.CancelledError:
+            self._fetch_task.cancel()
+            for worker in workers:
+                worker.cancel()
+            raise
+        finally:
+            self._drained = None
+
+        for _ in workers:
+            self._ready.put_nowait(None)
+        await asyncio.wait(workers)
+
+        if self._error is not None:
+            raise self._error
+        if not self._fetch_task.cancelled() and \
+                self._fetch_task.exception() is not None:
+            raise self._fetch_task.exception()
+
+    def stop(self):
+        """
+        Stop taking records from the consumer. `run` returns once the
+        records already taken are handled.
+        """
+        if self._fetch_task is not None:
+            self._fetch_task.cancel()
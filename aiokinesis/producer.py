@@ -1,68 +1,514 @@
 import asyncio
 from asyncio import ensure_future
+from collections import namedtuple
 import json
 
-import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 
-from .message_accumulator import MessageAccumulator
+from .aggregation import RecordAggregator
+from .errors import BufferFullError, DeliveryTimeoutError, RecordError
+from .message_accumulator import (
+    MAX_BATCH_RECORDS, MAX_BATCH_SIZE, MessageAccumulator
+)
+from .rate_limiter import (
+    WRITE_BYTES_PER_SECOND, WRITE_RECORDS_PER_SECOND, shard_rate_limiter
+)
+from .retry import RetryPolicy, is_retryable
+from .serialization import get_compression
+from .shards import ShardMap, shard_cache
+from .transport import acquire_shared_transport, release_shared_transport
+
+
+# Where kinesis stored a record. Records that were aggregated also have
+# their position within the aggregated record.
+RecordMetadata = namedtuple(
+    'RecordMetadata',
+    ['shard_id', 'sequence_number', 'sub_sequence_number']
+)
+RecordMetadata.__new__.__defaults__ = (None,)
+
+# A shard takes 1 MiB a second, so larger batches are always throttled
+MAX_SHARD_BATCH_RECORDS = min(MAX_BATCH_RECORDS, WRITE_RECORDS_PER_SECOND)
+MAX_SHARD_BATCH_SIZE = min(MAX_BATCH_SIZE, WRITE_BYTES_PER_SECOND)
+
+
+class _KinesisRecord:
+    """
+    A put_records entry together with the messages it carries
+    """
+    __slots__ = ('entry', 'messages', 'size', 'aggregated')
+
+    def __init__(self, entry, messages, size, aggregated):
+        self.entry = entry
+        self.messages = messages
+        self.size = size
+        self.aggregated = aggregated
+
+    @classmethod
+    def from_message(cls, message):
+        entry = {
+            'Data': message.value,
+            'PartitionKey': message.partition_key
+        }
+        return cls(entry, [message], message.size, False)
+
+    @classmethod
+    def from_aggregator(cls, aggregator, messages):
+        entry = {
+            'Data': aggregator.serialize(),
+            'PartitionKey': aggregator.partition_key
+        }
+        return cls(entry, messages, aggregator.size, True)
 
 
 class AIOKinesisProducer:
     """
     Async client to produce to a kinesis topic
+
+    Records are routed to shards by the MD5 hash of their partition key.
+    Every shard is sent its own batches of at most 1 MiB, limited by the
+    shard's write budget of 1000 records and 1 MiB per rolling second.
+
+    Throttled and transiently failing records are retried with jittered
+    exponential backoff. Records which still fail once `retry_policy` runs
+    out of retries, or fail with an error that isn't retryable, are passed
+    to `on_dropped(message, error)` and fail the future returned by `send`.
+
+    Messages waiting to be sent are limited to `max_buffered_records` and
+    `max_buffered_bytes`. Once the buffer is full, `send` either waits for
+    space (`buffer_full_policy='block'`) or raises BufferFullError
+    (`buffer_full_policy='raise'`). At most `max_in_flight_requests`
+    put_records requests are made at once. Batches are only taken from
+    the buffer while fewer requests than that are outstanding.
+
+    `flush` sends every buffered message right away, in batches as large
+    as kinesis allows, and waits until they and the requests in flight
+    are done. `stop` flushes before it stops the producer; messages not
+    delivered within its `timeout` are dropped with DeliveryTimeoutError.
+
+    With `aggregate=True`, messages for the same shard are packed into KPL
+    aggregated records, which cuts the number of kinesis records and PUT
+    payload units for small messages. Consumers built on the KCL or on
+    AIOKinesisConsumer deaggregate them transparently.
+
+    Values are serialized with `value_serializer` (json.dumps by default).
+    Values which are already bytes are sent as they are. With `compression`
+    set to 'gzip' or 'zstd', the data of every message is compressed before
+    it is buffered; consumers need the same `compression` to read it.
+
+    Metrics on records sent, retried and dropped, batch sizes, request
+    latency, time spent waiting for the write budget and buffer depth are
+    reported to `metrics`, a MetricsSink.
     """
 
-    def __init__(self, stream_name, loop, region_name='us-east-1'):
+    def __init__(self, stream_name, loop, region_name='us-east-1',
+                 linger_time=0, transport=None, retry_policy=None,
+                 on_dropped=None, max_buffered_records=None,
+                 max_buffered_bytes=32 * 1024 * 1024,
+                 buffer_full_policy='block', max_in_flight_requests=32,
+                 aggregate=False, value_serializer=json.dumps,
+                 compression=None, metrics=None):
+        if buffer_full_policy not in ('block', 'raise'):
+            raise ValueError(
+                "buffer_full_policy must be 'block' or 'raise'"
+            )
+
         self._stream_name = stream_name
         self._region_name = region_name
         self._loop = loop
 
-        self._message_accumulator = MessageAccumulator(loop)
-        self._outstanding_tasks = set()
+        # Clients that aren't given a transport share one per region
+        self._shares_transport = transport is None
+        if transport is None:
+            transport = acquire_shared_transport(loop, region_name)
+        self._transport = transport
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+        self._on_dropped = on_dropped
+
+        self._buffer_full_policy = buffer_full_policy
+        self._max_in_flight_requests = max_in_flight_requests
+        self._aggregate = aggregate
+        self._value_serializer = value_serializer
+        self._compression = None
+        if compression is not None:
+            self._compression = get_compression(compression)
+
+        self._metrics = metrics
+        self._tags = {'stream': stream_name}
+        self._shard_tags = {}
+
+        self._message_accumulator = MessageAccumulator(
+            loop,
+            linger_time=linger_time,
+            max_buffered_records=max_buffered_records,
+            max_buffered_bytes=max_buffered_bytes,
+            # The record limit applies to records after aggregation
+            max_batch_records=None if aggregate else MAX_BATCH_RECORDS,
+            metrics=metrics,
+            tags=self._tags
+        )
+        # Messages of every outstanding produce request by its task
+        self._outstanding_tasks = {}
+        self._in_flight_requests = None
+
+        self._shard_map = None
+        self._shard_rate_limiters = {}
+        self._refresh_task = None
 
     async def start(self):
-        # Instantiate kinesis client
-        self._kinesis_client = boto3.client(
-            'kinesis',
-            region_name=self._region_name
+        # Start transport
+        await self._transport.start()
+
+        # Cache shard hash key ranges
+        shards = await shard_cache(self._transport).list_shards(
+            self._stream_name
         )
+        self._set_shards(shards)
 
         # Start sender routine
+        self._in_flight_requests = asyncio.Semaphore(
+            self._max_in_flight_requests
+        )
         self._sender_task = ensure_future(
             self._sender_routine(),
             loop=self._loop
         )
 
-    async def _send_produce_request(self, partition_key, message):
-        self._kinesis_client.put_record(
-            StreamName=self._stream_name,
-            Data=message,
-            PartitionKey=partition_key
-        )
+    def _set_shards(self, shards):
+        self._shard_map = ShardMap(shards)
+        self._shard_rate_limiters = {
+            shard_id: shard_rate_limiter(
+                self._stream_name,
+                shard_id,
+                'write'
+            )
+            for shard_id in self._shard_map.shard_ids
+        }
 
-    def _complete_produce_request(self, task):
-        self._outstanding_tasks.remove(task)
+    async def _refresh_shards(self):
+        # Written records show the stream was resharded since it was listed
+        cache = shard_cache(self._transport)
+        cache.invalidate(self._stream_name)
+        try:
+            shards = await cache.list_shards(self._stream_name)
+        except (ClientError, BotoCoreError):
+            # Kinesis still routes records correctly, only the batching and
+            # write budgets are off until the next refresh
+            return
+        finally:
+            self._refresh_task = None
+        self._set_shards(shards)
 
-    async def _sender_routine(self):
-        async for message in self._message_accumulator:
-            _produce_request_future = self._send_produce_request(
-                message.partition_key,
-                message.value
+    def _group_by_shard(self, messages):
+        messages_by_shard = {}
+        for message in messages:
+            shard_id = self._shard_map.shard_for(message.partition_key)
+            messages_by_shard.setdefault(shard_id, []).append(message)
+        return messages_by_shard
+
+    def _build_records(self, messages):
+        """
+        Turn messages into kinesis records
+        """
+        if not self._aggregate:
+            return [_KinesisRecord.from_message(m) for m in messages]
+
+        records = []
+        aggregator = RecordAggregator()
+        aggregated_messages = []
+        for message in messages:
+            if not aggregator.fits(message.partition_key, message.value):
+                if aggregated_messages:
+                    records.append(_KinesisRecord.from_aggregator(
+                        aggregator,
+                        aggregated_messages
+                    ))
+                    aggregator = RecordAggregator()
+                    aggregated_messages = []
+
+                # Messages too large to aggregate are sent on their own
+                if not aggregator.fits(message.partition_key, message.value):
+                    records.append(_KinesisRecord.from_message(message))
+                    continue
+
+            aggregator.add(message.partition_key, message.value)
+            aggregated_messages.append(message)
+
+        if aggregated_messages:
+            records.append(_KinesisRecord.from_aggregator(
+                aggregator,
+                aggregated_messages
+            ))
+        return records
+
+    def _tags_for_shard(self, shard_id):
+        tags = self._shard_tags.get(shard_id)
+        if tags is None:
+            tags = {'stream': self._stream_name, 'shard': shard_id or ''}
+            self._shard_tags[shard_id] = tags
+        return tags
+
+    async def _put_records(self, shard_id, records):
+        """
+        Send records once and return the ones that failed with their errors
+        """
+        metrics = self._metrics
+        if metrics is not None:
+            tags = self._tags_for_shard(shard_id)
+            size = sum(record.size for record in records)
+            metrics.observe('producer.batch_records', len(records), tags)
+            metrics.observe('producer.batch_bytes', size, tags)
+
+        # Wait for the shard's write budget
+        rate_limiter = self._shard_rate_limiters.get(shard_id)
+        if rate_limiter is not None:
+            waited = await rate_limiter.acquire(
+                count=len(records),
+                size=sum(record.size for record in records)
             )
-            task = ensure_future(
-                _produce_request_future,
+            if metrics is not None and waited > 0:
+                metrics.timing('producer.throttle_wait', waited, tags)
+
+        started = self._loop.time()
+        try:
+            response = await self._transport.request(
+                'put_records',
+                StreamName=self._stream_name,
+                Records=[record.entry for record in records]
+            )
+        except (ClientError, BotoCoreError) as e:
+            if metrics is not None:
+                metrics.increment('producer.request_errors', 1, tags)
+            return [(record, e) for record in records]
+        if metrics is not None:
+            metrics.timing(
+                'producer.put_records_latency',
+                self._loop.time() - started,
+                tags
+            )
+
+        # Resolve futures of written records for the whole batch at once
+        failed = []
+        resharded = False
+        for record, result in zip(records, response['Records']):
+            if 'ErrorCode' in result:
+                failed.append((record, RecordError(
+                    result['ErrorCode'],
+                    result.get('ErrorMessage')
+                )))
+                continue
+            if result['ShardId'] != shard_id:
+                resharded = True
+
+            for i, message in enumerate(record.messages):
+                if not message.future.done():
+                    message.future.set_result(RecordMetadata(
+                        result['ShardId'],
+                        result['SequenceNumber'],
+                        i if record.aggregated else None
+                    ))
+
+        if resharded and self._refresh_task is None:
+            self._refresh_task = ensure_future(
+                self._refresh_shards(),
                 loop=self._loop
             )
-            task.add_done_callback(self._complete_produce_request)
-            self._outstanding_tasks.add(task)
+
+        if metrics is not None:
+            sent = sum(len(record.messages) for record in records) - \
+                sum(len(record.messages) for record, _ in failed)
+            metrics.increment('producer.records_sent', sent, tags)
+            if failed:
+                metrics.increment(
+                    'producer.records_failed',
+                    sum(len(record.messages) for record, _ in failed),
+                    tags
+                )
+        return failed
+
+    def _drop(self, message, error):
+        if not message.future.done():
+            message.future.set_exception(error)
+        if self._metrics is not None:
+            self._metrics.increment('producer.records_dropped', 1, self._tags)
+        if self._on_dropped is not None:
+            self._on_dropped(message, error)
+
+    async def _send_produce_request(self, shard_id, records):
+        async with self._in_flight_requests:
+            await self._send_records(shard_id, records)
+
+    async def _send_records(self, shard_id, records):
+        attempt = 0
+        while records:
+            failed = await self._put_records(shard_id, records)
+
+            # Only retry records that failed with a retryable error
+            records = []
+            for record, error in failed:
+                if is_retryable(error) and \
+                        attempt < self._retry_policy.max_retries:
+                    records.append(record)
+                else:
+                    for message in record.messages:
+                        self._drop(message, error)
+
+            if records:
+                if self._metrics is not None:
+                    self._metrics.increment(
+                        'producer.records_retried',
+                        sum(len(record.messages) for record in records),
+                        self._tags_for_shard(shard_id)
+                    )
+                await asyncio.sleep(self._retry_policy.backoff(attempt))
+                attempt += 1
+
+    def _complete_produce_request(self, task):
+        del self._outstanding_tasks[task]
+
+    def _batches(self, records):
+        """
+        Split kinesis records for one shard into batches within the
+        put_records limits and the shard's write budget
+        """
+        batch = []
+        batch_size = 0
+        for record in records:
+            if len(batch) == MAX_SHARD_BATCH_RECORDS or \
+                    batch_size + record.size > MAX_SHARD_BATCH_SIZE:
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(record)
+            batch_size += record.size
+        if batch:
+            yield batch
+
+    def _dispatch(self, messages):
+        """
+        Start a produce request for every shard's batches. Requests wait
+        for their turn to be in flight, so messages are never held
+        anywhere but in the buffer or an outstanding request.
+        """
+        messages_by_shard = self._group_by_shard(messages)
+        for shard_id, shard_messages in messages_by_shard.items():
+            records = self._build_records(shard_messages)
+            for batch in self._batches(records):
+                task = ensure_future(
+                    self._send_produce_request(shard_id, batch),
+                    loop=self._loop
+                )
+                task.add_done_callback(self._complete_produce_request)
+                self._outstanding_tasks[task] = [
+                    message for record in batch
+                    for message in record.messages
+                ]
+
+    async def _sender_routine(self):
+        async for messages in self._message_accumulator:
+            self._dispatch(messages)
+
+            # Leave messages in the buffer, where they apply backpressure,
+            # while enough requests are outstanding
+            while len(self._outstanding_tasks) >= \
+                    self._max_in_flight_requests:
+                await asyncio.wait(
+                    list(self._outstanding_tasks),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
 
     async def send(self, partition_key, value):
-        self._message_accumulator.add_message(
-            partition_key,
-            json.dumps(value)
-        )
+        """
+        Queue a message to be sent. Returns a future which resolves to the
+        RecordMetadata of the written record, or fails with the error the
+        record was dropped for.
+        """
+        # Pre-serialized values skip the serializer
+        if isinstance(value, (bytes, bytearray)):
+            data = value
+        else:
+            data = self._value_serializer(value)
+        if self._compression is not None:
+            data = self._compression.compress(data)
+
+        while True:
+            try:
+                return self._message_accumulator.add_message(
+                    partition_key,
+                    data
+                )
+            except BufferFullError:
+                if self._buffer_full_policy == 'raise':
+                    raise
+
+            # Backpressure until the sender routine makes room
+            await self._message_accumulator.wait_for_space()
 
-    async def stop(self):
+    async def send_and_wait(self, partition_key, value):
+        """
+        Send a message and wait until kinesis has written it
+        """
+        future = await self.send(partition_key, value)
+        return await future
+
+    async def flush(self, timeout=None):
+        """
+        Send every buffered message right away and wait until kinesis has
+        accepted or rejected them and every message already in flight, for
+        at most `timeout` seconds. Returns the messages that are still
+        pending after the timeout; they keep being sent.
+        """
+        self._dispatch(self._message_accumulator.drain())
+
+        tasks = list(self._outstanding_tasks)
+        if not tasks:
+            return []
+        messages = [
+            message for task in tasks
+            for message in self._outstanding_tasks[task]
+        ]
+        await asyncio.wait(tasks, timeout=timeout)
+        return [message for message in messages if not message.future.done()]
+
+    async def stop(self, timeout=None):
+        """
+        Flush and stop the producer. Messages that weren't delivered within
+        `timeout` seconds are dropped with DeliveryTimeoutError: passed to
+        `on_dropped` and failing their futures. Returns them.
+        """
         self._sender_task.cancel()
-        if len(self._outstanding_tasks):
-            await asyncio.wait(self._outstanding_tasks, loop=self._loop)
+        await self.flush(timeout)
+
+        # Give up on requests still outstanding after the timeout
+        tasks = list(self._outstanding_tasks)
+        messages = [
+            message for task in tasks
+            for message in self._outstanding_tasks[task]
+        ]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+        # Messages sent while stopping never leave the buffer
+        messages.extend(self._message_accumulator.drain())
+
+        undelivered = [
+            message for message in messages if not message.future.done()
+        ]
+        if undelivered:
+            error = DeliveryTimeoutError(
+                'Producer stopped before {} messages were delivered'
+                .format(len(undelivered))
+            )
+            for message in undelivered:
+                self._drop(message, error)
+
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        if self._shares_transport:
+            await release_shared_transport(self._loop, self._region_name)
+        return undelivered
@@ -0,0 +1,156 @@
+import asyncio
+from collections import deque
+from time import monotonic
+from weakref import WeakKeyDictionary, WeakValueDictionary
+
+
+# Kinesis per shard limits
+READ_REQUESTS_PER_SECOND = 5
+READ_BYTES_PER_SECOND = 2 * 1024 * 1024
+WRITE_RECORDS_PER_SECOND = 1000
+WRITE_BYTES_PER_SECOND = 1024 * 1024
+
+# Kinesis counts usage when requests arrive, a little after they were let
+# through, so usage is kept for a little longer than a second
+WINDOW_MARGIN = 0.1
+
+
+class _RollingWindow:
+    """
+    Tracks how much of a limit was used over the last rolling second,
+    padded by WINDOW_MARGIN.
+    Every entry is appended and evicted once, so upkeep is O(1) amortized.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.total = 0
+        self._entries = deque()
+
+    def evict(self, now):
+        entries = self._entries
+        while entries and now - entries[0][0] >= 1 + WINDOW_MARGIN:
+            self.total -= entries.popleft()[1]
+
+    def delay(self, amount):
+        # Anything fits into an empty window, even if it's over the limit
+        if not self._entries or self.total + amount <= self.limit:
+            return 0
+        return self._entries[0][0] + 1 + WINDOW_MARGIN - monotonic()
+
+    def add(self, now, amount):
+        if amount:
+            self._entries.append((now, amount))
+            self.total += amount
+
+
+class RateLimiter:
+    """
+    Limits the number of requests (or records) and bytes per rolling
+    second. A single limiter can be shared by any number of clients to
+    enforce one budget between them.
+
+    Time spent waiting is reported to `metrics` as `rate_limiter.wait`
+    with `tags`.
+    """
+
+    def __init__(self, requests_per_second=None, bytes_per_second=None,
+                 metrics=None, tags=None):
+        self._metrics = metrics
+        self._tags = tags
+        self._windows = []
+        self._requests = self._bytes = None
+        if requests_per_second is not None:
+            self._requests = _RollingWindow(requests_per_second)
+            self._windows.append(self._requests)
+        if bytes_per_second is not None:
+            self._bytes = _RollingWindow(bytes_per_second)
+            self._windows.append(self._bytes)
+
+        # Locks bind to a loop, so every loop the limiter is used on gets
+        # its own. Created lazily once the loop is running.
+        self._locks = WeakKeyDictionary()
+
+    def _evict(self):
+        now = monotonic()
+        for window in self._windows:
+            window.evict(now)
+        return now
+
+    async def acquire(self, count=1, size=0):
+        """
+        Wait until `count` requests and `size` bytes fit into the limits
+        and record them. Waiters are served in order. Returns how many
+        seconds were spent waiting.
+        """
+        loop = asyncio.get_event_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            lock = self._locks[loop] = asyncio.Lock()
+
+        # Only time spent queued behind other waiters or sleeping counts
+        started = monotonic()
+        waiting = lock.locked()
+        async with lock:
+            now = self._evict()
+            while True:
+                delay = max(
+                    self._requests.delay(count) if self._requests else 0,
+                    self._bytes.delay(size) if self._bytes else 0
+                )
+                if delay <= 0:
+                    break
+                waiting = True
+                await asyncio.sleep(delay)
+                now = self._evict()
+
+            self.charge(count, size, now)
+
+        if not waiting:
+            return 0
+        waited = now - started
+        if self._metrics is not None:
+            self._metrics.timing('rate_limiter.wait', waited, self._tags)
+        return waited
+
+    def charge(self, count=0, size=0, now=None):
+        """
+        Record usage without waiting, e.g. bytes of a response that are
+        only known after the request was made. Later acquires wait until
+        the usage has rolled out of the window.
+        """
+        if now is None:
+            now = self._evict()
+        if self._requests is not None:
+            self._requests.add(now, count)
+        if self._bytes is not None:
+            self._bytes.add(now, size)
+
+
+_shard_rate_limiters = WeakValueDictionary()
+
+
+def shard_rate_limiter(stream_name, shard_id, operation):
+    """
+    Return the process wide rate limiter for reads or writes to a shard.
+    Every client that reads (or writes) the shard shares its budget.
+    Limiters are dropped once no client references them.
+    """
+    key = (stream_name, shard_id, operation)
+    rate_limiter = _shard_rate_limiters.get(key)
+    if rate_limiter is None:
+        if operation == 'read':
+            rate_limiter = RateLimiter(
+                requests_per_second=READ_REQUESTS_PER_SECOND,
+                bytes_per_second=READ_BYTES_PER_SECOND
+            )
+        elif operation == 'write':
+            rate_limiter = RateLimiter(
+                requests_per_second=WRITE_RECORDS_PER_SECOND,
+                bytes_per_second=WRITE_BYTES_PER_SECOND
+            )
+        else:
+            raise ValueError('Unknown operation {}'.format(operation))
+        _shard_rate_limiters[key] = rate_limiter
+
+    return rate_limiter
@@ -0,0 +1,181 @@
+from .aggregation import MAGIC, parse_user_records
+
+
+# Marks a value that wasn't decoded yet
+_UNDECODED = object()
+
+# Attributes of records by the name of the boto3 record field
+_FIELDS = {
+    'ShardId': 'shard_id',
+    'SequenceNumber': 'sequence_number',
+    'SubSequenceNumber': 'sub_sequence_number',
+    'PartitionKey': 'partition_key',
+    'ExplicitHashKey': 'explicit_hash_key',
+    'ApproximateArrivalTimestamp': 'approximate_arrival_timestamp',
+    'Data': 'data',
+    'Value': 'value',
+}
+
+
+def _unpickle_record(shard_id, sequence_number, partition_key, data,
+                     sub_sequence_number, explicit_hash_key,
+                     approximate_arrival_timestamp, value):
+    record = Record(
+        shard_id,
+        sequence_number,
+        partition_key,
+        data,
+        sub_sequence_number=sub_sequence_number,
+        explicit_hash_key=explicit_hash_key,
+        approximate_arrival_timestamp=approximate_arrival_timestamp
+    )
+    record._value = value
+    return record
+
+
+class Record:
+    """
+    A record read from a shard. Records keep only their own fields, not
+    the response they were read from.
+
+    User records of a KPL aggregated record keep their data as a memoryview
+    of the aggregated record, so splitting it copies nothing. `data` copies
+    it into bytes once it's first read, `data_view` never does.
+
+    With a `decode` function (the consumer's decompression and
+    `value_deserializer`), `value` is decoded once, when it's first read.
+    Without one, `value` is the record's data.
+
+    Fields can also be read by their boto3 name, like `record['Data']`, for
+    code written against the records of boto3 responses. Fields a boto3
+    record wouldn't have, such as the `SubSequenceNumber` of records that
+    weren't aggregated, raise KeyError.
+    """
+
+    __slots__ = (
+        'shard_id', 'sequence_number', 'sub_sequence_number',
+        'partition_key', 'explicit_hash_key',
+        'approximate_arrival_timestamp', '_data', '_decode', '_value'
+    )
+
+    def __init__(self, shard_id, sequence_number, partition_key, data,
+                 sub_sequence_number=None, explicit_hash_key=None,
+                 approximate_arrival_timestamp=None, decode=None):
+        self.shard_id = shard_id
+        self.sequence_number = sequence_number
+        self.sub_sequence_number = sub_sequence_number
+        self.partition_key = partition_key
+        self.explicit_hash_key = explicit_hash_key
+        self.approximate_arrival_timestamp = approximate_arrival_timestamp
+        self._data = data
+        self._decode = decode
+        self._value = _UNDECODED
+
+    @property
+    def data(self):
+        data = self._data
+        if type(data) is memoryview:
+            data = self._data = bytes(data)
+        return data
+
+    @property
+    def data_view(self):
+        return memoryview(self._data)
+
+    @property
+    def value(self):
+        value = self._value
+        if value is _UNDECODED:
+            if self._decode is None:
+                return self.data
+            value = self._value = self._decode(self.data)
+        return value
+
+    def __getitem__(self, name):
+        if name == 'Value' and self._decode is None and \
+                self._value is _UNDECODED:
+            raise KeyError(name)
+        value = getattr(self, _FIELDS[name])
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __reduce__(self):
+        # Views and the consumer's decode function can't be pickled, e.g.
+        # to hand records to a ProcessPoolExecutor, so data and value go as
+        # they are read
+        value = self._value
+        if self._decode is not None:
+            value = self.value
+        return (_unpickle_record, (
+            self.shard_id,
+            self.sequence_number,
+            self.partition_key,
+            self.data,
+            self.sub_sequence_number,
+            self.explicit_hash_key,
+            self.approximate_arrival_timestamp,
+            value
+        ))
+
+    def __repr__(self):
+        return '<Record shard_id={!r} sequence_number={!r}{}>'.format(
+            self.shard_id,
+            self.sequence_number,
+            '' if self.sub_sequence_number is None else
+            ' sub_sequence_number={!r}'.format(self.sub_sequence_number)
+        )
+
+
+def records_from_response(records, shard_id, decode=None):
+    """
+    Turn the records of a get_records response or SubscribeToShard event
+    into Records, splitting KPL aggregated records into their user records
+    """
+    result = []
+    append = result.append
+    for record in records:
+        data = record['Data']
+        user_records = None
+        if data.startswith(MAGIC):
+            user_records = parse_user_records(data)
+
+        if user_records is None:
+            append(Record(
+                shard_id,
+                record['SequenceNumber'],
+                record.get('PartitionKey'),
+                data,
+                explicit_hash_key=record.get('ExplicitHashKey'),
+                approximate_arrival_timestamp=record.get(
+                    'ApproximateArrivalTimestamp'
+                ),
+                decode=decode
+            ))
+            continue
+
+        sequence_number = record['SequenceNumber']
+        approximate_arrival_timestamp = \
+            record.get('ApproximateArrivalTimestamp')
+        for sub_sequence_number, user_record in enumerate(user_records):
+            partition_key, explicit_hash_key, user_data = user_record
+            append(Record(
+                shard_id,
+                sequence_number,
+                partition_key,
+                user_data,
+                sub_sequence_number=sub_sequence_number,
+                explicit_hash_key=explicit_hash_key,
+                approximate_arrival_timestamp=approximate_arrival_timestamp,
+                decode=decode
+            ))
+    return result
@@ -0,0 +1,69 @@
+import asyncio
+import random
+
+from botocore.exceptions import (
+    BotoCoreError, ClientError, ConnectionError, HTTPClientError
+)
+
+from .errors import RecordError
+
+
+# Throttling and transient failures which are worth retrying
+RETRYABLE_ERROR_CODES = frozenset([
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'ThrottlingException',
+    'KMSThrottlingException',
+    'InternalFailure',
+    'InternalServerError',
+    'ServiceUnavailable',
+])
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    if isinstance(error, RecordError):
+        return error.error_code
+    return None
+
+
+def is_retryable(error):
+    # Connection errors and timeouts are always worth another try
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    return error_code(error) in RETRYABLE_ERROR_CODES
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, so clients which were throttled
+    together don't retry together
+    """
+
+    def __init__(self, max_retries=5, base_delay=0.1, max_delay=5.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        return random.uniform(
+            0,
+            min(self.max_delay, self.base_delay * 2 ** attempt)
+        )
+
+    async def call(self, coroutine_function):
+        """
+        Await `coroutine_function()` until it succeeds, fails with an
+        error that isn't retryable or runs out of retries
+        """
+        attempt = 0
+        while True:
+            try:
+                return await coroutine_function()
+            except (ClientError, BotoCoreError) as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
@@ -0,0 +1,58 @@
+import gzip
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+def to_bytes(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+class Compression:
+    """
+    Compresses record data. Data which doesn't start with the format's
+    magic bytes is passed through by `decompress`, so streams can switch
+    compression on without breaking consumers of older records.
+    """
+
+    def __init__(self, name, magic, compress, decompress):
+        self.name = name
+        self.magic = magic
+        self._compress = compress
+        self._decompress = decompress
+
+    def compress(self, data):
+        return self._compress(to_bytes(data))
+
+    def decompress(self, data):
+        if not bytes(data[:len(self.magic)]) == self.magic:
+            return data
+        return self._decompress(data)
+
+
+def get_compression(name):
+    if name == 'gzip':
+        return Compression(
+            'gzip',
+            b'\x1f\x8b',
+            gzip.compress,
+            gzip.decompress
+        )
+
+    if name == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(
+                'zstandard must be installed to use zstd compression'
+            )
+        return Compression(
+            'zstd',
+            b'\x28\xb5\x2f\xfd',
+            zstandard.ZstdCompressor().compress,
+            zstandard.ZstdDecompressor().decompress
+        )
+
+    raise ValueError('Unknown compression {}'.format(name))
@@ -0,0 +1,141 @@
+import asyncio
+from bisect import bisect_right
+from hashlib import md5
+from time import monotonic
+from weakref import WeakKeyDictionary, ref
+
+
+# How long listed shards are reused before they are listed again
+SHARD_CACHE_TTL = 10.0
+
+
+async def list_shards(transport, stream_name):
+    """
+    List every shard of a stream, following ListShards pagination
+    """
+    shards = []
+    list_shards_kwargs = {'StreamName': stream_name}
+    while True:
+        response = await transport.request(
+            'list_shards',
+            **list_shards_kwargs
+        )
+        shards.extend(response['Shards'])
+
+        # ListShards rejects the stream name once we have a token
+        next_token = response.get('NextToken')
+        if next_token is None:
+            return shards
+        list_shards_kwargs = {'NextToken': next_token}
+
+
+class ShardCache:
+    """
+    Shards of streams listed through one transport, reused for `ttl`
+    seconds. Concurrent lookups of a stream share a single listing, so
+    clients starting together make one ListShards call per stream.
+    """
+
+    def __init__(self, transport, ttl=SHARD_CACHE_TTL):
+        # The process wide caches are dropped along with their transport,
+        # which a strong reference would keep alive
+        self._transport = ref(transport)
+        self.ttl = ttl
+
+        # Listed shards and when they were listed by stream name
+        self._entries = {}
+        self._listings = {}
+
+    async def _list(self, stream_name):
+        try:
+            shards = await list_shards(self._transport(), stream_name)
+            self._entries[stream_name] = (monotonic(), shards)
+            return shards
+        finally:
+            del self._listings[stream_name]
+
+    async def list_shards(self, stream_name):
+        entry = self._entries.get(stream_name)
+        if entry is not None and monotonic() - entry[0] < self.ttl:
+            return list(entry[1])
+
+        listing = self._listings.get(stream_name)
+        if listing is None:
+            listing = asyncio.ensure_future(self._list(stream_name))
+            self._listings[stream_name] = listing
+
+        # A cancelled caller must not cancel the listing of the others
+        return list(await asyncio.shield(listing))
+
+    def invalidate(self, stream_name):
+        """
+        Forget a stream's shards, e.g. once it was resharded
+        """
+        self._entries.pop(stream_name, None)
+
+
+_shard_caches = WeakKeyDictionary()
+
+
+def shard_cache(transport):
+    """
+    Return the process wide shard cache of a transport. The cache is
+    dropped once the transport is.
+    """
+    cache = _shard_caches.get(transport)
+    if cache is None:
+        cache = _shard_caches[transport] = ShardCache(transport)
+    return cache
+
+
+def is_open(shard):
+    # Closed shards have an ending sequence number
+    return 'EndingSequenceNumber' not in shard.get('SequenceNumberRange', {})
+
+
+def parent_shard_ids(shard):
+    """
+    Shards a shard was split or merged from
+    """
+    return [
+        shard[key]
+        for key in ('ParentShardId', 'AdjacentParentShardId')
+        if shard.get(key) is not None
+    ]
+
+
+def partition_key_hash(partition_key):
+    """
+    Hash a partition key the same way kinesis does to pick a shard
+    """
+    digest = md5(str(partition_key).encode('utf-8')).hexdigest()
+    return int(digest, 16)
+
+
+class ShardMap:
+    """
+    Maps partition keys to the open shards of a stream by hash key range
+    """
+
+    def __init__(self, shards):
+        hash_key_ranges = sorted(
+            (
+                int(shard['HashKeyRange']['StartingHashKey']),
+                int(shard['HashKeyRange']['EndingHashKey']),
+                shard['ShardId']
+            )
+            for shard in shards
+            if is_open(shard)
+        )
+        self._starting_hash_keys = [r[0] for r in hash_key_ranges]
+        self._ending_hash_keys = [r[1] for r in hash_key_ranges]
+        self.shard_ids = [r[2] for r in hash_key_ranges]
+
+    def shard_for_hash_key(self, hash_key):
+        i = bisect_right(self._starting_hash_keys, hash_key) - 1
+        if i < 0 or hash_key > self._ending_hash_keys[i]:
+            return None
+        return self.shard_ids[i]
+
+    def shard_for(self, partition_key):
+        return self.shard_for_hash_key(partition_key_hash(partition_key))
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+
+
+class SQLiteDatabase:
+    """
+    Runs queries against a local SQLite database file on a single worker
+    thread so they never block the event loop
+
+    Every `start` is matched by a `close`. The database is only closed by
+    the last one, so consumers can share a store.
+    """
+
+    def __init__(self, loop, path):
+        self._loop = loop
+        self._path = path
+
+        self._connection = None
+        self._executor = None
+        self._users = 0
+
+    def _create_tables(self, connection):
+        pass
+
+    async def _run(self, function, *args):
+        return await self._loop.run_in_executor(
+            self._executor,
+            function,
+            *args
+        )
+
+    def _connect(self):
+        self._connection = sqlite3.connect(
+            self._path,
+            check_same_thread=False
+        )
+        with self._connection:
+            self._create_tables(self._connection)
+
+    async def start(self):
+        self._users += 1
+        if self._executor is not None:
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        await self._run(self._connect)
+
+    async def close(self):
+        self._users = max(self._users - 1, 0)
+        if self._executor is None or self._users:
+            return
+
+        await self._run(self._connection.close)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        self._connection = None
@@ -0,0 +1,166 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import boto3
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:  # pragma: no cover
+    get_session = None
+
+
+# Worker threads of the transport shared by clients that weren't given one
+SHARED_MAX_WORKERS = 32
+
+
+class ExecutorTransport:
+    """
+    Runs blocking boto3 kinesis calls on a bounded thread pool so they
+    never block the event loop. One boto3 client is shared by all workers.
+    """
+
+    def __init__(self, loop, region_name='us-east-1', max_workers=8,
+                 client=None, **client_kwargs):
+        self._loop = loop
+        self._region_name = region_name
+        self._max_workers = max_workers
+        self._client_kwargs = client_kwargs
+
+        self._kinesis_client = client
+        self._executor = None
+
+    async def start(self):
+        if self._executor is not None:
+            return
+
+        # Instantiate kinesis client. boto3 clients are thread safe so a
+        # single client is shared by every worker thread.
+        if self._kinesis_client is None:
+            self._kinesis_client = boto3.client(
+                'kinesis',
+                region_name=self._region_name,
+                **self._client_kwargs
+            )
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+
+    async def request(self, operation, **kwargs):
+        method = getattr(self._kinesis_client, operation)
+        return await self._loop.run_in_executor(
+            self._executor,
+            partial(method, **kwargs)
+        )
+
+    async def iterate_events(self, event_stream):
+        """
+        Iterate over a botocore event stream. Every stream waits for its
+        next event on a thread of its own, so subscriptions never hold the
+        worker threads that requests are made on.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        events = iter(event_stream)
+        try:
+            while True:
+                event = await self._loop.run_in_executor(
+                    executor,
+                    next,
+                    events,
+                    None
+                )
+                if event is None:
+                    return
+                yield event
+        finally:
+            event_stream.close()
+            executor.shutdown(wait=False)
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class AiobotocoreTransport:
+    """
+    Native async transport built on aiobotocore. Requests share the
+    client's aiohttp connection pool.
+    """
+
+    def __init__(self, loop, region_name='us-east-1', **client_kwargs):
+        if get_session is None:
+            raise RuntimeError(
+                'aiobotocore must be installed to use AiobotocoreTransport'
+            )
+
+        self._loop = loop
+        self._region_name = region_name
+        self._client_kwargs = client_kwargs
+
+        self._client_context = None
+        self._kinesis_client = None
+
+    async def start(self):
+        if self._kinesis_client is not None:
+            return
+
+        self._client_context = get_session().create_client(
+            'kinesis',
+            region_name=self._region_name,
+            **self._client_kwargs
+        )
+        self._kinesis_client = await self._client_context.__aenter__()
+
+    async def request(self, operation, **kwargs):
+        method = getattr(self._kinesis_client, operation)
+        return await method(**kwargs)
+
+    async def iterate_events(self, event_stream):
+        """
+        Iterate over an aiobotocore event stream
+        """
+        try:
+            async for event in event_stream:
+                yield event
+        finally:
+            event_stream.close()
+
+    async def close(self):
+        if self._kinesis_client is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client_context = None
+            self._kinesis_client = None
+
+
+# Shared transports and how many clients use them, by loop and region
+_shared_transports = {}
+
+
+def acquire_shared_transport(loop, region_name='us-east-1'):
+    """
+    Return the process wide ExecutorTransport for a loop and region, so
+    clients share one boto3 client and thread pool. Every call must be
+    matched by a call to `release_shared_transport`.
+    """
+    key = (loop, region_name)
+    transport, users = _shared_transports.get(key, (None, 0))
+    if transport is None:
+        transport = ExecutorTransport(
+            loop,
+            region_name=region_name,
+            max_workers=SHARED_MAX_WORKERS
+        )
+    _shared_transports[key] = (transport, users + 1)
+    return transport
+
+
+async def release_shared_transport(loop, region_name='us-east-1'):
+    """
+    Stop using the shared transport, closing it once no client uses it
+    """
+    key = (loop, region_name)
+    transport, users = _shared_transports[key]
+    if users > 1:
+        _shared_transports[key] = (transport, users - 1)
+        return
+
+    del _shared_transports[key]
+    await transport.close()
@@ -1,6 +1,4 @@
-import asyncio
-from heapq import heappush
-from time import time
+from .rate_limiter import RateLimiter
 
 
 def rate_limit_per_rolling_second(requests_per_rolling_second):
@@ -10,23 +8,13 @@ def rate_limit_per_rolling_second(requests_per_rolling_second):
                 rate_limit_per_rolling_second must decorate a method
             """
 
-            # Instantiate list of requests if it doesn't exist
-            if not hasattr(self, '_request_times'):
-                self._request_times = []
+            # Instantiate rate limiter if it doesn't exist
+            if not hasattr(self, '_rate_limiter'):
+                self._rate_limiter = RateLimiter(
+                    requests_per_second=requests_per_rolling_second
+                )
 
-            # Remove stale requests from list
-            current_time = float(time())
-            self._request_times = [
-                t
-                for t in self._request_times
-                if current_time - t < 1
-            ]
-
-            if len(self._request_times) >= requests_per_rolling_second:
-                oldest_request_time = self._request_times[0]
-                await asyncio.sleep(1 - current_time + oldest_request_time)
-
-            heappush(self._request_times, float(time()))
+            await self._rate_limiter.acquire()
 
             return await f(self, *args, **kwargs)
         return inner_wrapper
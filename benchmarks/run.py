@@ -0,0 +1,332 @@
+"""
+Throughput and latency benchmarks of the producer and consumer.
+
+Every scenario writes `--records` records through an AIOKinesisProducer and
+reads them back with an AIOKinesisConsumer, against the in-process fake
+kinesis of the test suite. The fake throttles requests over kinesis' per
+shard limits (1000 records and 1 MiB per second for writes, 5 requests and
+2 MiB per second for reads) unless `--no-limits` is passed, and every
+request takes `--round-trip` seconds.
+
+Scenarios sweep shard count, record size, linger time and concurrency (the
+number of records sent but not acknowledged yet), each in a fresh process
+so CPU time and peak memory aren't shared between them:
+
+    python -m benchmarks.run --shards 1 4 --record-sizes 100 10000 \\
+        --linger-times 0 0.05 --concurrency 100 1000 --output results.json
+
+Reported per scenario:
+
+- records/s and MiB/s from the first send until the last record is consumed
+- p50 and p99 latency from `send` until the record is acknowledged
+- p50 and p99 latency from `send` until the record is consumed
+- CPU time per record, of the client and the fake together
+- peak resident memory of the process
+
+With `--baseline results.json`, scenarios whose throughput dropped or whose
+p99 latency grew by more than `--tolerance` are reported as regressions and
+the exit status is 1.
+"""
+import argparse
+import asyncio
+from collections import namedtuple
+from itertools import count, product
+import json
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import time
+
+from aiokinesis import AIOKinesisConsumer, AIOKinesisProducer
+
+# The fake kinesis lives with the tests
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'tests')
+)
+from fake_kinesis import FakeKinesisClient, InlineTransport  # noqa: E402
+
+
+STREAM_NAME = 'benchmark-stream'
+
+# Records start with the time they were sent
+TIMESTAMP = struct.Struct('>d')
+
+Scenario = namedtuple(
+    'Scenario',
+    ['shards', 'record_size', 'linger_time', 'concurrency']
+)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def peak_memory():
+    """
+    Peak resident memory of the process in MiB
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB and macOS bytes
+    if sys.platform == 'darwin':
+        return max_rss / 2 ** 20
+    return max_rss / 2 ** 10
+
+
+async def run_scenario(loop, scenario, records, enforce_limits, round_trip):
+    client = FakeKinesisClient(
+        STREAM_NAME,
+        shard_count=scenario.shards,
+        enforce_limits=enforce_limits
+    )
+    transport = InlineTransport(client, delay=round_trip)
+    producer = AIOKinesisProducer(
+        STREAM_NAME,
+        loop,
+        linger_time=scenario.linger_time,
+        transport=transport
+    )
+    consumer = AIOKinesisConsumer(
+        STREAM_NAME,
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport
+    )
+    await producer.start()
+    await consumer.start()
+
+    padding = b'x' * max(scenario.record_size - TIMESTAMP.size, 0)
+    partition_keys = count()
+    ack_latencies = []
+    consume_latencies = []
+    in_flight = asyncio.Semaphore(scenario.concurrency)
+
+    def on_ack(future, sent):
+        ack_latencies.append(time.perf_counter() - sent)
+        in_flight.release()
+
+    async def produce():
+        for _ in range(records):
+            await in_flight.acquire()
+            sent = time.perf_counter()
+            future = await producer.send(
+                str(next(partition_keys)),
+                TIMESTAMP.pack(sent) + padding
+            )
+            future.add_done_callback(lambda f, sent=sent: on_ack(f, sent))
+
+    async def consume():
+        async for batch in consumer.batches():
+            now = time.perf_counter()
+            for record in batch:
+                sent, = TIMESTAMP.unpack_from(record.data_view)
+                consume_latencies.append(now - sent)
+            if len(consume_latencies) >= records:
+                return
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    await asyncio.gather(produce(), consume())
+    elapsed = time.perf_counter() - started
+    cpu_time = time.process_time() - cpu_started
+
+    await consumer.stop()
+    await producer.stop()
+
+    size = len(padding) + TIMESTAMP.size
+    return {
+        'scenario': scenario._asdict(),
+        'records': records,
+        'seconds': elapsed,
+        'records_per_second': records / elapsed,
+        'mib_per_second': records * size / elapsed / 2 ** 20,
+        'ack_p50': percentile(ack_latencies, 0.5),
+        'ack_p99': percentile(ack_latencies, 0.99),
+        'consume_p50': percentile(consume_latencies, 0.5),
+        'consume_p99': percentile(consume_latencies, 0.99),
+        'cpu_us_per_record': cpu_time / records * 1e6,
+        'peak_memory_mib': peak_memory(),
+    }
+
+
+def run_in_process(scenario, records, enforce_limits, round_trip, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.wait_for(
+            run_scenario(loop, scenario, records, enforce_limits, round_trip),
+            timeout
+        ))
+    finally:
+        loop.close()
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare results to a baseline run and describe every scenario that got
+    slower by more than `tolerance`
+    """
+    baseline = {
+        Scenario(**result['scenario']): result for result in baseline
+    }
+    regressions = []
+    for result in results:
+        previous = baseline.get(Scenario(**result['scenario']))
+        if previous is None:
+            continue
+        if result['records_per_second'] < \
+                previous['records_per_second'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} records/s, was {:.0f}'.format(
+                Scenario(**result['scenario']),
+                result['records_per_second'],
+                previous['records_per_second']
+            ))
+        for latency in ('ack_p99', 'consume_p99'):
+            if result[latency] > previous[latency] * (1 + tolerance):
+                regressions.append('{}: {} {:.1f} ms, was {:.1f} ms'.format(
+                    Scenario(**result['scenario']),
+                    latency,
+                    result[latency] * 1000,
+                    previous[latency] * 1000
+                ))
+    return regressions
+
+
+def format_result(result):
+    scenario = Scenario(**result['scenario'])
+    return (
+        '{:>6} {:>8} {:>7} {:>6} | {:>9.0f} {:>7.2f} | {:>7.1f} {:>7.1f} | '
+        '{:>7.1f} {:>7.1f} | {:>7.1f} {:>7.1f}'.format(
+            scenario.shards,
+            scenario.record_size,
+            scenario.linger_time,
+            scenario.concurrency,
+            result['records_per_second'],
+            result['mib_per_second'],
+            result['ack_p50'] * 1000,
+            result['ack_p99'] * 1000,
+            result['consume_p50'] * 1000,
+            result['consume_p99'] * 1000,
+            result['cpu_us_per_record'],
+            result['peak_memory_mib']
+        )
+    )
+
+
+HEADER = (
+    'shards     size  linger   conc | records/s   MiB/s | ack p50 ack p99 | '
+    'e2e p50 e2e p99 |  us/rec peak MiB'
+)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark aiokinesis against an in-process fake kinesis'
+    )
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4])
+    parser.add_argument(
+        '--record-sizes',
+        type=int,
+        nargs='+',
+        default=[100, 10000]
+    )
+    parser.add_argument(
+        '--linger-times',
+        type=float,
+        nargs='+',
+        default=[0, 0.05]
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        nargs='+',
+        default=[100, 1000],
+        help='records sent but not acknowledged yet'
+    )
+    parser.add_argument(
+        '--records',
+        type=int,
+        default=5000,
+        help='records written and read per scenario'
+    )
+    parser.add_argument(
+        '--round-trip',
+        type=float,
+        default=0.005,
+        help='seconds every request to the fake takes'
+    )
+    parser.add_argument(
+        '--no-limits',
+        dest='enforce_limits',
+        action='store_false',
+        help="don't throttle requests over the per shard limits in the fake"
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=300,
+        help='seconds after which a scenario fails'
+    )
+    parser.add_argument('--output', help='write results to a JSON file')
+    parser.add_argument('--baseline', help='compare to an earlier --output')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='relative slowdown reported as a regression'
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    scenarios = [
+        Scenario(*values) for values in product(
+            args.shards,
+            args.record_sizes,
+            args.linger_times,
+            args.concurrency
+        )
+    ]
+
+    results = []
+    print(HEADER)
+    context = multiprocessing.get_context('spawn')
+    for scenario in scenarios:
+        # A fresh process per scenario, so peak memory is its own
+        with context.Pool(1) as pool:
+            result = pool.apply(run_in_process, (
+                scenario,
+                args.records,
+                args.enforce_limits,
+                args.round_trip,
+                args.timeout
+            ))
+        results.append(result)
+        print(format_result(result), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(
+                results,
+                json.load(f),
+                args.tolerance
+            )
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -53,4 +53,10 @@ setup(
     version=read_version(),
     packages=['aiokinesis'],
     install_requires=install_req,
+    extras_require={
+        'aiobotocore': ['aiobotocore'],
+        'zstd': ['zstandard'],
+        'prometheus': ['prometheus_client'],
+        'statsd': ['statsd'],
+    },
 )
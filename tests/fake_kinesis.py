@@ -0,0 +1,662 @@
+"""
+In-memory stand-in for a boto3 kinesis client.
+
+Implements the subset of the kinesis API used by aiokinesis with the same
+request and response shapes as boto3, so it can be handed to a transport
+in place of a real client.
+"""
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from hashlib import md5
+from itertools import count
+from threading import Lock
+import time
+from uuid import uuid4
+
+from botocore.exceptions import ClientError
+
+
+MAX_HASH_KEY = 2 ** 128 - 1
+
+# Kinesis per shard limits
+WRITE_RECORDS_PER_SECOND = 1000
+WRITE_BYTES_PER_SECOND = 1024 * 1024
+READ_REQUESTS_PER_SECOND = 5
+READ_BYTES_PER_SECOND = 2 * 1024 * 1024
+
+
+def client_error(code, operation_name, message=''):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': message}},
+        operation_name
+    )
+
+
+class RollingLimit:
+    """
+    Usage of a limit over the last rolling second
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.total = 0
+        self._entries = deque()
+
+    def fits(self, amount, now):
+        while self._entries and now - self._entries[0][0] >= 1:
+            self.total -= self._entries.popleft()[1]
+        return self.total + amount <= self.limit
+
+    def add(self, amount, now):
+        self._entries.append((now, amount))
+        self.total += amount
+
+
+class FakeShard:
+    def __init__(self, shard_id, starting_hash_key, ending_hash_key,
+                 parent_shard_id=None, adjacent_parent_shard_id=None):
+        self.shard_id = shard_id
+        self.starting_hash_key = starting_hash_key
+        self.ending_hash_key = ending_hash_key
+        self.parent_shard_id = parent_shard_id
+        self.adjacent_parent_shard_id = adjacent_parent_shard_id
+        self.records = []
+
+        # Throughput used, only checked if the client enforces limits
+        self.write_records = RollingLimit(WRITE_RECORDS_PER_SECOND)
+        self.write_bytes = RollingLimit(WRITE_BYTES_PER_SECOND)
+        self.read_requests = RollingLimit(READ_REQUESTS_PER_SECOND)
+        self.read_bytes = RollingLimit(READ_BYTES_PER_SECOND)
+
+        # Set once the shard is closed by a split or merge
+        self.ending_sequence_number = None
+
+    def describe(self):
+        description = {
+            'ShardId': self.shard_id,
+            'HashKeyRange': {
+                'StartingHashKey': str(self.starting_hash_key),
+                'EndingHashKey': str(self.ending_hash_key),
+            },
+            'SequenceNumberRange': {
+                'StartingSequenceNumber': '0',
+            },
+        }
+        if self.parent_shard_id is not None:
+            description['ParentShardId'] = self.parent_shard_id
+        if self.adjacent_parent_shard_id is not None:
+            description['AdjacentParentShardId'] = \
+                self.adjacent_parent_shard_id
+        if self.ending_sequence_number is not None:
+            description['SequenceNumberRange']['EndingSequenceNumber'] = \
+                self.ending_sequence_number
+        return description
+
+
+class FakeEventStream:
+    """
+    SubscribeToShard event stream. Emits an event whenever new records
+    arrive on the shard, and ends once `duration` seconds have passed (5
+    minutes on kinesis) or a closed shard has been read to its end.
+    Supports blocking iteration like botocore and async iteration like
+    aiobotocore.
+    """
+
+    def __init__(self, client, shard, position, duration,
+                 poll_interval=0.01):
+        self._client = client
+        self._shard = shard
+        self._position = position
+        self._duration = duration
+        self._poll_interval = poll_interval
+        self._closed = False
+        self._ended = False
+
+    def _continuation_sequence_number(self):
+        if self._position == 0:
+            return '0'
+        return self._shard.records[self._position - 1]['SequenceNumber']
+
+    def _next_event(self):
+        """
+        Return the next event, or None if there is nothing to send yet
+        """
+        with self._client._lock:
+            records = self._shard.records[self._position:]
+            self._position += len(records)
+            if self._shard.ending_sequence_number is not None and \
+                    self._position >= len(self._shard.records):
+                self._ended = True
+                child_shards = [
+                    shard.shard_id for shard in self._client.shards
+                    if self._shard.shard_id in (
+                        shard.parent_shard_id,
+                        shard.adjacent_parent_shard_id
+                    )
+                ]
+                return {'SubscribeToShardEvent': {
+                    'Records': records,
+                    'ContinuationSequenceNumber': None,
+                    'MillisBehindLatest': 0,
+                    'ChildShards': [
+                        {'ShardId': shard_id} for shard_id in child_shards
+                    ],
+                }}
+            if not records:
+                return None
+            return {'SubscribeToShardEvent': {
+                'Records': records,
+                'ContinuationSequenceNumber':
+                    self._continuation_sequence_number(),
+                'MillisBehindLatest': 0,
+            }}
+
+    def __iter__(self):
+        deadline = time.monotonic() + self._duration
+        while not self._closed and not self._ended and \
+                time.monotonic() < deadline:
+            event = self._next_event()
+            if event is None:
+                time.sleep(self._poll_interval)
+                continue
+            yield event
+
+    async def __aiter__(self):
+        deadline = time.monotonic() + self._duration
+        while not self._closed and not self._ended and \
+                time.monotonic() < deadline:
+            event = self._next_event()
+            if event is None:
+                await asyncio.sleep(self._poll_interval)
+                continue
+            yield event
+
+    def close(self):
+        self._closed = True
+
+
+class FakeKinesisClient:
+    """
+    With `enforce_limits`, writes and reads over a shard's limits are
+    throttled with ProvisionedThroughputExceededException like on kinesis.
+    """
+
+    def __init__(self, stream_name='test-stream', shard_count=1,
+                 enforce_limits=False):
+        self.stream_name = stream_name
+        self.enforce_limits = enforce_limits
+        self.stream_arn = \
+            'arn:aws:kinesis:us-east-1:123456789012:stream/' + stream_name
+        self.shards = []
+        self.calls = []
+
+        # Enhanced fan-out consumers by name, how many describes they stay
+        # in CREATING for, and how long subscriptions last before they
+        # have to be renewed
+        self.stream_consumers = {}
+        self.consumer_activation_describes = 0
+        self.subscription_duration = 300
+
+        # Seconds before shard iterators expire
+        self.shard_iterator_ttl = 300
+
+        self._lock = Lock()
+        self._sequence_numbers = count(1)
+        self._shard_iterators = {}
+
+        # Split the hash key space evenly between shards
+        shard_width = (MAX_HASH_KEY + 1) // shard_count
+        for i in range(shard_count):
+            ending_hash_key = MAX_HASH_KEY if i == shard_count - 1 \
+                else (i + 1) * shard_width - 1
+            self.shards.append(FakeShard(
+                'shardId-{:012d}'.format(i),
+                i * shard_width,
+                ending_hash_key
+            ))
+
+    def _check_stream(self, stream_name, operation_name):
+        if stream_name != self.stream_name:
+            raise client_error(
+                'ResourceNotFoundException',
+                operation_name,
+                'Stream {} not found'.format(stream_name)
+            )
+
+    def _get_shard(self, shard_id, operation_name):
+        for shard in self.shards:
+            if shard.shard_id == shard_id:
+                return shard
+        raise client_error('ResourceNotFoundException', operation_name)
+
+    def _route(self, partition_key, explicit_hash_key=None):
+        if explicit_hash_key is not None:
+            hash_key = int(explicit_hash_key)
+        else:
+            hash_key = int(md5(partition_key.encode('utf-8')).hexdigest(), 16)
+        for shard in self.shards:
+            if shard.ending_sequence_number is None and \
+                    shard.starting_hash_key <= hash_key <= \
+                    shard.ending_hash_key:
+                return shard
+
+    def _new_shard_iterator(self, shard, position):
+        shard_iterator = str(uuid4())
+        self._shard_iterators[shard_iterator] = (
+            shard,
+            position,
+            time.monotonic()
+        )
+        return shard_iterator
+
+    def _append(self, partition_key, data, explicit_hash_key=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        shard = self._route(str(partition_key), explicit_hash_key)
+
+        if self.enforce_limits:
+            now = time.monotonic()
+            size = len(data) + len(str(partition_key))
+            if not shard.write_records.fits(1, now) or \
+                    not shard.write_bytes.fits(size, now):
+                raise client_error(
+                    'ProvisionedThroughputExceededException',
+                    'PutRecord',
+                    'Rate exceeded for shard {}'.format(shard.shard_id)
+                )
+            shard.write_records.add(1, now)
+            shard.write_bytes.add(size, now)
+
+        sequence_number = '{:056d}'.format(next(self._sequence_numbers))
+        shard.records.append({
+            'SequenceNumber': sequence_number,
+            'ApproximateArrivalTimestamp': datetime.now(timezone.utc),
+            'Data': data,
+            'PartitionKey': str(partition_key),
+        })
+        return {
+            'ShardId': shard.shard_id,
+            'SequenceNumber': sequence_number,
+        }
+
+    def _close(self, shard):
+        shard.ending_sequence_number = '{:056d}'.format(
+            next(self._sequence_numbers)
+        )
+
+    def _new_shard_id(self):
+        return 'shardId-{:012d}'.format(len(self.shards))
+
+    def split_shard(self, shard_id, new_starting_hash_key):
+        """
+        Close a shard and split its hash key range between two children
+        """
+        with self._lock:
+            parent = self._get_shard(shard_id, 'SplitShard')
+            self._close(parent)
+            children = []
+            for starting_hash_key, ending_hash_key in (
+                    (parent.starting_hash_key, new_starting_hash_key - 1),
+                    (new_starting_hash_key, parent.ending_hash_key)):
+                child = FakeShard(
+                    self._new_shard_id(),
+                    starting_hash_key,
+                    ending_hash_key,
+                    parent_shard_id=parent.shard_id
+                )
+                self.shards.append(child)
+                children.append(child)
+            return children
+
+    def merge_shards(self, shard_id, adjacent_shard_id):
+        """
+        Close two adjacent shards and merge them into one child
+        """
+        with self._lock:
+            parent = self._get_shard(shard_id, 'MergeShards')
+            adjacent_parent = self._get_shard(
+                adjacent_shard_id,
+                'MergeShards'
+            )
+            self._close(parent)
+            self._close(adjacent_parent)
+            child = FakeShard(
+                self._new_shard_id(),
+                min(
+                    parent.starting_hash_key,
+                    adjacent_parent.starting_hash_key
+                ),
+                max(parent.ending_hash_key, adjacent_parent.ending_hash_key),
+                parent_shard_id=parent.shard_id,
+                adjacent_parent_shard_id=adjacent_parent.shard_id
+            )
+            self.shards.append(child)
+            return child
+
+    def describe_stream(self, StreamName):
+        self.calls.append('describe_stream')
+        self._check_stream(StreamName, 'DescribeStream')
+        return {
+            'StreamDescription': {
+                'StreamName': self.stream_name,
+                'StreamStatus': 'ACTIVE',
+                'Shards': [shard.describe() for shard in self.shards],
+                'HasMoreShards': False,
+            }
+        }
+
+    def list_shards(self, StreamName=None, NextToken=None, MaxResults=1000):
+        self.calls.append('list_shards')
+
+        # NextToken and StreamName are mutually exclusive
+        if NextToken is not None:
+            if StreamName is not None:
+                raise client_error('InvalidArgumentException', 'ListShards')
+            StreamName, start = NextToken.rsplit(':', 1)
+            start = int(start)
+        else:
+            start = 0
+        self._check_stream(StreamName, 'ListShards')
+
+        end = start + MaxResults
+        response = {
+            'Shards': [shard.describe() for shard in self.shards[start:end]]
+        }
+        if end < len(self.shards):
+            response['NextToken'] = '{}:{}'.format(StreamName, end)
+        return response
+
+    def _position(self, shard, shard_iterator_type, sequence_number,
+                  timestamp, operation_name):
+        records = shard.records
+        if shard_iterator_type == 'TRIM_HORIZON':
+            return 0
+        if shard_iterator_type == 'LATEST':
+            return len(records)
+        if shard_iterator_type in (
+                'AT_SEQUENCE_NUMBER', 'AFTER_SEQUENCE_NUMBER'):
+            sequence_number = int(sequence_number)
+            position = len(records)
+            for i, record in enumerate(records):
+                if int(record['SequenceNumber']) >= sequence_number:
+                    position = i
+                    break
+            if shard_iterator_type == 'AFTER_SEQUENCE_NUMBER' and \
+                    position < len(records) and \
+                    int(records[position]['SequenceNumber']) == \
+                    sequence_number:
+                position += 1
+            return position
+        if shard_iterator_type == 'AT_TIMESTAMP':
+            for i, record in enumerate(records):
+                if record['ApproximateArrivalTimestamp'] >= timestamp:
+                    return i
+            return len(records)
+        raise client_error('InvalidArgumentException', operation_name)
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                           StartingSequenceNumber=None, Timestamp=None):
+        self.calls.append('get_shard_iterator')
+        self._check_stream(StreamName, 'GetShardIterator')
+
+        with self._lock:
+            shard = self._get_shard(ShardId, 'GetShardIterator')
+            position = self._position(
+                shard,
+                ShardIteratorType,
+                StartingSequenceNumber,
+                Timestamp,
+                'GetShardIterator'
+            )
+            return {
+                'ShardIterator': self._new_shard_iterator(shard, position)
+            }
+
+    def _check_stream_arn(self, stream_arn, operation_name):
+        if stream_arn != self.stream_arn:
+            raise client_error('ResourceNotFoundException', operation_name)
+
+    def describe_stream_summary(self, StreamName):
+        self.calls.append('describe_stream_summary')
+        self._check_stream(StreamName, 'DescribeStreamSummary')
+        return {
+            'StreamDescriptionSummary': {
+                'StreamName': self.stream_name,
+                'StreamARN': self.stream_arn,
+                'StreamStatus': 'ACTIVE',
+                'OpenShardCount': len([
+                    shard for shard in self.shards
+                    if shard.ending_sequence_number is None
+                ]),
+            }
+        }
+
+    def _describe_consumer(self, consumer):
+        return {
+            key: value for key, value in consumer.items()
+            if key != 'PendingDescribes'
+        }
+
+    def register_stream_consumer(self, StreamARN, ConsumerName):
+        self.calls.append('register_stream_consumer')
+        self._check_stream_arn(StreamARN, 'RegisterStreamConsumer')
+        if ConsumerName in self.stream_consumers:
+            raise client_error(
+                'ResourceInUseException',
+                'RegisterStreamConsumer'
+            )
+
+        consumer = {
+            'ConsumerName': ConsumerName,
+            'ConsumerARN': '{}/consumer/{}:1'.format(
+                self.stream_arn,
+                ConsumerName
+            ),
+            'ConsumerStatus': 'CREATING',
+            'ConsumerCreationTimestamp': datetime.now(timezone.utc),
+            'PendingDescribes': self.consumer_activation_describes,
+        }
+        if not self.consumer_activation_describes:
+            consumer['ConsumerStatus'] = 'ACTIVE'
+        self.stream_consumers[ConsumerName] = consumer
+        return {'Consumer': self._describe_consumer(consumer)}
+
+    def describe_stream_consumer(self, StreamARN, ConsumerName):
+        self.calls.append('describe_stream_consumer')
+        self._check_stream_arn(StreamARN, 'DescribeStreamConsumer')
+        try:
+            consumer = self.stream_consumers[ConsumerName]
+        except KeyError:
+            raise client_error(
+                'ResourceNotFoundException',
+                'DescribeStreamConsumer'
+            )
+        # Consumers become active after a number of describes
+        if consumer['PendingDescribes']:
+            consumer['PendingDescribes'] -= 1
+        else:
+            consumer['ConsumerStatus'] = 'ACTIVE'
+        return {
+            'ConsumerDescription': dict(
+                self._describe_consumer(consumer),
+                StreamARN=StreamARN
+            )
+        }
+
+    def subscribe_to_shard(self, ConsumerARN, ShardId, StartingPosition):
+        self.calls.append('subscribe_to_shard')
+        consumer_arns = {
+            consumer['ConsumerARN']: consumer
+            for consumer in self.stream_consumers.values()
+        }
+        consumer = consumer_arns.get(ConsumerARN)
+        if consumer is None:
+            raise client_error('ResourceNotFoundException', 'SubscribeToShard')
+        if consumer['ConsumerStatus'] != 'ACTIVE':
+            raise client_error('ResourceInUseException', 'SubscribeToShard')
+
+        with self._lock:
+            shard = self._get_shard(ShardId, 'SubscribeToShard')
+            position = self._position(
+                shard,
+                StartingPosition['Type'],
+                StartingPosition.get('SequenceNumber'),
+                StartingPosition.get('Timestamp'),
+                'SubscribeToShard'
+            )
+        return {
+            'EventStream': FakeEventStream(
+                self,
+                shard,
+                position,
+                self.subscription_duration
+            )
+        }
+
+    def get_records(self, ShardIterator, Limit=10000):
+        self.calls.append('get_records')
+
+        with self._lock:
+            try:
+                shard, position, created = \
+                    self._shard_iterators.pop(ShardIterator)
+            except KeyError:
+                raise client_error('InvalidArgumentException', 'GetRecords')
+            if time.monotonic() - created > self.shard_iterator_ttl:
+                raise client_error('ExpiredIteratorException', 'GetRecords')
+
+            # Reads over the byte limit throttle the following requests
+            if self.enforce_limits:
+                now = time.monotonic()
+                if not shard.read_requests.fits(1, now) or \
+                        not shard.read_bytes.fits(0, now):
+                    self._shard_iterators[ShardIterator] = \
+                        (shard, position, created)
+                    raise client_error(
+                        'ProvisionedThroughputExceededException',
+                        'GetRecords'
+                    )
+                shard.read_requests.add(1, now)
+
+            records = shard.records[position:position + Limit]
+            next_position = position + len(records)
+            if self.enforce_limits:
+                shard.read_bytes.add(
+                    sum(len(record['Data']) for record in records),
+                    now
+                )
+
+            # Lag is the age of the oldest record we haven't read yet
+            millis_behind_latest = 0
+            if next_position < len(shard.records):
+                next_record = shard.records[next_position]
+                age = datetime.now(timezone.utc) - \
+                    next_record['ApproximateArrivalTimestamp']
+                millis_behind_latest = max(
+                    int(age.total_seconds() * 1000),
+                    1
+                )
+
+            response = {
+                'Records': records,
+                'MillisBehindLatest': millis_behind_latest,
+            }
+
+            # Closed shards that have been read to the end have no next
+            # shard iterator
+            if shard.ending_sequence_number is None or \
+                    next_position < len(shard.records):
+                response['NextShardIterator'] = self._new_shard_iterator(
+                    shard,
+                    next_position
+                )
+            return response
+
+    def put_record(self, StreamName, Data, PartitionKey,
+                   ExplicitHashKey=None):
+        self.calls.append('put_record')
+        self._check_stream(StreamName, 'PutRecord')
+
+        with self._lock:
+            return self._append(PartitionKey, Data, ExplicitHashKey)
+
+    def put_records(self, StreamName, Records):
+        self.calls.append('put_records')
+        self._check_stream(StreamName, 'PutRecords')
+
+        with self._lock:
+            results = []
+            for record in Records:
+                try:
+                    results.append(self._append(
+                        record['PartitionKey'],
+                        record['Data'],
+                        record.get('ExplicitHashKey')
+                    ))
+                except ClientError as e:
+                    results.append({
+                        'ErrorCode': e.response['Error']['Code'],
+                        'ErrorMessage': e.response['Error']['Message'],
+                    })
+            return {
+                'FailedRecordCount': len([
+                    result for result in results if 'ErrorCode' in result
+                ]),
+                'Records': results,
+            }
+
+
+class InlineTransport:
+    """
+    Calls client methods directly on the event loop. Useful for timing
+    sensitive tests where thread pool scheduling jitter gets in the way.
+    A `delay` simulates the round trip of every request.
+    """
+
+    def __init__(self, client, delay=0):
+        self._kinesis_client = client
+        self._delay = delay
+
+    async def start(self):
+        pass
+
+    async def request(self, operation, **kwargs):
+        if self._delay:
+            await asyncio.sleep(self._delay)
+        return getattr(self._kinesis_client, operation)(**kwargs)
+
+    async def iterate_events(self, event_stream):
+        try:
+            async for event in event_stream:
+                yield event
+        finally:
+            event_stream.close()
+
+    async def close(self):
+        pass
+
+
+def put_numbered_records(fake_kinesis_client, start, stop):
+    """
+    Write the numbers from `start` to `stop` as records with the same
+    partition key
+    """
+    for i in range(start, stop):
+        fake_kinesis_client.put_record(
+            StreamName=fake_kinesis_client.stream_name,
+            Data=str(i),
+            PartitionKey='key'
+        )
+
+
+async def consume_numbers(consumer, count):
+    """
+    Read `count` numbered records from a started consumer
+    """
+    numbers = []
+    async for record in consumer:
+        numbers.append(int(record['Data']))
+        if len(numbers) == count:
+            break
+    return numbers
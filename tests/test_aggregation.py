@@ -0,0 +1,181 @@
+import asyncio
+from hashlib import md5
+import json
+
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, AIOKinesisProducer
+from aiokinesis.aggregation import (
+    MAGIC, RecordAggregator, _decode_varint, _encode_varint,
+    parse_user_records
+)
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 300, 2 ** 32, 2 ** 64 - 1])
+def test_varint_round_trip(value):
+    encoded = _encode_varint(value)
+    assert _decode_varint(encoded, 0) == (value, len(encoded))
+
+
+def test_serialize():
+    aggregator = RecordAggregator()
+    aggregator.add('a', b'x')
+
+    # partition_key_table: ['a'], records: [{partition_key_index: 0,
+    # data: 'x'}]
+    message = b'\x0a\x01a' + b'\x1a\x05' + b'\x08\x00\x1a\x01x'
+    assert aggregator.serialize() == MAGIC + message + md5(message).digest()
+    assert aggregator.partition_key == 'a'
+
+
+def test_size_accounting():
+    aggregator = RecordAggregator()
+    for i in range(200):
+        aggregator.add('key-{}'.format(i % 7), 'x' * i)
+
+        # Size is the serialized record plus its partition key
+        assert aggregator.size == \
+            len(aggregator.serialize()) + len(aggregator.partition_key)
+    assert len(aggregator) == 200
+
+
+def test_fits():
+    aggregator = RecordAggregator(max_size=100)
+    assert aggregator.fits('a', b'x' * 50)
+    aggregator.add('a', b'x' * 50)
+    assert not aggregator.fits('a', b'x' * 50)
+    assert aggregator.fits('a', b'x' * 10)
+
+
+def test_parse_user_records():
+    aggregator = RecordAggregator()
+    user_records = [('a', b'1'), ('b', b'22'), ('a', b'333')]
+    for partition_key, data in user_records:
+        aggregator.add(partition_key, data)
+
+    parsed = parse_user_records(aggregator.serialize())
+    assert [
+        (partition_key, explicit_hash_key, bytes(data))
+        for partition_key, explicit_hash_key, data in parsed
+    ] == [('a', None, b'1'), ('b', None, b'22'), ('a', None, b'333')]
+
+
+def test_parse_user_records_explicit_hash_keys():
+    # Built by hand since the aggregator doesn't write explicit hash keys
+    message = b'\x0a\x01a' + b'\x12\x03123' + \
+        b'\x1a\x07' + b'\x08\x00\x10\x00\x1a\x01x'
+
+    (partition_key, explicit_hash_key, data), = \
+        parse_user_records(MAGIC + message + md5(message).digest())
+    assert explicit_hash_key == '123'
+    assert bytes(data) == b'x'
+
+
+@pytest.mark.parametrize('data', [
+    b'{"not": "aggregated"}',
+    MAGIC + b'\x0a\x01a' + b'0123456789abcdef',
+    MAGIC,
+])
+def test_parse_user_records_passthrough(data):
+    # Plain records and records with a bad checksum aren't split
+    assert parse_user_records(data) is None
+
+
+@pytest.mark.asyncio
+async def test_produce_and_consume_aggregated():
+    fake_kinesis_client = FakeKinesisClient('aggregate-stream', shard_count=2)
+    transport = InlineTransport(fake_kinesis_client)
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'aggregate-stream',
+        loop,
+        linger_time=0.05,
+        transport=transport,
+        aggregate=True
+    )
+    await producer.start()
+
+    futures = [await producer.send(str(i), {'i': i}) for i in range(100)]
+    results = await asyncio.gather(*futures)
+    await producer.stop()
+
+    # 100 messages should fit in one kinesis record per shard
+    records = [
+        record
+        for shard in fake_kinesis_client.shards
+        for record in shard.records
+    ]
+    assert len(records) == 2
+    assert {result.sub_sequence_number for result in results} <= \
+        set(range(100))
+
+    # The consumer should get the messages back one by one
+    consumer = AIOKinesisConsumer(
+        'aggregate-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport
+    )
+    await consumer.start()
+    consumed = []
+    async for record in consumer:
+        consumed.append(record)
+        if len(consumed) == 100:
+            break
+    await consumer.stop()
+
+    assert sorted(
+        json.loads(record['Data'].decode('utf-8'))['i']
+        for record in consumed
+    ) == list(range(100))
+    for record in consumed:
+        result = results[int(record['PartitionKey'])]
+        assert record['SequenceNumber'] == result.sequence_number
+        assert record['SubSequenceNumber'] == result.sub_sequence_number
+
+
+@pytest.mark.asyncio
+async def test_produce_aggregated_large_messages():
+    fake_kinesis_client = FakeKinesisClient('aggregate-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'aggregate-stream',
+        loop,
+        linger_time=0.05,
+        transport=InlineTransport(fake_kinesis_client),
+        aggregate=True
+    )
+    await producer.start()
+
+    # Messages close to 1 MiB don't fit into an aggregated record together
+    value = 'x' * (600 * 1024)
+    futures = [await producer.send(str(i), value) for i in range(3)]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    records = fake_kinesis_client.shards[0].records
+    assert len(records) == 3
+    assert all(len(record['Data']) <= 1024 * 1024 for record in records)
+
+
+@pytest.mark.asyncio
+async def test_produce_aggregated_batches_count_kinesis_records():
+    fake_kinesis_client = FakeKinesisClient('aggregate-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'aggregate-stream',
+        loop,
+        linger_time=0.05,
+        transport=InlineTransport(fake_kinesis_client),
+        aggregate=True
+    )
+    await producer.start()
+
+    futures = [await producer.send(str(i), {'i': i}) for i in range(2000)]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    # Messages beyond the 500 records of a request share aggregated records
+    assert fake_kinesis_client.calls.count('put_records') == 1
+    assert len(fake_kinesis_client.shards[0].records) == 1
@@ -0,0 +1,233 @@
+import asyncio
+import json
+
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, AIOKinesisProducer
+from aiokinesis.checkpoint import (
+    Checkpoint, CheckpointBuffer, MemoryCheckpointer, SQLiteCheckpointer
+)
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def put_records(fake_kinesis_client, stream_name, count):
+    for i in range(count):
+        fake_kinesis_client.put_record(
+            StreamName=stream_name,
+            Data=json.dumps(i),
+            PartitionKey='key'
+        )
+
+
+async def consume(consumer, count):
+    records = []
+    async for record in consumer:
+        records.append(record)
+        if len(records) == count:
+            break
+    return records
+
+
+@pytest.mark.asyncio
+async def test_sqlite_checkpointer(tmp_path):
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / 'checkpoints.db')
+    checkpointer = SQLiteCheckpointer(loop, path)
+    await checkpointer.start()
+    assert await checkpointer.get_checkpoint('stream', 'shard-1') is None
+
+    await checkpointer.set_checkpoints('stream', {
+        'shard-1': Checkpoint('1'),
+        'shard-2': Checkpoint('2', 3)
+    })
+    await checkpointer.set_checkpoints('stream', {
+        'shard-1': Checkpoint('4')
+    })
+    await checkpointer.close()
+
+    # Checkpoints should survive reopening the database
+    checkpointer = SQLiteCheckpointer(loop, path)
+    await checkpointer.start()
+    assert await checkpointer.get_checkpoint('stream', 'shard-1') == \
+        Checkpoint('4')
+    assert await checkpointer.get_checkpoint('stream', 'shard-2') == \
+        Checkpoint('2', 3)
+    assert await checkpointer.get_checkpoint('other', 'shard-1') is None
+    await checkpointer.close()
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_buffer_flushes_by_record_count():
+    loop = asyncio.get_event_loop()
+    checkpointer = MemoryCheckpointer()
+    checkpoint_buffer = CheckpointBuffer(
+        loop,
+        checkpointer,
+        'stream',
+        interval=60,
+        max_records=3
+    )
+
+    checkpoint_buffer.mark('shard', Checkpoint('1'))
+    checkpoint_buffer.mark('shard', Checkpoint('2'))
+    assert not checkpoint_buffer.due()
+    checkpoint_buffer.mark('shard', Checkpoint('3'))
+    assert checkpoint_buffer.due()
+
+    await checkpoint_buffer.flush()
+    assert checkpointer.checkpoints == {('stream', 'shard'): Checkpoint('3')}
+    assert not checkpoint_buffer.due()
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_buffer_flushes_by_time():
+    loop = asyncio.get_event_loop()
+    checkpoint_buffer = CheckpointBuffer(
+        loop,
+        MemoryCheckpointer(),
+        'stream',
+        interval=0.05,
+        max_records=1000
+    )
+
+    checkpoint_buffer.mark('shard', Checkpoint('1'))
+    assert not checkpoint_buffer.due()
+    await asyncio.sleep(0.05)
+    assert checkpoint_buffer.due()
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_buffer_keeps_checkpoints_when_write_fails():
+    loop = asyncio.get_event_loop()
+
+    class FailingCheckpointer(MemoryCheckpointer):
+        async def set_checkpoints(self, stream_name, checkpoints):
+            raise IOError('disk full')
+
+    checkpoint_buffer = CheckpointBuffer(
+        loop,
+        FailingCheckpointer(),
+        'stream'
+    )
+    checkpoint_buffer.mark('shard', Checkpoint('1'))
+    with pytest.raises(IOError):
+        await checkpoint_buffer.flush()
+    assert checkpoint_buffer._pending == {'shard': Checkpoint('1')}
+
+
+@pytest.mark.asyncio
+async def test_consumer_resumes_after_checkpoint():
+    fake_kinesis_client = FakeKinesisClient('checkpoint-stream')
+    put_records(fake_kinesis_client, 'checkpoint-stream', 10)
+    transport = InlineTransport(fake_kinesis_client)
+    loop = asyncio.get_event_loop()
+    checkpointer = MemoryCheckpointer()
+
+    consumer = AIOKinesisConsumer(
+        'checkpoint-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        checkpointer=checkpointer,
+        limit=4
+    )
+    await consumer.start()
+    records = await consume(consumer, 5)
+    await consumer.stop()
+
+    # The last record handed out wasn't processed yet
+    assert checkpointer.checkpoints == {
+        ('checkpoint-stream', 'shardId-000000000000'):
+            Checkpoint(records[3]['SequenceNumber'])
+    }
+
+    consumer = AIOKinesisConsumer(
+        'checkpoint-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        checkpointer=checkpointer
+    )
+    await consumer.start()
+    shard_reader = consumer._shard_readers['shardId-000000000000']
+    assert shard_reader._shard_iterator_type == 'AFTER_SEQUENCE_NUMBER'
+    records = await consume(consumer, 6)
+    await consumer.stop()
+
+    assert [json.loads(record['Data']) for record in records] == \
+        list(range(4, 10))
+
+
+@pytest.mark.asyncio
+async def test_consumer_explicit_checkpoint():
+    fake_kinesis_client = FakeKinesisClient('explicit-checkpoint-stream')
+    put_records(fake_kinesis_client, 'explicit-checkpoint-stream', 5)
+    loop = asyncio.get_event_loop()
+    checkpointer = MemoryCheckpointer()
+
+    consumer = AIOKinesisConsumer(
+        'explicit-checkpoint-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        checkpointer=checkpointer,
+        auto_checkpoint=False,
+        checkpoint_max_records=2
+    )
+    await consumer.start()
+    records = await consume(consumer, 5)
+
+    await consumer.checkpoint(records[0])
+    assert checkpointer.checkpoints == {}
+    await consumer.checkpoint(records[2])
+    assert checkpointer.checkpoints == {
+        ('explicit-checkpoint-stream', 'shardId-000000000000'):
+            Checkpoint(records[2]['SequenceNumber'])
+    }
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_resumes_within_aggregated_record():
+    fake_kinesis_client = FakeKinesisClient('aggregated-checkpoint-stream')
+    transport = InlineTransport(fake_kinesis_client)
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'aggregated-checkpoint-stream',
+        loop,
+        linger_time=0.05,
+        transport=transport,
+        aggregate=True
+    )
+    await producer.start()
+    futures = [await producer.send('key', i) for i in range(10)]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    checkpointer = MemoryCheckpointer()
+    consumer = AIOKinesisConsumer(
+        'aggregated-checkpoint-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        checkpointer=checkpointer,
+        auto_checkpoint=False
+    )
+    await consumer.start()
+    records = await consume(consumer, 4)
+    await consumer.checkpoint(records[3])
+    await consumer.stop()
+
+    consumer = AIOKinesisConsumer(
+        'aggregated-checkpoint-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        checkpointer=checkpointer
+    )
+    await consumer.start()
+    records = await consume(consumer, 6)
+    await consumer.stop()
+
+    assert [json.loads(record['Data']) for record in records] == \
+        list(range(4, 10))
@@ -1,12 +1,27 @@
 import asyncio
-from time import time
+from time import monotonic
 from uuid import uuid4
 from datetime import datetime
 
-from mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from mock import MagicMock, call, patch
 import pytest
 
 from aiokinesis import AIOKinesisConsumer
+from aiokinesis.retry import RetryPolicy
+from aiokinesis.transport import ExecutorTransport
+from fake_kinesis import (
+    FakeKinesisClient, InlineTransport, consume_numbers, put_numbered_records
+)
+
+
+def mock_list_shards(shard_count=1):
+    return {
+        'Shards': [
+            {'ShardId': 'shardId-{:012d}'.format(i)}
+            for i in range(shard_count)
+        ]
+    }
 
 
 @pytest.mark.asyncio
@@ -22,6 +37,7 @@ async def test_consumer_start(stream_name, region_name, shard_iterator_type,
     with patch('boto3.client') as mock_boto3_client:
         # Setup mock
         mock_kinesis_client = MagicMock()
+        mock_kinesis_client.list_shards.return_value = mock_list_shards()
         mock_boto3_client.return_value = mock_kinesis_client
 
         # Instantiate consumer
@@ -36,7 +52,7 @@ async def test_consumer_start(stream_name, region_name, shard_iterator_type,
         )
 
         # Starting consumer should create a kinesis consumer exactly once.
-        # It should describe stream exactly once to get shards.
+        # It should list shards exactly once to get shards.
         # Lastly it should call `get_shard_iterator` to get at least one
         # shard iterator
         await consumer.start()
@@ -44,7 +60,7 @@ async def test_consumer_start(stream_name, region_name, shard_iterator_type,
             'kinesis',
             region_name=region_name
         )
-        mock_kinesis_client.describe_stream.assert_called_once_with(
+        mock_kinesis_client.list_shards.assert_called_once_with(
             StreamName=stream_name
         )
         call_kwargs = mock_kinesis_client\
@@ -56,6 +72,8 @@ async def test_consumer_start(stream_name, region_name, shard_iterator_type,
             starting_sequence_number
         assert call_kwargs.get('Timestamp') == timestamp
 
+        await consumer.stop()
+
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize('shard_iterator', [
@@ -70,6 +88,11 @@ async def test_consumer_anext(shard_iterator):
         mock_kinesis_client.get_shard_iterator.return_value = {
             "ShardIterator": shard_iterator,
         }
+        mock_kinesis_client.get_records.return_value = {
+            "Records": [{"SequenceNumber": "1", "Data": b"{}"}],
+            "NextShardIterator": shard_iterator,
+        }
+        mock_kinesis_client.list_shards.return_value = mock_list_shards()
         mock_boto3_client.return_value = mock_kinesis_client
 
         # Instantiate consumer
@@ -82,16 +105,23 @@ async def test_consumer_anext(shard_iterator):
         # Start consumer
         await consumer.start()
 
-        # Calling anext on consumer shoud call get one with shard_iterator
+        # Calling anext on consumer shoud call get one with shard_iterator.
+        # The shard routine may already be fetching the next response.
         await consumer.__anext__()
-        mock_kinesis_client.get_records.assert_called_once_with(
+        assert mock_kinesis_client.get_records.call_args_list[0] == call(
             ShardIterator=shard_iterator,
-            Limit=1
+            Limit=10000
         )
 
+        await consumer.stop()
+
 
 @pytest.mark.asyncio
-async def test_consumer_rate_limit():
+@pytest.mark.parametrize('prefetch_kwargs', [
+    {},
+    {'max_prefetch_records': 100},
+])
+async def test_consumer_rate_limit(prefetch_kwargs):
     records_request_times = []
 
     def mock_get_shard_iterator(*args, **kwargs):
@@ -99,42 +129,533 @@ async def test_consumer_rate_limit():
         return {"ShardIterator": shard_iterator}
 
     def mock_get_records(*args, **kwargs):
-        current_time = float(time())
+        # Measured on the clock the rate limiter uses
+        current_time = monotonic()
         records_request_times.append(current_time)
         shard_iterator = str(uuid4())
-        return {"NextShardIterator": shard_iterator}
+        return {
+            "Records": [{
+                "SequenceNumber": str(len(records_request_times)),
+                "Data": b"{}",
+            }],
+            "NextShardIterator": shard_iterator
+        }
+
+    # Setup mock. Requests are made inline on the loop so that the
+    # request times aren't skewed by thread pool scheduling.
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.get_shard_iterator = mock_get_shard_iterator
+    mock_kinesis_client.list_shards.return_value = mock_list_shards()
+    mock_kinesis_client.get_records = mock_get_records
+
+    # Instantiate consumer
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'test-stream-name',
+        loop,
+        transport=InlineTransport(mock_kinesis_client),
+        **prefetch_kwargs
+    )
+
+    # Start consumer
+    await consumer.start()
+
+    # Async iteration. Shards may fetch ahead of the records taken.
+    async for record in consumer:
+        assert 'SequenceNumber' in record
+        if len(records_request_times) >= 50:
+            break
+
+    requests_per_rolling_sec = 5
+    # Verify that we never make more than 5 requests per rolling second
+    # and that we're making almost 5 requests per rolling second
+    for i, request_time in enumerate(records_request_times):
+        if i < requests_per_rolling_sec:
+            continue
+
+        prev_i = i - requests_per_rolling_sec
+        prev_request_time = records_request_times[prev_i]
+        assert request_time - prev_request_time > 1
+        assert request_time - prev_request_time < 1.5
+
+    await consumer.stop()
+
 
+@pytest.mark.asyncio
+async def test_consumer_list_shards_pagination():
     with patch('boto3.client') as mock_boto3_client:
-        # Setup mock
+        # Setup mock which returns shards over two pages
         mock_kinesis_client = MagicMock()
-        mock_kinesis_client.get_shard_iterator = mock_get_shard_iterator
+        mock_kinesis_client.list_shards.side_effect = [
+            {'Shards': [{'ShardId': 'shard-1'}], 'NextToken': 'token'},
+            {'Shards': [{'ShardId': 'shard-2'}]},
+        ]
         mock_boto3_client.return_value = mock_kinesis_client
-        mock_kinesis_client.get_records = mock_get_records
 
         # Instantiate consumer
         loop = asyncio.get_event_loop()
-        consumer = AIOKinesisConsumer(
-            'test-stream-name',
-            loop
+        consumer = AIOKinesisConsumer('test-stream-name', loop)
+        await consumer.start()
+
+        # Only the first page should be requested with the stream name
+        assert mock_kinesis_client.list_shards.call_args_list == [
+            call(StreamName='test-stream-name'),
+            call(NextToken='token'),
+        ]
+
+        # A shard iterator should be created for every shard
+        shard_ids = {
+            c[1]['ShardId']
+            for c in mock_kinesis_client.get_shard_iterator.call_args_list
+        }
+        assert shard_ids == {'shard-1', 'shard-2'}
+
+        await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_reads_every_shard():
+    # Setup a stream with several shards and a record on each
+    fake_kinesis_client = FakeKinesisClient('test-stream', shard_count=4)
+    for i in range(100):
+        fake_kinesis_client.put_record(
+            StreamName='test-stream',
+            Data='{}',
+            PartitionKey=str(i)
         )
+    shards_with_records = {
+        shard.shard_id
+        for shard in fake_kinesis_client.shards
+        if shard.records
+    }
+    assert len(shards_with_records) == 4
 
-        # Start consumer
-        await consumer.start()
+    loop = asyncio.get_event_loop()
+    transport = ExecutorTransport(loop, client=fake_kinesis_client)
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        limit=1
+    )
+    await consumer.start()
+
+    # Every shard is polled concurrently with its own rate limit, so 20
+    # responses from four shards should arrive in about one second
+    start_time = loop.time()
+    partition_keys = set()
+    for _ in range(20):
+        records = await consumer.getmany()
+        assert len(records) == 1
+        partition_keys.add(records[0]['PartitionKey'])
+    assert loop.time() - start_time < 1
+
+    assert len(partition_keys) == 20
+    await consumer.stop()
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_consumer_stops_on_client_error():
+    # Setup a stream whose shard iterators are rejected
+    fake_kinesis_client = FakeKinesisClient('test-stream')
+    fake_kinesis_client.get_records = MagicMock(
+        side_effect=ClientError({'Error': {'Code': 'Boom'}}, 'GetRecords')
+    )
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        transport=ExecutorTransport(loop, client=fake_kinesis_client)
+    )
+    await consumer.start()
+
+    # Iteration should stop
+    records = [record async for record in consumer]
+    assert records == []
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_buffers_records():
+    # Setup a stream with more records than fit in one response
+    fake_kinesis_client = FakeKinesisClient('test-stream')
+    for i in range(25):
+        fake_kinesis_client.put_record(
+            StreamName='test-stream',
+            Data='{}',
+            PartitionKey=str(i)
+        )
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=ExecutorTransport(loop, client=fake_kinesis_client),
+        limit=10
+    )
+    await consumer.start()
+
+    # Records are yielded one at a time in order
+    partition_keys = []
+    async for record in consumer:
+        partition_keys.append(record['PartitionKey'])
+        if len(partition_keys) == 25:
+            break
+    assert partition_keys == [str(i) for i in range(25)]
+
+    # Reading 25 records 10 at a time takes at least three requests
+    assert fake_kinesis_client.calls.count('get_records') >= 3
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_batches():
+    # Setup a stream with some records
+    fake_kinesis_client = FakeKinesisClient('test-stream')
+    for i in range(25):
+        fake_kinesis_client.put_record(
+            StreamName='test-stream',
+            Data='{}',
+            PartitionKey=str(i)
+        )
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=ExecutorTransport(loop, client=fake_kinesis_client),
+        limit=10
+    )
+    await consumer.start()
+
+    # Record lists should be yielded as they were fetched
+    batch_sizes = []
+    async for records in consumer.batches():
+        batch_sizes.append(len(records))
+        if sum(batch_sizes) == 25:
+            break
+    assert batch_sizes == [10, 10, 5]
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_getmany_drains_buffer():
+    # Setup a stream with some records
+    fake_kinesis_client = FakeKinesisClient('test-stream')
+    for i in range(5):
+        fake_kinesis_client.put_record(
+            StreamName='test-stream',
+            Data='{}',
+            PartitionKey=str(i)
+        )
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=ExecutorTransport(loop, client=fake_kinesis_client)
+    )
+    await consumer.start()
+
+    # getmany should return what's left over from single record iteration
+    first_record = await consumer.__anext__()
+    records = await consumer.getmany()
+    assert first_record['PartitionKey'] == '0'
+    assert [r['PartitionKey'] for r in records] == ['1', '2', '3', '4']
+    await consumer.stop()
+
+
+@pytest.mark.parametrize('limit', [0, 10001])
+def test_consumer_invalid_limit(limit):
+    loop = asyncio.new_event_loop()
+    with pytest.raises(ValueError):
+        AIOKinesisConsumer('test-stream', loop, limit=limit)
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_consumer_idle_backoff():
+    # Setup an empty stream
+    fake_kinesis_client = FakeKinesisClient('test-stream')
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        transport=ExecutorTransport(loop, client=fake_kinesis_client),
+        max_idle_interval=0.8
+    )
+    await consumer.start()
+
+    # Idle polls should back off 0.2, 0.4, 0.8, 0.8... seconds apart instead
+    # of polling 5 times per second
+    await asyncio.sleep(2)
+    assert 3 <= fake_kinesis_client.calls.count('get_records') <= 5
+    assert consumer.millis_behind_latest == {'shardId-000000000000': 0}
+
+    # New records should be picked up within the max idle interval
+    fake_kinesis_client.put_record(
+        StreamName='test-stream',
+        Data='{}',
+        PartitionKey='key'
+    )
+    record = await asyncio.wait_for(consumer.__anext__(), timeout=1)
+    assert record['PartitionKey'] == 'key'
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_polls_at_full_rate_when_behind():
+    # Setup a stream with a backlog. It has its own name so that it doesn't
+    # share a read budget with streams of other tests.
+    fake_kinesis_client = FakeKinesisClient('backlog-stream')
+    for i in range(20):
+        fake_kinesis_client.put_record(
+            StreamName='backlog-stream',
+            Data='{}',
+            PartitionKey=str(i)
+        )
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'backlog-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=ExecutorTransport(loop, client=fake_kinesis_client),
+        limit=1
+    )
+    await consumer.start()
+
+    # Lag should be exposed while we are behind
+    await consumer.__anext__()
+    assert consumer.millis_behind_latest['shardId-000000000000'] > 0
+
+    # The backlog should be read at 5 requests per second
+    start_time = loop.time()
+    for _ in range(14):
+        await consumer.__anext__()
+    assert loop.time() - start_time < 2.5
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_retries_throttled_requests():
+    # Setup a stream which throttles the first two reads
+    fake_kinesis_client = FakeKinesisClient('throttled-stream')
+    fake_kinesis_client.put_record(
+        StreamName='throttled-stream',
+        Data='{}',
+        PartitionKey='key'
+    )
+    get_records = fake_kinesis_client.get_records
+    throttled = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}},
+        'GetRecords'
+    )
+
+    def throttle_then_read(**kwargs):
+        if fake_kinesis_client.get_records.call_count <= 2:
+            raise throttled
+        return get_records(**kwargs)
+    fake_kinesis_client.get_records = MagicMock(
+        side_effect=throttle_then_read
+    )
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'throttled-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        retry_policy=RetryPolicy(base_delay=0.01)
+    )
+    await consumer.start()
+
+    # The record should be read once throttling stops
+    record = await asyncio.wait_for(consumer.__anext__(), timeout=1)
+    assert record['PartitionKey'] == 'key'
+    assert fake_kinesis_client.get_records.call_count >= 3
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_reads_parent_before_children():
+    fake_kinesis_client = FakeKinesisClient('split-stream')
+    put_numbered_records(fake_kinesis_client, 0, 5)
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 127)
+    put_numbered_records(fake_kinesis_client, 5, 10)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'split-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        limit=1
+    )
+    await consumer.start()
+
+    # Only the parent is read while it has records left
+    assert list(consumer._shard_readers) == ['shardId-000000000000']
+
+    # Records of the key should come in order across the split
+    assert await consume_numbers(consumer, 10) == list(range(10))
+    assert 'shardId-000000000000' not in consumer._shard_readers
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_reads_merged_shard_after_both_parents():
+    fake_kinesis_client = FakeKinesisClient('merge-stream', shard_count=2)
+    put_numbered_records(fake_kinesis_client, 0, 5)
+    fake_kinesis_client.merge_shards(
+        'shardId-000000000000',
+        'shardId-000000000001'
+    )
+    put_numbered_records(fake_kinesis_client, 5, 10)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'merge-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await consumer.start()
+    assert await consume_numbers(consumer, 10) == list(range(10))
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_discovers_new_shards():
+    fake_kinesis_client = FakeKinesisClient('discovery-stream')
+    put_numbered_records(fake_kinesis_client, 0, 5)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'discovery-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        shard_discovery_interval=0.05
+    )
+    await consumer.start()
+    assert await consume_numbers(consumer, 5) == list(range(5))
+
+    # Reshard while consuming
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 127)
+    put_numbered_records(fake_kinesis_client, 5, 10)
+    assert await consume_numbers(consumer, 5) == list(range(5, 10))
+    assert len(consumer._shard_readers) == 2
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_skips_closed_shards_at_latest():
+    fake_kinesis_client = FakeKinesisClient('latest-split-stream')
+    put_numbered_records(fake_kinesis_client, 0, 5)
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 127)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'latest-split-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await consumer.start()
+
+    # The closed parent has nothing after its latest record
+    assert sorted(consumer._shard_readers) == [
+        'shardId-000000000001',
+        'shardId-000000000002'
+    ]
+    assert fake_kinesis_client.calls.count('get_shard_iterator') > 1
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_renews_expired_shard_iterators():
+    fake_kinesis_client = FakeKinesisClient('expiry-stream')
+    fake_kinesis_client.shard_iterator_ttl = 0.05
+    put_numbered_records(fake_kinesis_client, 0, 10)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'expiry-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        limit=2
+    )
+    await consumer.start()
+
+    # The iterator expires while the consumer is too slow to take records
+    numbers = await consume_numbers(consumer, 2)
+    await asyncio.sleep(0.1)
+    numbers.extend(await consume_numbers(consumer, 8))
+    await consumer.stop()
+
+    # Reading carries on after the last record without gaps or duplicates
+    assert numbers == list(range(10))
+    assert fake_kinesis_client.calls.count('get_shard_iterator') > 1
+
+
+@pytest.mark.asyncio
+async def test_consumer_renews_idle_latest_shard_iterators():
+    fake_kinesis_client = FakeKinesisClient('latest-expiry-stream')
+    fake_kinesis_client.shard_iterator_ttl = 0.1
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'latest-expiry-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await consumer.start()
+
+    # Idle polls back off until the iterator expires between two of them
+    await asyncio.sleep(0.3)
+    put_numbered_records(fake_kinesis_client, 0, 1)
+
+    # The record written before the iterator was renewed isn't skipped
+    assert await asyncio.wait_for(
+        consume_numbers(consumer, 1),
+        timeout=3
+    ) == [0]
+    await consumer.stop()
+    assert fake_kinesis_client.calls.count('get_shard_iterator') > 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('stream_name, prefetch_kwargs, buffered', [
+    ('unbounded-stream', {}, 1),
+    ('prefetch-stream', {'max_prefetch_records': 4}, 4),
+])
+async def test_consumer_prefetches_while_processing(
+        stream_name, prefetch_kwargs, buffered):
+    # Streams differ so that their shards don't share a read budget
+    fake_kinesis_client = FakeKinesisClient(stream_name)
+    put_numbered_records(fake_kinesis_client, 0, 10)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        stream_name,
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        limit=1,
+        **prefetch_kwargs
+    )
+    await consumer.start()
 
-        # Async iteration
-        async for record in consumer:
-            assert 'NextShardIterator' in record
-            if len(records_request_times) == 50:
-                break
-
-        requests_per_rolling_sec = 5
-        # Verify that we never make more than 5 requests per rolling second
-        # and that we're making almost 5 requests per rolling second
-        for i, request_time in enumerate(records_request_times):
-            if i < requests_per_rolling_sec:
-                continue
-
-            prev_i = i - requests_per_rolling_sec
-            prev_request_time = records_request_times[prev_i]
-            assert request_time - prev_request_time > 1
-            assert request_time - prev_request_time < 1.5
+    # Records are fetched while the application is busy, up to the bound
+    await asyncio.sleep(0.1)
+    assert len(consumer._batches) == buffered
+    assert await consume_numbers(consumer, 10) == list(range(10))
+    await consumer.stop()
@@ -0,0 +1,198 @@
+import asyncio
+
+import pytest
+from mock import patch
+
+from aiokinesis import AIOKinesisConsumer
+from aiokinesis.fanout import register_stream_consumer
+from aiokinesis.retry import RetryPolicy
+from aiokinesis.transport import ExecutorTransport
+from fake_kinesis import (
+    FakeKinesisClient, InlineTransport, client_error, consume_numbers,
+    put_numbered_records
+)
+
+
+@pytest.mark.asyncio
+async def test_register_stream_consumer():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    fake_kinesis_client.consumer_activation_describes = 2
+    transport = InlineTransport(fake_kinesis_client)
+
+    # Registration should wait for the consumer to become active
+    consumer_arn = await register_stream_consumer(
+        transport,
+        'fanout-stream',
+        'my-app',
+        poll_interval=0
+    )
+    consumer = fake_kinesis_client.stream_consumers['my-app']
+    assert consumer_arn == consumer['ConsumerARN']
+    assert consumer['ConsumerStatus'] == 'ACTIVE'
+    assert fake_kinesis_client.calls.count('describe_stream_consumer') == 3
+
+    # Registering again should find the existing consumer
+    assert await register_stream_consumer(
+        transport,
+        'fanout-stream',
+        'my-app'
+    ) == consumer_arn
+
+
+@pytest.mark.asyncio
+async def test_consumer_reads_with_enhanced_fan_out():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    put_numbered_records(fake_kinesis_client, 0, 5)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'fanout-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        consumer_name='my-app'
+    )
+    await consumer.start()
+    assert await consume_numbers(consumer, 5) == list(range(5))
+
+    # Records written later are pushed to the consumer
+    put_numbered_records(fake_kinesis_client, 5, 10)
+    assert await consume_numbers(consumer, 5) == list(range(5, 10))
+    await consumer.stop()
+
+    assert 'get_records' not in fake_kinesis_client.calls
+
+
+@pytest.mark.asyncio
+async def test_consumer_resubscribes_when_subscription_expires():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    fake_kinesis_client.subscription_duration = 0.05
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'fanout-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client),
+        consumer_name='my-app'
+    )
+    await consumer.start()
+
+    numbers = []
+    for i in range(5):
+        put_numbered_records(fake_kinesis_client, i, i + 1)
+        numbers.extend(await consume_numbers(consumer, 1))
+        await asyncio.sleep(0.06)
+    await consumer.stop()
+
+    # Every record should be read exactly once across subscriptions
+    assert numbers == list(range(5))
+    assert fake_kinesis_client.calls.count('subscribe_to_shard') > 1
+
+
+@pytest.mark.asyncio
+async def test_consumer_retries_throttled_subscriptions():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    put_numbered_records(fake_kinesis_client, 0, 3)
+    subscribe_to_shard = fake_kinesis_client.subscribe_to_shard
+    attempts = []
+
+    def throttled_subscribe_to_shard(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            raise client_error('LimitExceededException', 'SubscribeToShard')
+        return subscribe_to_shard(**kwargs)
+    fake_kinesis_client.subscribe_to_shard = throttled_subscribe_to_shard
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'fanout-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        consumer_name='my-app',
+        retry_policy=RetryPolicy(base_delay=0.01)
+    )
+    await consumer.start()
+    assert await consume_numbers(consumer, 3) == list(range(3))
+    await consumer.stop()
+    assert len(attempts) == 2
+
+
+@pytest.mark.asyncio
+async def test_consumer_resubscribes_after_resource_in_use():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    put_numbered_records(fake_kinesis_client, 0, 3)
+    subscribe_to_shard = fake_kinesis_client.subscribe_to_shard
+    attempts = []
+
+    def early_subscribe_to_shard(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            raise client_error('ResourceInUseException', 'SubscribeToShard')
+        return subscribe_to_shard(**kwargs)
+    fake_kinesis_client.subscribe_to_shard = early_subscribe_to_shard
+
+    sleep = asyncio.sleep
+    delays = []
+
+    async def recording_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'fanout-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        consumer_name='my-app',
+        retry_policy=RetryPolicy(base_delay=0.01)
+    )
+    with patch('aiokinesis.fanout.asyncio.sleep', recording_sleep):
+        await consumer.start()
+        assert await consume_numbers(consumer, 3) == list(range(3))
+    await consumer.stop()
+
+    # The subscription is retried once Kinesis accepts it again
+    assert len(attempts) == 2
+    assert delays and delays[0] >= 5
+
+
+@pytest.mark.asyncio
+async def test_consumer_follows_split_with_enhanced_fan_out():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    put_numbered_records(fake_kinesis_client, 0, 5)
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 127)
+    put_numbered_records(fake_kinesis_client, 5, 10)
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'fanout-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        consumer_name='my-app'
+    )
+    await consumer.start()
+    assert await consume_numbers(consumer, 10) == list(range(10))
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_executor_transport_iterates_events():
+    fake_kinesis_client = FakeKinesisClient('fanout-stream')
+    put_numbered_records(fake_kinesis_client, 0, 3)
+
+    loop = asyncio.get_event_loop()
+    transport = ExecutorTransport(loop, client=fake_kinesis_client)
+    consumer = AIOKinesisConsumer(
+        'fanout-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        consumer_name='my-app'
+    )
+    await consumer.start()
+    assert await consume_numbers(consumer, 3) == list(range(3))
+    await consumer.stop()
+    await transport.close()
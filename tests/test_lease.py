@@ -0,0 +1,343 @@
+import asyncio
+
+import pytest
+
+from aiokinesis import AIOKinesisConsumer
+from aiokinesis.checkpoint import MemoryCheckpointer, SQLiteCheckpointer
+from aiokinesis.lease import (
+    Lease, LeaseCoordinator, MemoryLeaseStore, SQLiteLeaseStore
+)
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def shards(count):
+    return [
+        {'ShardId': 'shardId-{:012d}'.format(i)}
+        for i in range(count)
+    ]
+
+
+def coordinator(lease_store, worker_id, lease_duration=10.0):
+    return LeaseCoordinator(
+        asyncio.get_event_loop(),
+        lease_store,
+        'stream',
+        worker_id=worker_id,
+        lease_duration=lease_duration
+    )
+
+
+@pytest.mark.asyncio
+async def test_sqlite_lease_store(tmp_path):
+    loop = asyncio.get_event_loop()
+    lease_store = SQLiteLeaseStore(loop, str(tmp_path / 'leases.db'))
+    await lease_store.start()
+
+    await lease_store.create_leases('stream', [
+        Lease('shard-1'),
+        Lease('shard-2', parent_shard_ids=('shard-0', 'shard-1'))
+    ])
+    # Existing leases are kept
+    await lease_store.create_leases('stream', [Lease('shard-1', 'worker')])
+    leases = sorted(await lease_store.list_leases('stream'))
+    assert leases == [
+        Lease('shard-1'),
+        Lease('shard-2', parent_shard_ids=('shard-0', 'shard-1'))
+    ]
+
+    taken = await lease_store.update_lease(
+        'stream',
+        leases[0],
+        'worker',
+        False
+    )
+    assert taken == Lease('shard-1', 'worker', 1)
+
+    # Updates from a stale view of the lease fail
+    assert await lease_store.update_lease(
+        'stream',
+        leases[0],
+        'other-worker',
+        False
+    ) is None
+    assert await lease_store.list_leases('other-stream') == []
+    await lease_store.close()
+
+
+@pytest.mark.asyncio
+async def test_coordinator_takes_unowned_leases():
+    lease_store = MemoryLeaseStore()
+    worker = coordinator(lease_store, 'a')
+    await worker.add_shards(shards(4))
+
+    assert await worker.heartbeat() == {s['ShardId'] for s in shards(4)}
+
+    # Heartbeats renew held leases
+    await worker.heartbeat()
+    assert {lease.counter for lease in lease_store.leases.values()} == {2}
+
+
+@pytest.mark.asyncio
+async def test_coordinators_balance_leases_by_stealing():
+    lease_store = MemoryLeaseStore()
+    worker_a = coordinator(lease_store, 'a')
+    worker_b = coordinator(lease_store, 'b')
+    await worker_a.add_shards(shards(4))
+    await worker_a.heartbeat()
+
+    # Worker b steals one lease per heartbeat until both have their share
+    assert len(await worker_b.heartbeat()) == 1
+    assert len(await worker_b.heartbeat()) == 2
+    assert len(await worker_b.heartbeat()) == 2
+
+    # Worker a notices the stolen leases when it renews
+    held_a = await worker_a.heartbeat()
+    assert len(held_a) == 2
+    assert not held_a & set(worker_b.held)
+
+
+@pytest.mark.asyncio
+async def test_coordinator_takes_over_expired_leases():
+    lease_store = MemoryLeaseStore()
+    worker_a = coordinator(lease_store, 'a', lease_duration=0.05)
+    worker_b = coordinator(lease_store, 'b', lease_duration=0.05)
+    await worker_a.add_shards(shards(4))
+    await worker_a.heartbeat()
+    await worker_b.heartbeat()
+
+    # Worker a stops renewing its leases
+    await asyncio.sleep(0.06)
+    assert len(await worker_b.heartbeat()) == 4
+
+
+@pytest.mark.asyncio
+async def test_coordinator_takes_back_leases_of_earlier_run():
+    lease_store = MemoryLeaseStore()
+    await coordinator(lease_store, 'a').add_shards(shards(2))
+    await coordinator(lease_store, 'a').heartbeat()
+
+    # A restarted worker with the same id doesn't wait for them to expire
+    assert len(await coordinator(lease_store, 'a').heartbeat()) == 2
+
+
+@pytest.mark.asyncio
+async def test_coordinator_waits_for_parents_to_finish():
+    lease_store = MemoryLeaseStore()
+    worker = coordinator(lease_store, 'a')
+    await worker.add_shards([
+        {'ShardId': 'parent'},
+        {'ShardId': 'child', 'ParentShardId': 'parent'}
+    ])
+
+    assert await worker.heartbeat() == {'parent'}
+    await worker.finish('parent')
+    assert await worker.heartbeat() == {'child'}
+    assert worker.finished_shard_ids == {'parent'}
+
+
+@pytest.mark.asyncio
+async def test_consumers_split_shards():
+    fake_kinesis_client = FakeKinesisClient('lease-stream', shard_count=4)
+    for i in range(40):
+        fake_kinesis_client.put_record(
+            StreamName='lease-stream',
+            Data=str(i),
+            PartitionKey=str(i)
+        )
+    transport = InlineTransport(fake_kinesis_client)
+    loop = asyncio.get_event_loop()
+    lease_store = MemoryLeaseStore()
+    checkpointer = MemoryCheckpointer()
+
+    def create_consumer(worker_id):
+        return AIOKinesisConsumer(
+            'lease-stream',
+            loop,
+            shard_iterator_type='TRIM_HORIZON',
+            transport=transport,
+            checkpointer=checkpointer,
+            lease_store=lease_store,
+            worker_id=worker_id,
+            lease_duration=0.06
+        )
+
+    consumer_a = create_consumer('a')
+    consumer_b = create_consumer('b')
+    await consumer_a.start()
+    await consumer_b.start()
+
+    # Give consumer b time to steal its share
+    await asyncio.sleep(0.2)
+    assert len(consumer_a._shard_readers) == 2
+    assert len(consumer_b._shard_readers) == 2
+    assert not set(consumer_a._shard_readers) & set(consumer_b._shard_readers)
+
+    # Once consumer a stops, consumer b takes over its shards
+    await consumer_a.stop()
+    await asyncio.sleep(0.1)
+    assert len(consumer_b._shard_readers) == 4
+    await consumer_b.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumers_close_shared_stores(tmp_path):
+    fake_kinesis_client = FakeKinesisClient('closing-stream', shard_count=2)
+    transport = InlineTransport(fake_kinesis_client)
+    loop = asyncio.get_event_loop()
+    checkpointer = SQLiteCheckpointer(loop, str(tmp_path / 'checkpoints.db'))
+    lease_store = SQLiteLeaseStore(loop, str(tmp_path / 'leases.db'))
+
+    def create_consumer(worker_id):
+        return AIOKinesisConsumer(
+            'closing-stream',
+            loop,
+            transport=transport,
+            checkpointer=checkpointer,
+            lease_store=lease_store,
+            worker_id=worker_id
+        )
+
+    consumer_a = create_consumer('a')
+    consumer_b = create_consumer('b')
+    await consumer_a.start()
+    await consumer_b.start()
+
+    # The stores stay open for the consumer still running
+    await consumer_a.stop()
+    assert await lease_store.list_leases('closing-stream')
+    await consumer_b.stop()
+    assert checkpointer._executor is None
+    assert lease_store._executor is None
+
+
+@pytest.mark.asyncio
+async def test_consumer_drops_prefetched_records_of_lost_shards():
+    fake_kinesis_client = FakeKinesisClient('lost-stream', shard_count=2)
+    for i in range(40):
+        fake_kinesis_client.put_record(
+            StreamName='lost-stream',
+            Data=str(i),
+            PartitionKey=str(i)
+        )
+    loop = asyncio.get_event_loop()
+    lease_store = MemoryLeaseStore()
+    consumer = AIOKinesisConsumer(
+        'lost-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        checkpointer=MemoryCheckpointer(),
+        lease_store=lease_store,
+        worker_id='a',
+        max_prefetch_records=100
+    )
+    await consumer.start()
+
+    # Both shards are fetched ahead
+    await asyncio.sleep(0.05)
+    assert len(consumer._batches) == 40
+
+    # Another consumer takes the lease of the first shard
+    key = ('lost-stream', 'shardId-000000000000')
+    lease = lease_store.leases[key]
+    lease_store.leases[key] = lease._replace(
+        owner='b',
+        counter=lease.counter + 1
+    )
+    await consumer._update_leases()
+
+    # Only the records of the shard still held are handed out
+    records = await consumer.getmany()
+    assert {record['ShardId'] for record in records} == \
+        {'shardId-000000000001'}
+    assert len(consumer._batches) == 0
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_consumer_drops_checkpoints_of_lost_shards():
+    fake_kinesis_client = FakeKinesisClient('handover-stream', shard_count=2)
+    for i in range(20):
+        fake_kinesis_client.put_record(
+            StreamName='handover-stream',
+            Data=str(i),
+            PartitionKey=str(i)
+        )
+    loop = asyncio.get_event_loop()
+    lease_store = MemoryLeaseStore()
+    checkpointer = MemoryCheckpointer()
+    consumer = AIOKinesisConsumer(
+        'handover-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        checkpointer=checkpointer,
+        auto_checkpoint=False,
+        lease_store=lease_store,
+        worker_id='a'
+    )
+    await consumer.start()
+
+    # Checkpoints of both shards wait to be written
+    records = await consumer.getmany()
+    records.extend(await consumer.getmany())
+    for record in records:
+        await consumer.checkpoint(record)
+    assert checkpointer.checkpoints == {}
+
+    # Another consumer takes the lease of the first shard
+    key = ('handover-stream', 'shardId-000000000000')
+    lease = lease_store.leases[key]
+    lease_store.leases[key] = lease._replace(
+        owner='b',
+        counter=lease.counter + 1
+    )
+    await consumer._update_leases()
+    await consumer.stop()
+
+    # Only the checkpoint of the shard still held is written
+    assert list(checkpointer.checkpoints) == [
+        ('handover-stream', 'shardId-000000000001')
+    ]
+
+
+@pytest.mark.asyncio
+async def test_consumer_keeps_leases_while_checkpointing():
+    fake_kinesis_client = FakeKinesisClient('held-stream', shard_count=2)
+    for i in range(10):
+        fake_kinesis_client.put_record(
+            StreamName='held-stream',
+            Data=str(i),
+            PartitionKey=str(i)
+        )
+    loop = asyncio.get_event_loop()
+    lease_store = MemoryLeaseStore()
+    checkpointer = MemoryCheckpointer()
+    consumer = AIOKinesisConsumer(
+        'held-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        checkpointer=checkpointer,
+        checkpoint_max_records=1,
+        lease_store=lease_store,
+        worker_id='a'
+    )
+    await consumer.start()
+
+    # Records are auto checkpointed as the next ones are requested
+    for _ in range(5):
+        record = await consumer.__anext__()
+    await consumer.checkpoint(record)
+    assert checkpointer.checkpoints
+
+    # Checkpoints don't hand the shards over
+    assert sorted(consumer._lease_coordinator.held) == [
+        'shardId-000000000000',
+        'shardId-000000000001'
+    ]
+    assert {lease.owner for lease in lease_store.leases.values()} == {'a'}
+
+    # Only stopping does
+    await consumer.stop()
+    assert {lease.owner for lease in lease_store.leases.values()} == {None}
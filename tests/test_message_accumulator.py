@@ -1,9 +1,14 @@
 import asyncio
+import json
 from time import time
 
 import pytest
 
-from aiokinesis.message_accumulator import Message, MessageAccumulator
+from aiokinesis.errors import BufferFullError
+from aiokinesis.message_accumulator import (
+    MAX_BATCH_RECORDS, MAX_BATCH_SIZE, MAX_RECORD_SIZE, Message,
+    MessageAccumulator
+)
 
 
 @pytest.mark.asyncio
@@ -20,13 +25,16 @@ async def test_add_message(partition_key, value):
     accumulator = MessageAccumulator(loop)
 
     # Add message
-    accumulator.add_message(partition_key, value)
+    future = accumulator.add_message(partition_key, json.dumps(value))
 
     # Check that message is the only thing in the accumulator's deque
     assert len(accumulator._accumulated_messages) == 1
     only_message = accumulator._accumulated_messages[0]
     assert only_message.partition_key
-    assert only_message.value == value
+    assert only_message.value == json.dumps(value)
+    assert only_message.future is future
+    assert not future.done()
+    assert accumulator._accumulated_size == only_message.size
 
 
 @pytest.mark.asyncio
@@ -43,15 +51,17 @@ async def test_anext_one_message(partition_key, value):
     accumulator = MessageAccumulator(loop)
 
     # Add message
-    accumulator.add_message(partition_key, value)
+    accumulator.add_message(partition_key, json.dumps(value))
 
-    # Consume one message
-    message = await accumulator.__anext__()
+    # Consume one batch
+    batch = await accumulator.__anext__()
 
     # Check that we got our message back
+    assert len(batch) == 1
+    message = batch[0]
     assert type(message) == Message
     assert message.partition_key == partition_key
-    assert message.value == value
+    assert message.value == json.dumps(value)
 
 
 @pytest.mark.asyncio
@@ -76,19 +86,23 @@ async def test_anext_multiple_messages(partition_key, value):
         (5, {}),
     )
     for k, v in messages:
-        accumulator.add_message(k, v)
+        accumulator.add_message(k, json.dumps(v))
 
     # Add last message
-    accumulator.add_message(partition_key, value)
+    accumulator.add_message(partition_key, json.dumps(value))
 
-    # Consume one message
-    message = await accumulator.__anext__()
+    # Consume one batch
+    batch = await accumulator.__anext__()
 
-    # Check that we got the first message
-    first_message = messages[0]
-    assert type(message) == Message
-    assert message.partition_key == first_message[0]
-    assert message.value == first_message[1]
+    # Check that we got all messages in the order they were added
+    assert len(batch) == len(messages) + 1
+    for message, (k, v) in zip(batch, messages):
+        assert type(message) == Message
+        assert message.partition_key == k
+        assert message.value == json.dumps(v)
+    assert batch[-1].partition_key == partition_key
+    assert batch[-1].value == json.dumps(value)
+    assert accumulator._accumulated_size == 0
 
 
 @pytest.mark.asyncio
@@ -107,35 +121,183 @@ async def test_anext_empty():
 
 
 @pytest.mark.asyncio
-async def test_rate_limit():
+async def test_no_rate_limit():
     # Create message accumulator
     loop = asyncio.get_event_loop()
     accumulator = MessageAccumulator(loop)
 
-    message_count = 50
-    # Fill accumulator with 50 messages
-    for i in range(message_count):
-        accumulator.add_message(i, {})
+    # Rate limits are applied per shard by the producer, so batches should
+    # be yielded as fast as messages come in
+    start_time = float(time())
+    for i in range(50):
+        accumulator.add_message(i, '{}')
+        batch = await accumulator.__anext__()
+        assert len(batch) == 1
+    assert float(time()) - start_time < 0.1
 
-    message_yield_times = []
-    # Empty accumulator
-    async for message in accumulator:
-        current_time = float(time())
-        message_yield_times.append(current_time)
-        assert type(message) == Message
 
-        # Check if accumulator is empty
-        if len(message_yield_times) == message_count - 1:
-            break
-
-    yields_per_rolling_sec = 5
-    # Verify that we never make more than 5 yields per rolling second
-    # and that we're making almost 5 yields per rolling second
-    for i, yield_time in enumerate(message_yield_times):
-        if i < yields_per_rolling_sec:
-            continue
-
-        prev_i = i - yields_per_rolling_sec
-        prev_yield_time = message_yield_times[prev_i]
-        assert yield_time - prev_yield_time > 1
-        assert yield_time - prev_yield_time < 1.5
+@pytest.mark.asyncio
+async def test_batch_record_limit():
+    # Create message accumulator
+    loop = asyncio.get_event_loop()
+    accumulator = MessageAccumulator(loop)
+
+    # Add more messages than fit into a single PutRecords request
+    for i in range(MAX_BATCH_RECORDS + 10):
+        accumulator.add_message(i, '{}')
+
+    # Batches should be packed up to the record limit
+    first_batch = await accumulator.__anext__()
+    second_batch = await accumulator.__anext__()
+    assert len(first_batch) == MAX_BATCH_RECORDS
+    assert len(second_batch) == 10
+    assert second_batch[0].partition_key == MAX_BATCH_RECORDS
+
+
+@pytest.mark.asyncio
+async def test_batch_size_limit():
+    # Create message accumulator
+    loop = asyncio.get_event_loop()
+    accumulator = MessageAccumulator(loop)
+
+    # Add messages which add up to more than 5 MiB
+    value = 'a' * (MAX_RECORD_SIZE - 1)
+    for i in range(6):
+        accumulator.add_message(i, value)
+
+    # Batches should never exceed the request size limit
+    first_batch = await accumulator.__anext__()
+    second_batch = await accumulator.__anext__()
+    assert len(first_batch) == 5
+    assert sum(message.size for message in first_batch) <= MAX_BATCH_SIZE
+    assert len(second_batch) == 1
+
+
+def test_add_message_too_large():
+    # Create message accumulator
+    loop = asyncio.new_event_loop()
+    accumulator = MessageAccumulator(loop)
+
+    # Records over 1 MiB are rejected by kinesis
+    with pytest.raises(ValueError):
+        accumulator.add_message('key', 'a' * MAX_RECORD_SIZE)
+    assert len(accumulator._accumulated_messages) == 0
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_linger_time():
+    # Create message accumulator that lingers for 0.5 seconds
+    loop = asyncio.get_event_loop()
+    accumulator = MessageAccumulator(loop, linger_time=0.5)
+
+    async def add_messages_later():
+        await asyncio.sleep(0.1)
+        accumulator.add_message(2, '{}')
+        accumulator.add_message(3, '{}')
+
+    # Messages added while lingering should join the batch
+    accumulator.add_message(1, '{}')
+    asyncio.ensure_future(add_messages_later())
+    start_time = loop.time()
+    batch = await accumulator.__anext__()
+    assert loop.time() - start_time >= 0.5
+    assert [message.partition_key for message in batch] == [1, 2, 3]
+
+
+@pytest.mark.parametrize('max_buffered_records, max_buffered_bytes', [
+    (3, None),
+    (None, 3 * (1 + len('{}'))),
+])
+def test_add_message_buffer_full(max_buffered_records, max_buffered_bytes):
+    # Create message accumulator which fits three messages
+    loop = asyncio.new_event_loop()
+    accumulator = MessageAccumulator(
+        loop,
+        max_buffered_records=max_buffered_records,
+        max_buffered_bytes=max_buffered_bytes
+    )
+
+    for i in range(3):
+        accumulator.add_message(i, '{}')
+
+    # The fourth message should be rejected
+    with pytest.raises(BufferFullError):
+        accumulator.add_message(3, '{}')
+    assert len(accumulator._accumulated_messages) == 3
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_space():
+    # Create message accumulator which fits one message
+    loop = asyncio.get_event_loop()
+    accumulator = MessageAccumulator(loop, max_buffered_records=1)
+    accumulator.add_message(1, '{}')
+
+    # Waiting for space should only finish once the buffer is drained
+    wait_future = asyncio.ensure_future(accumulator.wait_for_space())
+    await asyncio.sleep(0.1)
+    assert not wait_future.done()
+
+    await accumulator.__anext__()
+    await asyncio.wait_for(wait_future, timeout=1)
+    accumulator.add_message(2, '{}')
+
+
+def test_drain():
+    # Create message accumulator
+    loop = asyncio.new_event_loop()
+    accumulator = MessageAccumulator(loop)
+    for i in range(10):
+        accumulator.add_message(i, '{}')
+
+    # Messages are drained oldest first within the limits
+    message_size = 1 + len('{}')
+    assert [m.partition_key for m in accumulator.drain(max_records=3)] == \
+        [0, 1, 2]
+    assert [
+        m.partition_key
+        for m in accumulator.drain(max_bytes=2 * message_size + 1)
+    ] == [3, 4]
+    assert [m.partition_key for m in accumulator.drain()] == \
+        [5, 6, 7, 8, 9]
+    assert accumulator._accumulated_size == 0
+    assert accumulator.drain() == []
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_linger_ends_once_batch_is_full():
+    # Create message accumulator that lingers for a long time
+    loop = asyncio.get_event_loop()
+    accumulator = MessageAccumulator(loop, linger_time=10)
+    accumulator.add_message(0, '{}')
+    anext_future = asyncio.ensure_future(accumulator.__anext__())
+    await asyncio.sleep(0.01)
+
+    # Filling the batch should end the linger right away
+    for i in range(1, MAX_BATCH_RECORDS + 1):
+        accumulator.add_message(i, '{}')
+    batch = await asyncio.wait_for(anext_future, timeout=1)
+    assert len(batch) == MAX_BATCH_RECORDS
+    assert len(accumulator._accumulated_messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_wait_for_space_wakes_every_waiter():
+    # Create message accumulator which fits one message
+    loop = asyncio.get_event_loop()
+    accumulator = MessageAccumulator(loop, max_buffered_records=1)
+    accumulator.add_message(1, '{}')
+
+    waiters = [
+        asyncio.ensure_future(accumulator.wait_for_space())
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0.01)
+
+    # A cancelled waiter doesn't affect the others
+    waiters[0].cancel()
+    accumulator.drain()
+    await asyncio.wait_for(asyncio.gather(*waiters[1:]), timeout=1)
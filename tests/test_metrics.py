@@ -0,0 +1,181 @@
+import asyncio
+
+from botocore.exceptions import ClientError
+from mock import MagicMock
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, AIOKinesisProducer
+from aiokinesis.metrics import (
+    MetricsSink, PrometheusMetricsSink, StatsdMetricsSink
+)
+from aiokinesis.rate_limiter import RateLimiter
+from aiokinesis.retry import RetryPolicy
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+class RecordingMetricsSink(MetricsSink):
+    def __init__(self):
+        self.reported = []
+
+    def _record(self, kind, name, value, tags):
+        self.reported.append((kind, name, value, tags))
+
+    def increment(self, name, value=1, tags=None):
+        self._record('increment', name, value, tags)
+
+    def gauge(self, name, value, tags=None):
+        self._record('gauge', name, value, tags)
+
+    def observe(self, name, value, tags=None):
+        self._record('observe', name, value, tags)
+
+    def timing(self, name, seconds, tags=None):
+        self._record('timing', name, seconds, tags)
+
+    def values(self, name):
+        return [value for _, n, value, _ in self.reported if n == name]
+
+    def tags(self, name):
+        return [tags for _, n, _, tags in self.reported if n == name]
+
+
+@pytest.mark.asyncio
+async def test_producer_reports_metrics():
+    fake_kinesis_client = FakeKinesisClient('metrics-stream')
+    metrics = RecordingMetricsSink()
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'metrics-stream',
+        loop,
+        linger_time=0.05,
+        transport=InlineTransport(fake_kinesis_client),
+        metrics=metrics
+    )
+    await producer.start()
+    futures = [await producer.send(str(i), {}) for i in range(3)]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    shard_tags = {'stream': 'metrics-stream', 'shard': 'shardId-000000000000'}
+    assert sum(metrics.values('producer.records_sent')) == 3
+    assert metrics.values('producer.batch_records') == [3]
+    assert metrics.tags('producer.put_records_latency') == [shard_tags]
+    assert max(metrics.values('accumulator.buffered_records')) == 3
+    assert metrics.values('accumulator.buffered_records')[-1] == 0
+
+
+@pytest.mark.asyncio
+async def test_producer_reports_dropped_records():
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.list_shards.return_value = {'Shards': []}
+    mock_kinesis_client.put_records.side_effect = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}},
+        'PutRecords'
+    )
+    metrics = RecordingMetricsSink()
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'metrics-stream',
+        loop,
+        transport=InlineTransport(mock_kinesis_client),
+        retry_policy=RetryPolicy(max_retries=1, base_delay=0.01),
+        metrics=metrics
+    )
+    await producer.start()
+    future = await producer.send('a', {})
+    await asyncio.sleep(0.1)
+    await producer.stop()
+
+    assert future.exception() is not None
+    assert metrics.values('producer.request_errors') == [1, 1]
+    assert metrics.values('producer.records_retried') == [1]
+    assert metrics.values('producer.records_dropped') == [1]
+    assert metrics.values('producer.records_sent') == []
+
+
+@pytest.mark.asyncio
+async def test_consumer_reports_metrics():
+    fake_kinesis_client = FakeKinesisClient('metrics-stream')
+    for i in range(5):
+        fake_kinesis_client.put_record(
+            StreamName='metrics-stream',
+            Data=str(i),
+            PartitionKey='key'
+        )
+    metrics = RecordingMetricsSink()
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'metrics-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        metrics=metrics
+    )
+    await consumer.start()
+    records = await consumer.getmany()
+    await consumer.stop()
+
+    assert len(records) == 5
+    assert sum(metrics.values('consumer.records_received')) == 5
+    assert metrics.values('consumer.millis_behind_latest')[0] == 0
+    assert metrics.values('consumer.get_records_latency')
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_reports_waits():
+    metrics = RecordingMetricsSink()
+    rate_limiter = RateLimiter(
+        requests_per_second=1,
+        metrics=metrics,
+        tags={'shard': 'a'}
+    )
+
+    # Only waiting is reported
+    assert await rate_limiter.acquire() == 0
+    assert metrics.reported == []
+
+    # Make the first request look older so the test doesn't wait a second
+    entries = rate_limiter._requests._entries
+    entries[0] = (entries[0][0] - 0.9, entries[0][1])
+    waited = await rate_limiter.acquire()
+    assert waited > 0
+    assert metrics.reported == [
+        ('timing', 'rate_limiter.wait', waited, {'shard': 'a'})
+    ]
+
+
+def test_statsd_metrics_sink():
+    client = MagicMock()
+    metrics = StatsdMetricsSink(client)
+
+    tags = {'shard': 's', 'stream': 'x'}
+    metrics.increment('producer.records_sent', 3, tags)
+    metrics.gauge('accumulator.buffered_records', 10)
+    metrics.timing('producer.put_records_latency', 0.25)
+
+    client.incr.assert_called_once_with('producer.records_sent.s.x', 3)
+    client.gauge.assert_called_once_with('accumulator.buffered_records', 10)
+    client.timing.assert_called_once_with('producer.put_records_latency', 250)
+
+
+def test_prometheus_metrics_sink():
+    prometheus_client = pytest.importorskip('prometheus_client')
+    registry = prometheus_client.CollectorRegistry()
+    metrics = PrometheusMetricsSink(registry=registry)
+
+    tags = {'stream': 'x', 'shard': 's'}
+    metrics.increment('producer.records_sent', 3, tags)
+    metrics.increment('producer.records_sent', 2, tags)
+    metrics.timing('producer.put_records_latency', 0.25, tags)
+
+    assert registry.get_sample_value(
+        'aiokinesis_producer_records_sent_total',
+        tags
+    ) == 5
+    assert registry.get_sample_value(
+        'aiokinesis_producer_put_records_latency_seconds_count',
+        tags
+    ) == 1
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from aiokinesis.prefetch_buffer import PrefetchBuffer
+
+
+def records(count, data=b'x'):
+    return [{'Data': data} for _ in range(count)]
+
+
+async def has_space(buffer):
+    try:
+        await asyncio.wait_for(buffer.wait_for_space(), timeout=0.05)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+@pytest.mark.asyncio
+async def test_prefetch_buffer_stops_at_max_records():
+    loop = asyncio.get_event_loop()
+    buffer = PrefetchBuffer(loop, max_records=3)
+
+    buffer.put(records(2), 'shard-1')
+    assert await has_space(buffer)
+
+    # A response may go over the bound, but no more are fetched
+    buffer.put(records(2), 'shard-1')
+    assert len(buffer) == 4
+    assert not await has_space(buffer)
+
+    # Fetching resumes once records are taken
+    waiter = asyncio.ensure_future(buffer.wait_for_space())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    assert len(await buffer.get()) == 2
+    await asyncio.wait_for(waiter, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_prefetch_buffer_stops_at_max_bytes():
+    loop = asyncio.get_event_loop()
+    buffer = PrefetchBuffer(loop, max_bytes=10)
+
+    buffer.put(records(1, b'x' * 6), 'shard-1')
+    assert await has_space(buffer)
+    buffer.put(records(1, b'x' * 6), 'shard-2')
+    assert buffer.size == 12
+    assert not await has_space(buffer)
+
+    # Taking the oldest list of records makes room again
+    assert (await buffer.get())[0]['Data'] == b'x' * 6
+    assert buffer.size == 6
+    assert await has_space(buffer)
+
+
+@pytest.mark.asyncio
+async def test_prefetch_buffer_stops_at_max_batches():
+    loop = asyncio.get_event_loop()
+    buffer = PrefetchBuffer(loop, max_batches=1)
+
+    buffer.put(records(1), 'shard-1')
+    assert not await has_space(buffer)
+    await buffer.get()
+    assert await has_space(buffer)
+
+
+@pytest.mark.asyncio
+async def test_prefetch_buffer_takes_errors_when_full():
+    loop = asyncio.get_event_loop()
+    buffer = PrefetchBuffer(loop, max_records=1)
+
+    buffer.put(records(1), 'shard-1')
+    error = ValueError('shard failed')
+    buffer.put(error)
+
+    # Errors don't count against the bounds and come after earlier records
+    assert len(buffer) == 1
+    assert len(await buffer.get()) == 1
+    assert await buffer.get() is error
+
+
+@pytest.mark.asyncio
+async def test_prefetch_buffer_get_waits_for_records():
+    loop = asyncio.get_event_loop()
+    buffer = PrefetchBuffer(loop)
+
+    getter = asyncio.ensure_future(buffer.get())
+    await asyncio.sleep(0)
+    assert not getter.done()
+
+    batch = records(1)
+    buffer.put(batch, 'shard-1')
+    assert await asyncio.wait_for(getter, timeout=1) is batch
+
+
+@pytest.mark.asyncio
+async def test_prefetch_buffer_removes_shard():
+    loop = asyncio.get_event_loop()
+    buffer = PrefetchBuffer(loop, max_records=2)
+
+    first, second, third = records(1), records(1), records(1)
+    buffer.put(first, 'shard-1')
+    buffer.put(second, 'shard-2')
+    buffer.put(third, 'shard-1')
+    assert not await has_space(buffer)
+
+    # Only the records of other shards are left, and there is room again
+    buffer.remove('shard-1')
+    assert len(buffer) == 1
+    assert await has_space(buffer)
+    assert await buffer.get() is second
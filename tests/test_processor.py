@@ -0,0 +1,173 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import random
+
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, RecordProcessor
+from aiokinesis.checkpoint import Checkpoint, MemoryCheckpointer
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def create_consumer(stream_name, record_count, key_count,
+                    checkpointer=None):
+    fake_kinesis_client = FakeKinesisClient(stream_name)
+    for i in range(record_count):
+        fake_kinesis_client.put_record(
+            StreamName=stream_name,
+            Data=str(i),
+            PartitionKey=str(i % key_count)
+        )
+    return AIOKinesisConsumer(
+        stream_name,
+        asyncio.get_event_loop(),
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        checkpointer=checkpointer,
+        auto_checkpoint=False,
+        checkpoint_max_records=1
+    )
+
+
+@pytest.mark.asyncio
+async def test_processor_keeps_key_order():
+    consumer = create_consumer('order-stream', 100, 5)
+    await consumer.start()
+
+    handled = {}
+    running = set()
+    max_running = 0
+
+    async def handler(record):
+        nonlocal max_running
+        key = record['PartitionKey']
+        assert key not in running
+        running.add(key)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(random.random() / 100)
+        running.remove(key)
+        handled.setdefault(key, []).append(int(record['Data']))
+        if sum(map(len, handled.values())) == 100:
+            processor.stop()
+
+    processor = RecordProcessor(
+        consumer,
+        handler,
+        asyncio.get_event_loop(),
+        concurrency=3
+    )
+    await asyncio.wait_for(processor.run(), timeout=5)
+    await consumer.stop()
+
+    # Keys are handled concurrently, each in the order it was written
+    assert max_running == 3
+    for key, numbers in handled.items():
+        assert numbers == list(range(int(key), 100, 5))
+
+
+@pytest.mark.asyncio
+async def test_processor_checkpoints_after_earlier_records():
+    checkpointer = MemoryCheckpointer()
+    consumer = create_consumer('gap-stream', 10, 10, checkpointer)
+    await consumer.start()
+
+    first_record = asyncio.Event()
+    handled = []
+
+    async def handler(record):
+        # The first record finishes last
+        if record['Data'] == b'0':
+            await first_record.wait()
+        handled.append(record)
+
+    processor = RecordProcessor(
+        consumer,
+        handler,
+        asyncio.get_event_loop()
+    )
+    task = asyncio.ensure_future(processor.run())
+    while len(handled) < 9:
+        await asyncio.sleep(0.01)
+    assert checkpointer.checkpoints == {}
+
+    # Every record of the shard is done once the first one is
+    first_record.set()
+    await asyncio.sleep(0.01)
+    last = handled[-1]
+    assert last['Data'] == b'0'
+    assert checkpointer.checkpoints == {
+        ('gap-stream', 'shardId-000000000000'):
+            Checkpoint(max(r['SequenceNumber'] for r in handled), None)
+    }
+
+    processor.stop()
+    await task
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_processor_runs_functions_on_executor():
+    consumer = create_consumer('executor-stream', 20, 4)
+    await consumer.start()
+
+    handled = []
+
+    def handler(record):
+        handled.append(int(record['Data']))
+        if len(handled) == 20:
+            loop.call_soon_threadsafe(processor.stop)
+
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(4) as executor:
+        processor = RecordProcessor(
+            consumer,
+            handler,
+            loop,
+            concurrency=4,
+            executor=executor
+        )
+        await asyncio.wait_for(processor.run(), timeout=5)
+    await consumer.stop()
+    assert sorted(handled) == list(range(20))
+
+
+@pytest.mark.asyncio
+async def test_processor_stops_on_handler_error():
+    checkpointer = MemoryCheckpointer()
+    consumer = create_consumer('error-stream', 10, 1, checkpointer)
+    await consumer.start()
+
+    handled = []
+
+    async def handler(record):
+        if record['Data'] == b'3':
+            raise ValueError('bad record')
+        handled.append(record)
+
+    processor = RecordProcessor(
+        consumer,
+        handler,
+        asyncio.get_event_loop()
+    )
+    with pytest.raises(ValueError):
+        await asyncio.wait_for(processor.run(), timeout=5)
+    await consumer.stop()
+
+    # Records after the failed one are neither handled nor checkpointed
+    assert [r['Data'] for r in handled] == [b'0', b'1', b'2']
+    assert checkpointer.checkpoints == {
+        ('error-stream', 'shardId-000000000000'):
+            Checkpoint(handled[-1]['SequenceNumber'], None)
+    }
+
+
+@pytest.mark.asyncio
+async def test_processor_requires_explicit_checkpoints():
+    consumer = AIOKinesisConsumer(
+        'auto-stream',
+        asyncio.get_event_loop(),
+        transport=InlineTransport(FakeKinesisClient('auto-stream')),
+        checkpointer=MemoryCheckpointer()
+    )
+    with pytest.raises(ValueError):
+        RecordProcessor(consumer, None, None)
@@ -1,10 +1,30 @@
 import asyncio
 import json
 
+from botocore.exceptions import ClientError
 from mock import MagicMock, patch
 import pytest
 
 from aiokinesis import AIOKinesisProducer
+from aiokinesis.producer import RecordMetadata
+from aiokinesis.errors import (
+    BufferFullError, DeliveryTimeoutError, RecordError
+)
+from aiokinesis.retry import RetryPolicy
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def mock_list_shards():
+    return {
+        'Shards': [{
+            'ShardId': 'shardId-000000000000',
+            'HashKeyRange': {
+                'StartingHashKey': '0',
+                'EndingHashKey': str(2 ** 128 - 1),
+            },
+            'SequenceNumberRange': {'StartingSequenceNumber': '0'},
+        }]
+    }
 
 
 @pytest.mark.asyncio
@@ -15,6 +35,9 @@ from aiokinesis import AIOKinesisProducer
 ])
 async def test_producer_start(stream_name, region_name):
     with patch('boto3.client') as mock_boto3_client:
+        mock_boto3_client.return_value.list_shards.return_value = \
+            mock_list_shards()
+
         # Instantiate consumer
         loop = asyncio.get_event_loop()
         producer = AIOKinesisProducer(
@@ -44,7 +67,10 @@ async def test_producer_start(stream_name, region_name):
     ('cat', 'abceadsasdfnoaisdnfoasindfaos', []),
 ])
 async def test_producer_add_message(stream_name, partition_key, value):
-    with patch('boto3.client'):
+    with patch('boto3.client') as mock_boto3_client:
+        mock_boto3_client.return_value.list_shards.return_value = \
+            mock_list_shards()
+
         # Instantiate consumer
         loop = asyncio.get_event_loop()
         producer = AIOKinesisProducer(
@@ -79,6 +105,7 @@ async def test_producer_send_message(stream_name, partition_key, value):
     with patch('boto3.client') as mock_boto3_client:
         # Setup mock
         mock_kinesis_client = MagicMock()
+        mock_kinesis_client.list_shards.return_value = mock_list_shards()
         mock_boto3_client.return_value = mock_kinesis_client
 
         # Instantiate consumer
@@ -97,17 +124,21 @@ async def test_producer_send_message(stream_name, partition_key, value):
         # Wait for the sender routine
         await asyncio.sleep(0.1)
 
-        mock_kinesis_client.put_record.assert_called_once_with(
+        mock_kinesis_client.put_records.assert_called_once_with(
             StreamName=stream_name,
-            Data=json.dumps(value),
-            PartitionKey=partition_key
+            Records=[{
+                'Data': json.dumps(value),
+                'PartitionKey': partition_key
+            }]
         )
         await producer.stop()
 
 
 @pytest.mark.asyncio
 async def test_producer_send_message_done_callback(mocker):
-    mocker.patch('boto3.client')
+    mock_boto3_client = mocker.patch('boto3.client')
+    mock_boto3_client.return_value.list_shards.return_value = \
+        mock_list_shards()
     loop = asyncio.get_event_loop()
     producer = AIOKinesisProducer(
         'test1',
@@ -125,3 +156,539 @@ async def test_producer_send_message_done_callback(mocker):
 
     mock_complete_produce.assert_called_once()
     await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_send_batch():
+    with patch('boto3.client') as mock_boto3_client:
+        # Setup mock
+        mock_kinesis_client = MagicMock()
+        mock_kinesis_client.list_shards.return_value = mock_list_shards()
+        mock_boto3_client.return_value = mock_kinesis_client
+
+        # Instantiate producer with a linger time
+        loop = asyncio.get_event_loop()
+        producer = AIOKinesisProducer(
+            'test1',
+            loop,
+            linger_time=0.1
+        )
+
+        # Start producer
+        await producer.start()
+
+        # Send stuff
+        for i in range(10):
+            await producer.send(str(i), {'i': i})
+
+        # Wait for the sender routine
+        await asyncio.sleep(0.3)
+
+        # All messages should be sent in a single request
+        mock_kinesis_client.put_records.assert_called_once()
+        records = mock_kinesis_client.put_records.call_args[1]['Records']
+        assert [r['PartitionKey'] for r in records] == \
+            [str(i) for i in range(10)]
+        await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_routes_records_to_shards():
+    # Setup a stream with four shards
+    fake_kinesis_client = FakeKinesisClient('routing-stream', shard_count=4)
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'routing-stream',
+        loop,
+        linger_time=0.1,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+
+    # Send stuff
+    for i in range(100):
+        await producer.send(str(i), {'i': i})
+    await asyncio.sleep(0.3)
+
+    # Every request should only contain records for a single shard
+    assert fake_kinesis_client.calls.count('put_records') == 4
+    for shard in fake_kinesis_client.shards:
+        for record in shard.records:
+            shard_id = producer._shard_map.shard_for(record['PartitionKey'])
+            assert shard_id == shard.shard_id
+    assert sum(len(shard.records) for shard in fake_kinesis_client.shards) \
+        == 100
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_hot_shard_does_not_throttle_others():
+    # Setup a stream with two shards
+    fake_kinesis_client = FakeKinesisClient('hot-shard-stream', shard_count=2)
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'hot-shard-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+
+    # Find partition keys for each shard
+    hot_shard, cold_shard = producer._shard_map.shard_ids
+    hot_keys = [
+        str(i) for i in range(10000)
+        if producer._shard_map.shard_for(str(i)) == hot_shard
+    ]
+    cold_keys = [
+        str(i) for i in range(10000)
+        if producer._shard_map.shard_for(str(i)) == cold_shard
+    ]
+
+    # Send more to the hot shard than it can take in one second
+    for key in hot_keys[:1500]:
+        await producer.send(key, {})
+    await asyncio.sleep(0.1)
+    for key in cold_keys[:10]:
+        await producer.send(key, {})
+    await asyncio.sleep(0.3)
+
+    # The hot shard is limited to 1000 records per second while the cold
+    # shard's records go through right away
+    hot_records, cold_records = [
+        fake_kinesis_client.shards[i].records for i in range(2)
+    ]
+    assert len(hot_records) == 1000
+    assert len(cold_records) == 10
+
+    await asyncio.sleep(1)
+    assert len(hot_records) == 1500
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_stays_within_shard_limits():
+    fake_kinesis_client = FakeKinesisClient(
+        'limited-stream',
+        enforce_limits=True
+    )
+    put_records = fake_kinesis_client.put_records
+    failed_record_counts = []
+
+    def counting_put_records(**kwargs):
+        response = put_records(**kwargs)
+        failed_record_counts.append(response['FailedRecordCount'])
+        return response
+    fake_kinesis_client.put_records = counting_put_records
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'limited-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+    futures = [await producer.send(str(i), {}) for i in range(1200)]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    # Kinesis would never have throttled the producer
+    assert len(fake_kinesis_client.shards[0].records) == 1200
+    assert set(failed_record_counts) == {0}
+
+
+@pytest.mark.asyncio
+async def test_producer_batches_fit_shard_write_budget():
+    fake_kinesis_client = FakeKinesisClient(
+        'large-stream',
+        enforce_limits=True
+    )
+    put_records = fake_kinesis_client.put_records
+    batch_sizes = []
+    failed_record_counts = []
+
+    def recording_put_records(**kwargs):
+        batch_sizes.append(sum(
+            len(record['Data']) + len(record['PartitionKey'])
+            for record in kwargs['Records']
+        ))
+        response = put_records(**kwargs)
+        failed_record_counts.append(response['FailedRecordCount'])
+        return response
+    fake_kinesis_client.put_records = recording_put_records
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'large-stream',
+        loop,
+        linger_time=0.1,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+    futures = [
+        await producer.send(str(i), b'x' * 300 * 1024) for i in range(8)
+    ]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    # No batch is larger than a shard takes in one second
+    assert len(batch_sizes) == 3
+    assert max(batch_sizes) <= 1024 * 1024
+    assert set(failed_record_counts) == {0}
+
+
+@pytest.mark.asyncio
+async def test_producer_refreshes_shards_after_resharding():
+    fake_kinesis_client = FakeKinesisClient('reshard-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'reshard-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 127)
+
+    # Records written to other shards than expected reveal the split
+    await producer.send_and_wait('a', {})
+    await asyncio.sleep(0.01)
+    assert producer._shard_map.shard_ids == [
+        'shardId-000000000001',
+        'shardId-000000000002'
+    ]
+    await producer.stop()
+
+
+def put_records_response(*error_codes):
+    return {
+        'FailedRecordCount': len([c for c in error_codes if c]),
+        'Records': [
+            {'ErrorCode': c, 'ErrorMessage': 'oops'} if c
+            else {'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'}
+            for c in error_codes
+        ],
+    }
+
+
+@pytest.mark.asyncio
+async def test_producer_retries_failed_records():
+    # Setup mock which throttles the second record once
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.list_shards.return_value = mock_list_shards()
+    mock_kinesis_client.put_records.side_effect = [
+        put_records_response(
+            None,
+            'ProvisionedThroughputExceededException',
+            None
+        ),
+        put_records_response(None),
+    ]
+    on_dropped = MagicMock()
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'retry-stream',
+        loop,
+        linger_time=0.05,
+        transport=InlineTransport(mock_kinesis_client),
+        retry_policy=RetryPolicy(base_delay=0.01),
+        on_dropped=on_dropped
+    )
+    await producer.start()
+
+    for key in ['a', 'b', 'c']:
+        await producer.send(key, {})
+    await asyncio.sleep(0.2)
+
+    # Only the failed record should be sent again
+    first_call, second_call = mock_kinesis_client.put_records.call_args_list
+    assert [r['PartitionKey'] for r in first_call[1]['Records']] == \
+        ['a', 'b', 'c']
+    assert [r['PartitionKey'] for r in second_call[1]['Records']] == ['b']
+    on_dropped.assert_not_called()
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_drops_records_after_max_retries():
+    # Setup mock which always throttles
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.list_shards.return_value = mock_list_shards()
+    mock_kinesis_client.put_records.side_effect = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}},
+        'PutRecords'
+    )
+    on_dropped = MagicMock()
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'retry-stream',
+        loop,
+        transport=InlineTransport(mock_kinesis_client),
+        retry_policy=RetryPolicy(max_retries=2, base_delay=0.01),
+        on_dropped=on_dropped
+    )
+    await producer.start()
+
+    future = await producer.send('a', {})
+    await asyncio.sleep(0.2)
+
+    # The record should be tried three times and then dropped
+    assert mock_kinesis_client.put_records.call_count == 3
+    on_dropped.assert_called_once()
+    message, error = on_dropped.call_args[0]
+    assert message.partition_key == 'a'
+    assert isinstance(error, ClientError)
+    assert future.exception() is error
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_drops_records_with_permanent_errors():
+    # Setup mock which rejects one record for good
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.list_shards.return_value = mock_list_shards()
+    mock_kinesis_client.put_records.return_value = put_records_response(
+        'KMSAccessDeniedException',
+        None
+    )
+    on_dropped = MagicMock()
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'retry-stream',
+        loop,
+        linger_time=0.05,
+        transport=InlineTransport(mock_kinesis_client),
+        on_dropped=on_dropped
+    )
+    await producer.start()
+
+    future_a = await producer.send('a', {})
+    future_b = await producer.send('b', {})
+    await asyncio.sleep(0.2)
+
+    # The rejected record should be dropped without a retry
+    mock_kinesis_client.put_records.assert_called_once()
+    message, error = on_dropped.call_args[0]
+    assert message.partition_key == 'a'
+    assert isinstance(error, RecordError)
+    assert error.error_code == 'KMSAccessDeniedException'
+    with pytest.raises(RecordError):
+        await future_a
+    assert (await future_b).sequence_number == '1'
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_send_blocks_when_buffer_full():
+    # Setup a producer which can only buffer two records and make one slow
+    # request at a time
+    fake_kinesis_client = FakeKinesisClient('backpressure-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'backpressure-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client, delay=0.2),
+        max_buffered_records=2,
+        max_in_flight_requests=1
+    )
+    await producer.start()
+
+    # The first record is in flight, the next two stay buffered while the
+    # sender waits for the request to finish and the fourth has to wait
+    await producer.send('1', {})
+    await asyncio.sleep(0.05)
+    await producer.send('2', {})
+    await producer.send('3', {})
+    start_time = loop.time()
+    await producer.send('4', {})
+    assert loop.time() - start_time >= 0.1
+
+    await asyncio.sleep(0.5)
+    await producer.stop()
+    assert len(fake_kinesis_client.shards[0].records) == 4
+
+
+@pytest.mark.asyncio
+async def test_producer_send_raises_when_buffer_full():
+    # Setup a producer which can only buffer one record and make one slow
+    # request at a time
+    fake_kinesis_client = FakeKinesisClient('backpressure-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'backpressure-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client, delay=0.2),
+        max_buffered_records=1,
+        buffer_full_policy='raise',
+        max_in_flight_requests=1
+    )
+    await producer.start()
+
+    await producer.send('1', {})
+    await asyncio.sleep(0.05)
+    await producer.send('2', {})
+    with pytest.raises(BufferFullError):
+        await producer.send('3', {})
+
+    await asyncio.sleep(0.5)
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_max_in_flight_requests():
+    # Setup a stream where every request takes a while
+    fake_kinesis_client = FakeKinesisClient('in-flight-stream')
+    transport = InlineTransport(fake_kinesis_client, delay=0.1)
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'in-flight-stream',
+        loop,
+        transport=transport,
+        max_in_flight_requests=2
+    )
+    await producer.start()
+
+    # Send records one by one so that each one gets its own request
+    for i in range(6):
+        await producer.send(str(i), {})
+        await asyncio.sleep(0)
+
+    # Only two requests should be in flight at once
+    await asyncio.sleep(0.05)
+    assert len(producer._outstanding_tasks) == 2
+    await asyncio.sleep(0.4)
+    assert len(fake_kinesis_client.shards[0].records) == 6
+    await producer.stop()
+
+
+def test_producer_invalid_buffer_full_policy():
+    loop = asyncio.new_event_loop()
+    with pytest.raises(ValueError):
+        AIOKinesisProducer('test', loop, buffer_full_policy='drop')
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_producer_send_returns_future():
+    # Setup a stream with two shards
+    fake_kinesis_client = FakeKinesisClient('future-stream', shard_count=2)
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'future-stream',
+        loop,
+        linger_time=0.05,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+
+    futures = [await producer.send(str(i), {'i': i}) for i in range(10)]
+    results = await asyncio.gather(*futures)
+
+    # Every future should resolve to where its record was written
+    for i, result in enumerate(results):
+        assert isinstance(result, RecordMetadata)
+        assert result.shard_id == producer._shard_map.shard_for(str(i))
+        shard = [
+            shard for shard in fake_kinesis_client.shards
+            if shard.shard_id == result.shard_id
+        ][0]
+        record = [
+            record for record in shard.records
+            if record['SequenceNumber'] == result.sequence_number
+        ][0]
+        assert record['PartitionKey'] == str(i)
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_send_and_wait():
+    fake_kinesis_client = FakeKinesisClient('future-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'future-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+
+    result = await producer.send_and_wait('key', {})
+    assert result == RecordMetadata(
+        'shardId-000000000000',
+        fake_kinesis_client.shards[0].records[0]['SequenceNumber']
+    )
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_flush_sends_full_batches_right_away():
+    fake_kinesis_client = FakeKinesisClient('flush-stream')
+    put_records = fake_kinesis_client.put_records
+    batch_sizes = []
+
+    def recording_put_records(**kwargs):
+        batch_sizes.append(len(kwargs['Records']))
+        return put_records(**kwargs)
+    fake_kinesis_client.put_records = recording_put_records
+
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'flush-stream',
+        loop,
+        linger_time=10,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+    futures = [await producer.send(str(i), {}) for i in range(700)]
+
+    # Flushing doesn't wait for the linger time
+    start_time = loop.time()
+    assert await producer.flush() == []
+    assert loop.time() - start_time < 1
+    assert all(future.done() for future in futures)
+    assert sorted(batch_sizes) == [200, 500]
+    await producer.stop()
+
+
+@pytest.mark.asyncio
+async def test_producer_stop_delivers_buffered_messages():
+    fake_kinesis_client = FakeKinesisClient('stop-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'stop-stream',
+        loop,
+        linger_time=0.5,
+        transport=InlineTransport(fake_kinesis_client, delay=0.05),
+        max_in_flight_requests=1
+    )
+    await producer.start()
+    for i in range(10):
+        await producer.send(str(i), {})
+
+    assert await producer.stop() == []
+    assert len(fake_kinesis_client.shards[0].records) == 10
+
+
+@pytest.mark.asyncio
+async def test_producer_stop_drops_messages_after_timeout():
+    fake_kinesis_client = FakeKinesisClient('stop-stream')
+    on_dropped = MagicMock()
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'stop-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client, delay=1),
+        on_dropped=on_dropped
+    )
+    await producer.start()
+    future = await producer.send('a', {})
+
+    # The flush returns what's still pending, stopping gives up on it
+    assert len(await producer.flush(timeout=0.01)) == 1
+    undelivered = await producer.stop(timeout=0.05)
+    assert [message.partition_key for message in undelivered] == ['a']
+    assert isinstance(future.exception(), DeliveryTimeoutError)
+    on_dropped.assert_called_once()
+    assert fake_kinesis_client.shards[0].records == []
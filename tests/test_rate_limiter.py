@@ -0,0 +1,101 @@
+import asyncio
+from time import time
+
+import pytest
+
+from aiokinesis.rate_limiter import RateLimiter, shard_rate_limiter
+
+
+@pytest.mark.asyncio
+async def test_requests_per_rolling_second():
+    rate_limiter = RateLimiter(requests_per_second=5)
+
+    request_times = []
+    for _ in range(15):
+        await rate_limiter.acquire()
+        request_times.append(float(time()))
+
+    # Verify that we never make more than 5 requests per rolling second
+    # and that we're making almost 5 requests per rolling second
+    for i, request_time in enumerate(request_times[5:], 5):
+        assert request_time - request_times[i - 5] >= 1
+        assert request_time - request_times[i - 5] < 1.5
+
+
+@pytest.mark.asyncio
+async def test_bytes_per_rolling_second():
+    rate_limiter = RateLimiter(bytes_per_second=100)
+
+    # 60 + 40 bytes fit into the first second, the next 60 don't
+    start_time = float(time())
+    await rate_limiter.acquire(size=60)
+    await rate_limiter.acquire(size=40)
+    assert float(time()) - start_time < 0.1
+    await rate_limiter.acquire(size=60)
+    assert float(time()) - start_time >= 1
+
+
+@pytest.mark.asyncio
+async def test_oversized_acquire_does_not_deadlock():
+    rate_limiter = RateLimiter(bytes_per_second=100)
+
+    # A single acquire larger than the limit goes through on its own
+    await asyncio.wait_for(rate_limiter.acquire(size=500), timeout=0.1)
+
+
+@pytest.mark.asyncio
+async def test_charge():
+    rate_limiter = RateLimiter(requests_per_second=5, bytes_per_second=100)
+
+    # Charging usage after the fact should delay the next acquire
+    await rate_limiter.acquire()
+    rate_limiter.charge(size=150)
+    start_time = float(time())
+    await rate_limiter.acquire()
+    assert float(time()) - start_time >= 0.9
+
+
+@pytest.mark.asyncio
+async def test_concurrent_acquires_share_budget():
+    rate_limiter = RateLimiter(requests_per_second=5)
+    request_times = []
+
+    async def make_requests():
+        for _ in range(5):
+            await rate_limiter.acquire()
+            request_times.append(float(time()))
+
+    # Three clients sharing one limiter make 15 requests in about 2 seconds
+    await asyncio.gather(*[make_requests() for _ in range(3)])
+    request_times.sort()
+    for i, request_time in enumerate(request_times[5:], 5):
+        assert request_time - request_times[i - 5] >= 1
+
+
+def test_shard_rate_limiter():
+    # Limiters are shared per stream, shard and operation
+    read_limiter = shard_rate_limiter('stream', 'shard-1', 'read')
+    assert shard_rate_limiter('stream', 'shard-1', 'read') is read_limiter
+    assert shard_rate_limiter('stream', 'shard-2', 'read') is not read_limiter
+    assert shard_rate_limiter('stream', 'shard-1', 'write') is not \
+        read_limiter
+    assert shard_rate_limiter('other', 'shard-1', 'read') is not read_limiter
+
+    with pytest.raises(ValueError):
+        shard_rate_limiter('stream', 'shard-1', 'delete')
+
+
+def test_shard_rate_limiter_on_several_loops():
+    rate_limiter = shard_rate_limiter('stream', 'shard-1', 'read')
+
+    async def burst():
+        # Seven requests queue behind each other for the budget of five
+        await asyncio.gather(*[rate_limiter.acquire() for _ in range(7)])
+
+    # The process wide limiter keeps working once the first loop is gone
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(burst())
+    loop.close()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(burst())
+    loop.close()
@@ -0,0 +1,154 @@
+import asyncio
+from datetime import datetime
+import gc
+import pickle
+import weakref
+
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, Record
+from aiokinesis.aggregation import RecordAggregator
+from aiokinesis.record import records_from_response
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def aggregated_record(sequence_number='42'):
+    aggregator = RecordAggregator()
+    aggregator.add('a', b'first')
+    aggregator.add('b', b'second')
+    return {
+        'SequenceNumber': sequence_number,
+        'PartitionKey': 'a',
+        'ApproximateArrivalTimestamp': datetime.min,
+        'Data': aggregator.serialize()
+    }
+
+
+def test_records_from_response():
+    timestamp = datetime.min
+    data = b'plain'
+    record, = records_from_response([{
+        'SequenceNumber': '1',
+        'PartitionKey': 'key',
+        'ApproximateArrivalTimestamp': timestamp,
+        'Data': data
+    }], 'shard-1')
+
+    assert record.shard_id == 'shard-1'
+    assert record.sequence_number == '1'
+    assert record.sub_sequence_number is None
+    assert record.partition_key == 'key'
+    assert record.approximate_arrival_timestamp is timestamp
+
+    # The data of plain records isn't copied
+    assert record.data is data
+    assert not hasattr(record, '__dict__')
+
+
+def test_aggregated_records_are_views():
+    first, second = records_from_response([aggregated_record()], 'shard-1')
+
+    assert [first.sub_sequence_number, second.sub_sequence_number] == [0, 1]
+    assert [first.partition_key, second.partition_key] == ['a', 'b']
+    assert first.sequence_number == second.sequence_number == '42'
+
+    # Data stays a view of the aggregated record until it's read
+    assert type(first._data) is memoryview
+    assert first.data_view == b'first'
+    assert type(first._data) is memoryview
+    assert first.data == b'first'
+    assert type(first.data) is bytes
+
+
+def test_values_are_decoded_once_when_read():
+    decoded = []
+
+    def decode(data):
+        decoded.append(data)
+        return data.decode('utf-8').upper()
+
+    first, second = records_from_response(
+        [aggregated_record()],
+        'shard-1',
+        decode
+    )
+    assert decoded == []
+    assert first.value == 'FIRST'
+    assert first.value == 'FIRST'
+    assert decoded == [b'first']
+
+
+def test_boto3_field_names():
+    record, = records_from_response([{
+        'SequenceNumber': '1',
+        'PartitionKey': 'key',
+        'Data': b'data'
+    }], 'shard-1')
+
+    assert record['Data'] == b'data'
+    assert record['ShardId'] == 'shard-1'
+    assert 'SequenceNumber' in record
+
+    # Like a boto3 record dict, fields it wouldn't have are missing
+    assert 'SubSequenceNumber' not in record
+    assert record.get('SubSequenceNumber', -1) == -1
+    with pytest.raises(KeyError):
+        record['Value']
+    with pytest.raises(KeyError):
+        record['Unknown']
+
+
+def test_pickle():
+    first, _ = records_from_response(
+        [aggregated_record()],
+        'shard-1',
+        lambda data: data.decode('utf-8')
+    )
+    unpickled = pickle.loads(pickle.dumps(first))
+
+    assert isinstance(unpickled, Record)
+    assert unpickled.sequence_number == '42'
+    assert unpickled.sub_sequence_number == 0
+    assert unpickled.data == b'first'
+    assert unpickled.value == 'first'
+
+
+class ResponseRecords(list):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_consumer_frees_responses():
+    fake_kinesis_client = FakeKinesisClient('free-stream')
+    fake_kinesis_client.put_record(
+        StreamName='free-stream',
+        Data=b'data',
+        PartitionKey='key'
+    )
+
+    # Keep a weak reference to the records of every response
+    responses = []
+    get_records = fake_kinesis_client.get_records
+
+    def tracking_get_records(**kwargs):
+        response = get_records(**kwargs)
+        response['Records'] = ResponseRecords(response['Records'])
+        responses.append(weakref.ref(response['Records']))
+        return response
+    fake_kinesis_client.get_records = tracking_get_records
+
+    loop = asyncio.get_event_loop()
+    consumer = AIOKinesisConsumer(
+        'free-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await consumer.start()
+    record = await consumer.__anext__()
+    assert isinstance(record, Record)
+    assert record.data == b'data'
+
+    gc.collect()
+    assert responses[0]() is None
+    await consumer.stop()
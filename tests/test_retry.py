@@ -0,0 +1,93 @@
+from botocore.exceptions import ClientError, EndpointConnectionError
+from mock import MagicMock
+import pytest
+
+from aiokinesis.errors import RecordError
+from aiokinesis.retry import RetryPolicy, error_code, is_retryable
+from fake_kinesis import client_error
+
+
+@pytest.mark.parametrize('error, retryable', [
+    (
+        client_error('ProvisionedThroughputExceededException', 'PutRecords'),
+        True
+    ),
+    (client_error('InternalFailure', 'PutRecords'), True),
+    (client_error('ResourceNotFoundException', 'PutRecords'), False),
+    (client_error('ValidationException', 'PutRecords'), False),
+    (RecordError('ProvisionedThroughputExceededException'), True),
+    (RecordError('KMSAccessDeniedException'), False),
+    (EndpointConnectionError(endpoint_url='http://localhost'), True),
+    (ValueError(), False),
+])
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) == retryable
+
+
+def test_error_code():
+    assert error_code(client_error('InternalFailure', 'PutRecords')) == \
+        'InternalFailure'
+    assert error_code(RecordError('InternalFailure', 'oops')) == \
+        'InternalFailure'
+    assert error_code(ValueError()) is None
+
+
+def test_backoff_is_jittered_and_capped():
+    retry_policy = RetryPolicy(base_delay=0.1, max_delay=1)
+
+    for attempt in range(10):
+        delays = {retry_policy.backoff(attempt) for _ in range(20)}
+        assert len(delays) > 1
+        assert all(
+            0 <= delay <= min(1, 0.1 * 2 ** attempt)
+            for delay in delays
+        )
+
+
+@pytest.mark.asyncio
+async def test_call_retries_retryable_errors():
+    retry_policy = RetryPolicy(max_retries=3, base_delay=0.01)
+    request = MagicMock(side_effect=[
+        client_error('ProvisionedThroughputExceededException', 'PutRecords'),
+        client_error('InternalFailure', 'PutRecords'),
+        'response',
+    ])
+
+    async def make_request():
+        return request()
+
+    assert await retry_policy.call(make_request) == 'response'
+    assert request.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_call_gives_up_after_max_retries():
+    retry_policy = RetryPolicy(max_retries=2, base_delay=0.01)
+    request = MagicMock(
+        side_effect=client_error(
+            'ProvisionedThroughputExceededException',
+            'PutRecords'
+        )
+    )
+
+    async def make_request():
+        return request()
+
+    with pytest.raises(ClientError):
+        await retry_policy.call(make_request)
+    assert request.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_call_does_not_retry_other_errors():
+    retry_policy = RetryPolicy(max_retries=2, base_delay=0.01)
+    request = MagicMock(
+        side_effect=client_error('ResourceNotFoundException', 'PutRecords')
+    )
+
+    async def make_request():
+        return request()
+
+    with pytest.raises(ClientError):
+        await retry_policy.call(make_request)
+    assert request.call_count == 1
@@ -0,0 +1,138 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, AIOKinesisProducer
+from aiokinesis.serialization import get_compression
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def test_gzip_round_trip():
+    compression = get_compression('gzip')
+    compressed = compression.compress('{"a": 1}')
+    assert gzip.decompress(compressed) == b'{"a": 1}'
+    assert compression.decompress(compressed) == b'{"a": 1}'
+
+
+def test_decompress_passes_uncompressed_data_through():
+    compression = get_compression('gzip')
+    assert compression.decompress(b'{"a": 1}') == b'{"a": 1}'
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        get_compression('lz4')
+
+
+@pytest.mark.asyncio
+async def test_producer_value_serializer():
+    fake_kinesis_client = FakeKinesisClient('serializer-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'serializer-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client),
+        value_serializer=lambda value: str(value * 2)
+    )
+    await producer.start()
+    await producer.send_and_wait('key', 21)
+    await producer.stop()
+
+    assert fake_kinesis_client.shards[0].records[0]['Data'] == b'42'
+
+
+@pytest.mark.asyncio
+async def test_producer_sends_bytes_as_is():
+    fake_kinesis_client = FakeKinesisClient('bytes-stream')
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'bytes-stream',
+        loop,
+        transport=InlineTransport(fake_kinesis_client)
+    )
+    await producer.start()
+    await producer.send_and_wait('key', b'\x00raw')
+    await producer.stop()
+
+    assert fake_kinesis_client.shards[0].records[0]['Data'] == b'\x00raw'
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('aggregate', [False, True])
+async def test_compressed_round_trip(aggregate):
+    fake_kinesis_client = FakeKinesisClient('compressed-stream')
+    transport = InlineTransport(fake_kinesis_client)
+    loop = asyncio.get_event_loop()
+    producer = AIOKinesisProducer(
+        'compressed-stream',
+        loop,
+        linger_time=0.05,
+        transport=transport,
+        aggregate=aggregate,
+        compression='gzip'
+    )
+    await producer.start()
+    futures = [await producer.send('key', {'i': i}) for i in range(10)]
+    await asyncio.gather(*futures)
+    await producer.stop()
+
+    consumer = AIOKinesisConsumer(
+        'compressed-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport,
+        value_deserializer=json.loads,
+        compression='gzip'
+    )
+    await consumer.start()
+    records = []
+    async for record in consumer:
+        records.append(record)
+        if len(records) == 10:
+            break
+    await consumer.stop()
+
+    assert [record['Value'] for record in records] == \
+        [{'i': i} for i in range(10)]
+    assert gzip.decompress(records[0]['Data']) == b'{"i": 0}'
+
+
+@pytest.mark.asyncio
+async def test_consumer_decodes_values_when_read():
+    fake_kinesis_client = FakeKinesisClient('lazy-stream')
+    for i in range(3):
+        fake_kinesis_client.put_record(
+            StreamName='lazy-stream',
+            Data=json.dumps(i),
+            PartitionKey='key'
+        )
+    loop = asyncio.get_event_loop()
+    decoded = []
+
+    def value_deserializer(data):
+        decoded.append(data)
+        return json.loads(data)
+
+    consumer = AIOKinesisConsumer(
+        'lazy-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=InlineTransport(fake_kinesis_client),
+        value_deserializer=value_deserializer
+    )
+    await consumer.start()
+
+    # Records are only decoded once their value is read, and only once
+    record = await consumer.__anext__()
+    assert decoded == []
+    assert record.value == 0
+    assert record['Value'] == 0
+    assert len(decoded) == 1
+
+    records = await consumer.getmany()
+    assert len(decoded) == 1
+    assert [record.value for record in records] == [1, 2]
+    assert len(decoded) == 3
+    await consumer.stop()
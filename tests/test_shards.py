@@ -0,0 +1,140 @@
+
+import asyncio
+import gc
+import weakref
+
+import pytest
+
+from aiokinesis.shards import (
+    ShardMap, list_shards, parent_shard_ids, partition_key_hash, shard_cache
+)
+from fake_kinesis import FakeKinesisClient, InlineTransport
+
+
+def test_partition_key_hash():
+    # MD5 of the partition key as a 128 bit integer
+    assert partition_key_hash('a') == \
+        0x0cc175b9c0f1b6a831c399e269772661
+    assert partition_key_hash(1) == partition_key_hash('1')
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 5, 16])
+def test_shard_map_matches_kinesis_routing(shard_count):
+    fake_kinesis_client = FakeKinesisClient('test', shard_count=shard_count)
+    shard_map = ShardMap([
+        shard.describe() for shard in fake_kinesis_client.shards
+    ])
+
+    # Records should land on the shard the map predicts
+    for i in range(200):
+        response = fake_kinesis_client.put_record(
+            StreamName='test',
+            Data='{}',
+            PartitionKey=str(i)
+        )
+        assert shard_map.shard_for(str(i)) == response['ShardId']
+
+
+def test_shard_map_ignores_closed_shards():
+    shard_map = ShardMap([
+        {
+            'ShardId': 'closed',
+            'HashKeyRange': {'StartingHashKey': '0', 'EndingHashKey': '99'},
+            'SequenceNumberRange': {
+                'StartingSequenceNumber': '0',
+                'EndingSequenceNumber': '10',
+            },
+        },
+        {
+            'ShardId': 'low',
+            'HashKeyRange': {'StartingHashKey': '0', 'EndingHashKey': '49'},
+            'SequenceNumberRange': {'StartingSequenceNumber': '11'},
+        },
+        {
+            'ShardId': 'high',
+            'HashKeyRange': {'StartingHashKey': '50', 'EndingHashKey': '99'},
+            'SequenceNumberRange': {'StartingSequenceNumber': '11'},
+        },
+    ])
+
+    assert shard_map.shard_ids == ['low', 'high']
+    assert shard_map.shard_for_hash_key(0) == 'low'
+    assert shard_map.shard_for_hash_key(49) == 'low'
+    assert shard_map.shard_for_hash_key(50) == 'high'
+    assert shard_map.shard_for_hash_key(99) == 'high'
+    assert shard_map.shard_for_hash_key(100) is None
+
+
+@pytest.mark.asyncio
+async def test_list_shards_pagination():
+    fake_kinesis_client = FakeKinesisClient('test', shard_count=5)
+    original_list_shards = fake_kinesis_client.list_shards
+
+    # Return two shards per page
+    def list_shards_page(**kwargs):
+        return original_list_shards(MaxResults=2, **kwargs)
+    fake_kinesis_client.list_shards = list_shards_page
+
+    shards = await list_shards(InlineTransport(fake_kinesis_client), 'test')
+    assert [shard['ShardId'] for shard in shards] == [
+        shard.shard_id for shard in fake_kinesis_client.shards
+    ]
+
+
+@pytest.mark.asyncio
+async def test_shard_cache():
+    fake_kinesis_client = FakeKinesisClient('test', shard_count=2)
+    transport = InlineTransport(fake_kinesis_client, delay=0.01)
+    cache = shard_cache(transport)
+    assert shard_cache(transport) is cache
+
+    # Concurrent lookups share one listing, later ones reuse it
+    listings = await asyncio.gather(*[
+        cache.list_shards('test') for _ in range(10)
+    ])
+    assert all(len(shards) == 2 for shards in listings)
+    await cache.list_shards('test')
+    assert fake_kinesis_client.calls.count('list_shards') == 1
+
+    # Resharding invalidates the cached shards
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 126)
+    cache.invalidate('test')
+    assert len(await cache.list_shards('test')) == 4
+
+    # So does their age
+    cache.ttl = 0
+    await cache.list_shards('test')
+    assert fake_kinesis_client.calls.count('list_shards') == 3
+
+
+def test_shard_cache_is_dropped_with_transport():
+    transport = InlineTransport(FakeKinesisClient('test'))
+    cache = weakref.ref(shard_cache(transport))
+
+    # The cache doesn't keep its transport alive
+    del transport
+    gc.collect()
+    assert cache() is None
+
+
+def test_parent_shard_ids():
+    fake_kinesis_client = FakeKinesisClient('test', shard_count=2)
+    fake_kinesis_client.split_shard('shardId-000000000000', 2 ** 126)
+    merged = fake_kinesis_client.merge_shards(
+        'shardId-000000000002',
+        'shardId-000000000003'
+    )
+    shards = {
+        shard.shard_id: shard.describe()
+        for shard in fake_kinesis_client.shards
+    }
+
+    assert parent_shard_ids(shards['shardId-000000000000']) == []
+    assert parent_shard_ids(shards['shardId-000000000002']) == \
+        ['shardId-000000000000']
+    assert parent_shard_ids(shards[merged.shard_id]) == \
+        ['shardId-000000000002', 'shardId-000000000003']
+
+    # Only open shards take new records
+    shard_map = ShardMap(shards.values())
+    assert shard_map.shard_ids == [merged.shard_id, 'shardId-000000000001']
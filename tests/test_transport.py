@@ -0,0 +1,239 @@
+import asyncio
+import json
+import threading
+from time import sleep
+
+from mock import MagicMock, patch
+import pytest
+
+from aiokinesis import AIOKinesisConsumer, AIOKinesisProducer
+from aiokinesis import transport as transport_module
+from aiokinesis.transport import AiobotocoreTransport, ExecutorTransport
+from fake_kinesis import FakeKinesisClient
+
+
+@pytest.mark.asyncio
+async def test_executor_transport_start():
+    with patch('boto3.client') as mock_boto3_client:
+        loop = asyncio.get_event_loop()
+        transport = ExecutorTransport(
+            loop,
+            region_name='us-west-2',
+            endpoint_url='http://localhost:4567'
+        )
+
+        # Starting twice should only create one client
+        await transport.start()
+        await transport.start()
+        mock_boto3_client.assert_called_once_with(
+            'kinesis',
+            region_name='us-west-2',
+            endpoint_url='http://localhost:4567'
+        )
+
+        await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_clients_share_transport_and_shards():
+    with patch('boto3.client') as mock_boto3_client:
+        mock_boto3_client.return_value = FakeKinesisClient('shared-stream')
+        loop = asyncio.get_event_loop()
+        producer = AIOKinesisProducer('shared-stream', loop)
+        consumer = AIOKinesisConsumer('shared-stream', loop)
+        await asyncio.gather(producer.start(), consumer.start())
+
+        # Both clients use one boto3 client and list the shards once
+        assert producer._transport is consumer._transport
+        mock_boto3_client.assert_called_once()
+        assert mock_boto3_client.return_value.calls.count('list_shards') == 1
+
+        # The transport is closed once the last client stops
+        await producer.stop()
+        assert producer._transport._executor is not None
+        await consumer.stop()
+        assert producer._transport._executor is None
+        assert transport_module._shared_transports == {}
+
+
+@pytest.mark.asyncio
+async def test_executor_transport_does_not_block_loop():
+    # Setup a client which blocks for a while on every request
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.get_records.side_effect = \
+        lambda **kwargs: sleep(0.3) or {'Records': []}
+
+    loop = asyncio.get_event_loop()
+    transport = ExecutorTransport(loop, client=mock_kinesis_client)
+    await transport.start()
+
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(loop.time())
+            await asyncio.sleep(0.01)
+
+    # The loop should keep running other tasks while the request is made
+    ticker = asyncio.ensure_future(tick())
+    response = await transport.request('get_records', ShardIterator='abc')
+    ticker.cancel()
+
+    assert response == {'Records': []}
+    mock_kinesis_client.get_records.assert_called_once_with(
+        ShardIterator='abc'
+    )
+    assert len(ticks) > 10
+
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_executor_transport_max_workers():
+    # Setup a client which blocks for a while on every request
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.put_record.side_effect = \
+        lambda **kwargs: sleep(0.2)
+
+    loop = asyncio.get_event_loop()
+    transport = ExecutorTransport(
+        loop,
+        max_workers=2,
+        client=mock_kinesis_client
+    )
+    await transport.start()
+
+    # Four requests on two workers should take two round trips
+    start_time = loop.time()
+    await asyncio.gather(*[
+        transport.request('put_record', PartitionKey=str(i))
+        for i in range(4)
+    ])
+    elapsed = loop.time() - start_time
+    assert 0.4 <= elapsed < 0.6
+
+    await transport.close()
+
+
+def test_aiobotocore_transport_missing_dependency():
+    loop = asyncio.new_event_loop()
+    with patch.object(transport_module, 'get_session', None):
+        with pytest.raises(RuntimeError):
+            AiobotocoreTransport(loop)
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_aiobotocore_transport_request():
+    # Setup a fake aiobotocore session
+    mock_kinesis_client = MagicMock()
+
+    async def put_record(**kwargs):
+        return {'ShardId': 'shardId-000000000000'}
+    mock_kinesis_client.put_record = put_record
+
+    class ClientContext:
+        async def __aenter__(self):
+            return mock_kinesis_client
+
+        async def __aexit__(self, *args):
+            self.closed = True
+
+    client_context = ClientContext()
+    mock_session = MagicMock()
+    mock_session.create_client.return_value = client_context
+
+    with patch.object(transport_module, 'get_session',
+                      return_value=mock_session):
+        loop = asyncio.get_event_loop()
+        transport = AiobotocoreTransport(loop, region_name='eu-west-1')
+        await transport.start()
+        mock_session.create_client.assert_called_once_with(
+            'kinesis',
+            region_name='eu-west-1'
+        )
+
+        response = await transport.request('put_record', PartitionKey='a')
+        assert response == {'ShardId': 'shardId-000000000000'}
+
+        await transport.close()
+        assert client_context.closed
+
+
+@pytest.mark.asyncio
+async def test_produce_and_consume_with_fake_kinesis():
+    fake_kinesis_client = FakeKinesisClient('test-stream')
+    loop = asyncio.get_event_loop()
+
+    # Share a single transport between producer and consumer
+    transport = ExecutorTransport(loop, client=fake_kinesis_client)
+    producer = AIOKinesisProducer('test-stream', loop, transport=transport)
+    consumer = AIOKinesisConsumer(
+        'test-stream',
+        loop,
+        shard_iterator_type='TRIM_HORIZON',
+        transport=transport
+    )
+
+    await producer.start()
+    await producer.send('key', {'hello': 'world'})
+    await asyncio.sleep(0.1)
+    await producer.stop()
+
+    await consumer.start()
+    record = await consumer.__anext__()
+    await consumer.stop()
+    await transport.close()
+
+    assert record['PartitionKey'] == 'key'
+    assert json.loads(record['Data'].decode('utf-8')) == {'hello': 'world'}
+
+
+class BlockingEventStream:
+    """
+    Waits for events until it's closed, like a quiet subscription
+    """
+
+    def __init__(self):
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        self._closed.wait()
+        yield from ()
+
+    def close(self):
+        self._closed.set()
+
+
+@pytest.mark.asyncio
+async def test_executor_transport_event_streams_have_own_threads():
+    mock_kinesis_client = MagicMock()
+    mock_kinesis_client.list_shards.return_value = {'Shards': []}
+
+    loop = asyncio.get_event_loop()
+    transport = ExecutorTransport(
+        loop,
+        max_workers=1,
+        client=mock_kinesis_client
+    )
+    await transport.start()
+
+    # Subscriptions waiting for events leave the worker free for requests
+    event_streams = [BlockingEventStream() for _ in range(2)]
+    subscriptions = [
+        asyncio.ensure_future(transport.iterate_events(s).__anext__())
+        for s in event_streams
+    ]
+    await asyncio.sleep(0.05)
+    response = await asyncio.wait_for(
+        transport.request('list_shards', StreamName='stream'),
+        timeout=1
+    )
+    assert response == {'Shards': []}
+
+    for event_stream in event_streams:
+        event_stream.close()
+    for subscription in subscriptions:
+        with pytest.raises(StopAsyncIteration):
+            await asyncio.wait_for(subscription, timeout=1)
+    await transport.close()